@@ -0,0 +1,462 @@
+"""
+検索画面のベンチマーク用の合成データと代替ES
+
+generate() は commentall のドキュメント構成(コメント本文・動画ID・
+チャンネルID・配信日時・収集日時・動画内位置)に沿った
+コメントを乱数の種から再現可能に生成し、グループ・チャンネル・動画をDBに登録する。
+本文は日本語・絵文字・ハングル・英字を混ぜる。
+FakeSearch はそのコメントに対して検索画面が使う範囲のクエリ
+(bool / match_phrase / wildcard / term / range、composite / terms / histogram 集計、
+sort / search_after / point-in-time)に応答する、プロセス内のESの代わり。
+es_client.FakeTransport.handler に設定して使う。
+isolated() はベンチマークコマンドの実行環境(テスト用DB・プロセス内キャッシュ)を
+用意し、終了時にDB・キャッシュ・ESのトランスポートの設定を元に戻す。
+"""
+import random
+import re
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+import comment.es_client as es_client
+import comment.history_writer as history_writer
+from comment.models import Channel, ChannelGroup, Video
+
+JST = timezone(timedelta(hours=9))
+
+JP_WORDS = ("草", "かわいい", "おつかれ", "ナイス", "えっ", "こんばんは", "初見です",
+            "歌うま", "てぇてぇ", "神回", "ｗｗｗ", "888", "助かる", "かっこいい",
+            "おはよう", "ありがとう", "天才", "ｗ")
+EMOJI_WORDS = ("😂", "👏", "💕", "🎉", "🔥", "😭", "🤣", "✨")
+HANGUL_WORDS = ("ㅋㅋㅋ", "안녕하세요", "대박", "귀여워", "사랑해")
+ASCII_WORDS = ("www", "lol", "gg", "nice", "kawaii", "wwwww", "LOL")
+TITLE_WORDS = ("歌枠", "雑談", "ゲーム実況", "Minecraft", "APEX", "耐久", "コラボ",
+               "記念配信", "朝活", "ASMR", "凸待ち", "新衣装")
+# 本文の語の種類の出現割合
+WORD_KINDS = ((JP_WORDS, 70), (EMOJI_WORDS, 12), (HANGUL_WORDS, 8), (ASCII_WORDS, 10))
+
+# 直近の動画を置く期間(秒)
+RECENT_SPAN = 14 * 24 * 60 * 60
+
+Corpus = namedtuple('Corpus', ['groups', 'channels', 'videos', 'docs'])
+
+# 終了時に戻す代替トランスポートの設定
+FAKE_TRANSPORT_ATTRS = ('handler', 'delay')
+
+
+@contextmanager
+def isolated():
+    """テスト用DBとプロセス内キャッシュの中で実行する(本番のDB・キャッシュに書き込まない)
+
+    終了時にDB・キャッシュを戻し、ESのトランスポートと FakeTransport /
+    FakeAsyncTransport の handler・delay を開始前の値に戻す。
+    """
+    cache_settings = {alias: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                              'LOCATION': 'bench_' + alias,
+                              'OPTIONS': {'MAX_ENTRIES': 100000}}
+                      for alias in settings.CACHES}
+    transport_class = es_client.get_transport_class()
+    async_transport_class = es_client.get_async_transport_class()
+    fake_attrs = [(cls, name, getattr(cls, name))
+                  for cls in (es_client.FakeTransport, es_client.FakeAsyncTransport)
+                  for name in FAKE_TRANSPORT_ATTRS]
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        with override_settings(CACHES=cache_settings):
+            yield
+            # 検索履歴の書き込みはテスト用DBがあるうちに済ませる
+            history_writer.flush()
+    finally:
+        es_client.set_transport_class(transport_class)
+        es_client.set_async_transport_class(async_transport_class)
+        for cls, name, value in fake_attrs:
+            setattr(cls, name, value)
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        # SQLite のメモリ上のテスト用DBは閉じられずに残るため、元のDBに接続し直させる
+        connection.close()
+        teardown_test_environment()
+
+
+def _timestamp_text(msec):
+    seconds = msec // 1000
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return "%d:%02d:%02d" % (hours, minutes, seconds)
+    return "%d:%02d" % (minutes, seconds)
+
+
+def make_message(rnd):
+    words = []
+    for _ in range(rnd.randint(1, 4)):
+        kind = rnd.choices([words for words, _ in WORD_KINDS],
+                           [weight for _, weight in WORD_KINDS])[0]
+        words.append(rnd.choice(kind))
+    return rnd.choice(("", " ")).join(words)
+
+
+def generate(groups=3, channels=12, videos=40, comments=60, years=4, seed=0, nowtime=None,
+             recent_ratio=0.1):
+    """合成データを作成してDBに登録し、Corpus を返す
+
+    videos はチャンネルあたりの動画数、comments は動画あたりの平均コメント数。
+    動画は nowtime までの years 年間に分散させ、直近モード用に
+    recent_ratio の割合を直近2週間に置く。
+    """
+    rnd = random.Random(seed)
+    nowtime = nowtime or datetime.now(JST).replace(microsecond=0)
+    span = int(timedelta(days=365 * years).total_seconds())
+
+    group_list = [ChannelGroup.objects.create(groupName="ベンチ" + str(i + 1), no=i + 1)
+                  for i in range(groups)]
+    channel_list = []
+    for i in range(channels):
+        channel_list.append(Channel(id="UCbench%06d" % i, channelName="ベンチチャンネル" + str(i),
+                                    group=group_list[i % groups], no=i))
+    Channel.objects.bulk_create(channel_list)
+
+    video_list = []
+    docs = []
+    for channel in channel_list:
+        for i in range(videos):
+            if rnd.random() < recent_ratio:
+                publishedAt = nowtime - timedelta(seconds=rnd.randrange(RECENT_SPAN))
+            else:
+                publishedAt = nowtime - timedelta(seconds=rnd.randrange(span))
+            video = Video(id="bv%s%04d" % (channel.id[-4:], i), channel=channel,
+                          title=" ".join(rnd.sample(TITLE_WORDS, 2)) + " #" + str(i),
+                          description="", publishedAt=publishedAt,
+                          collectedAt=publishedAt + timedelta(hours=rnd.randint(3, 72)),
+                          enable=True, public=True)
+            video_list.append(video)
+
+            published_msec = int(publishedAt.timestamp()) * 1000
+            collected_msec = int(video.collectedAt.timestamp()) * 1000
+            duration = rnd.randint(30, 240) * 60 * 1000
+            # 動画ごとのコメント数は平均の半分から1.5倍
+            for n in range(rnd.randint(comments // 2, comments + comments // 2)):
+                offset = rnd.randrange(duration)
+                docs.append({
+                    'id': len(docs) + 1,
+                    'video_id': video.id,
+                    'video_channel_id': channel.id,
+                    'video_publishedat': published_msec,
+                    'video_collectedat': collected_msec,
+                    'message': make_message(rnd),
+                    'date': published_msec + offset,
+                    'timestamptext': _timestamp_text(offset),
+                    'videooffsettimemsec': offset,
+                })
+    Video.objects.bulk_create(video_list)
+    return Corpus(group_list, channel_list, video_list, docs)
+
+
+# ---- 代替ES ----
+
+# 全文検索の対象(部分一致で判定する)フィールド
+TEXT_FIELDS = ('message',)
+
+
+class UnsupportedQuery(Exception):
+    """FakeSearch が扱えないクエリ"""
+    pass
+
+
+def _field(name):
+    # message.ngram 等のサブフィールドは元のフィールドで判定する
+    return name.split('.')[0]
+
+
+def _wildcard_regex(pattern):
+    regex = ""
+    escaped = False
+    for char in pattern:
+        if escaped:
+            regex += re.escape(char)
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == '*':
+            regex += ".*"
+        elif char == '?':
+            regex += "."
+        else:
+            regex += re.escape(char)
+    return re.compile(regex, re.DOTALL)
+
+
+def _value(condition, key):
+    if isinstance(condition, dict):
+        return condition[key]
+    return condition
+
+
+def compile_query(query):
+    """クエリを判定関数 (ドキュメント -> 真偽) に変換"""
+    if not query or 'match_all' in query:
+        return lambda doc: True
+    (kind, condition), = query.items()
+
+    if kind == 'bool':
+        must = [compile_query(q) for q in condition.get('must', []) + condition.get('filter', [])]
+        must_not = [compile_query(q) for q in condition.get('must_not', [])]
+        should = [compile_query(q) for q in condition.get('should', [])]
+        minimum = condition.get('minimum_should_match', 0 if must or must_not else 1)
+        if not should:
+            minimum = 0
+
+        def match_bool(doc):
+            if not all(fn(doc) for fn in must):
+                return False
+            if any(fn(doc) for fn in must_not):
+                return False
+            return minimum == 0 or sum(1 for fn in should if fn(doc)) >= minimum
+        return match_bool
+
+    if kind in ('match_phrase', 'match', 'term'):
+        (name, condition), = condition.items()
+        field = _field(name)
+        value = _value(condition, 'value' if kind == 'term' else 'query')
+        if field in TEXT_FIELDS:
+            return lambda doc: value in doc[field]
+        return lambda doc: doc[field] == value
+
+    if kind == 'terms':
+        (name, values), = condition.items()
+        field = _field(name)
+        values = set(values)
+        return lambda doc: doc[field] in values
+
+    if kind == 'wildcard':
+        (name, condition), = condition.items()
+        field = _field(name)
+        regex = _wildcard_regex(_value(condition, 'value'))
+        return lambda doc: regex.fullmatch(doc[field]) is not None
+
+    if kind == 'range':
+        (name, condition), = condition.items()
+        field = _field(name)
+        checks = []
+        for op, bound in condition.items():
+            if op == 'gt':
+                checks.append(lambda v, b=bound: v > b)
+            elif op == 'gte':
+                checks.append(lambda v, b=bound: v >= b)
+            elif op == 'lt':
+                checks.append(lambda v, b=bound: v < b)
+            elif op == 'lte':
+                checks.append(lambda v, b=bound: v <= b)
+            else:
+                raise UnsupportedQuery("range." + op)
+        return lambda doc: all(check(doc[field]) for check in checks)
+
+    raise UnsupportedQuery(kind)
+
+
+def _compare(a, b, orders):
+    for x, y, order in zip(a, b, orders):
+        if x != y:
+            result = -1 if x < y else 1
+            return -result if order == 'desc' else result
+    return 0
+
+
+def _sorted(items, key, orders):
+    """key(item) の各要素を orders の昇順/降順で並べる(後ろの要素から安定ソート)"""
+    items = list(items)
+    for i in reversed(range(len(orders))):
+        items.sort(key=lambda item: key(item)[i], reverse=orders[i] == 'desc')
+    return items
+
+
+def _sort_spec(sort):
+    fields = []
+    orders = []
+    for item in sort:
+        if isinstance(item, dict):
+            (name, option), = item.items()
+            fields.append(_field(name))
+            orders.append(option.get('order', 'asc') if isinstance(option, dict) else option)
+        else:
+            fields.append(_field(item))
+            orders.append('asc')
+    return fields, orders
+
+
+SELECTOR_RE = re.compile(r"^params\.(\w+)\s*(>=|>|<=|<|==)\s*params\.(\w+)$")
+SELECTOR_OPS = {
+    '>=': lambda a, b: a >= b,
+    '>': lambda a, b: a > b,
+    '<=': lambda a, b: a <= b,
+    '<': lambda a, b: a < b,
+    '==': lambda a, b: a == b,
+}
+
+
+def _bucket_selector(selector):
+    """bucket_selector を判定関数 (バケット -> 真偽) に変換(件数の比較のみ対応)"""
+    script = selector['script']
+    source = script['source'] if isinstance(script, dict) else script
+    params = script.get('params', {}) if isinstance(script, dict) else {}
+    match = SELECTOR_RE.match(source.strip())
+    if match is None:
+        raise UnsupportedQuery("bucket_selector:" + source)
+    left, op, right = match.groups()
+    paths = selector['buckets_path']
+
+    def value(name, bucket):
+        if paths.get(name) == '_count':
+            return bucket['doc_count']
+        if name in params:
+            return params[name]
+        raise UnsupportedQuery("bucket_selector:" + name)
+    return lambda bucket: SELECTOR_OPS[op](value(left, bucket), value(right, bucket))
+
+
+def _apply_sub_aggs(agg, buckets):
+    for name, sub in agg.get('aggs', {}).items():
+        if 'bucket_selector' in sub:
+            keep = _bucket_selector(sub['bucket_selector'])
+            buckets = [bucket for bucket in buckets if keep(bucket)]
+        else:
+            raise UnsupportedQuery("aggs." + name)
+    return buckets
+
+
+def aggregate(agg, docs):
+    if 'composite' in agg:
+        composite = agg['composite']
+        names = []
+        fields = []
+        orders = []
+        for source in composite['sources']:
+            (name, option), = source.items()
+            names.append(name)
+            fields.append(_field(option['terms']['field']))
+            orders.append(option['terms'].get('order', 'asc'))
+        counts = {}
+        for doc in docs:
+            key = tuple(doc[field] for field in fields)
+            counts[key] = counts.get(key, 0) + 1
+        keys = _sorted(counts, lambda key: key, orders)
+        if 'after' in composite:
+            after = tuple(composite['after'][name] for name in names)
+            keys = [key for key in keys if _compare(key, after, orders) > 0]
+        keys = keys[:composite.get('size', 10)]
+        buckets = [{'key': dict(zip(names, key)), 'doc_count': counts[key]} for key in keys]
+        result = {'buckets': _apply_sub_aggs(agg, buckets)}
+        if keys:
+            result['after_key'] = dict(zip(names, keys[-1]))
+        return result
+
+    if 'terms' in agg:
+        terms = agg['terms']
+        field = _field(terms['field'])
+        counts = {}
+        for doc in docs:
+            counts[doc[field]] = counts.get(doc[field], 0) + 1
+        keys = sorted(counts, key=lambda key: (-counts[key], key))
+        keys = [key for key in keys if counts[key] >= terms.get('min_doc_count', 1)]
+        buckets = [{'key': key, 'doc_count': counts[key]}
+                   for key in keys[:terms.get('size', 10)]]
+        return {'buckets': _apply_sub_aggs(agg, buckets)}
+
+    if 'histogram' in agg:
+        histogram = agg['histogram']
+        field = _field(histogram['field'])
+        interval = histogram['interval']
+        counts = {}
+        for doc in docs:
+            key = doc[field] // interval * interval
+            counts[key] = counts.get(key, 0) + 1
+        keys = sorted(counts)
+        if keys and histogram.get('min_doc_count', 0) == 0:
+            keys = list(range(keys[0], keys[-1] + interval, interval))
+        buckets = [{'key': key, 'doc_count': counts.get(key, 0)} for key in keys
+                   if counts.get(key, 0) >= histogram.get('min_doc_count', 0)]
+        return {'buckets': _apply_sub_aggs(agg, buckets)}
+
+    raise UnsupportedQuery("aggs:" + ",".join(agg))
+
+
+def _source(doc, source):
+    if source is None or source is True:
+        return dict(doc)
+    if source is False:
+        return {}
+    if isinstance(source, dict):
+        source = source.get('includes', [])
+    return {field: doc[field] for field in source if field in doc}
+
+
+class FakeSearch:
+    """合成コメントに応答する代替ES(FakeTransport.handler 用)
+
+    インデックス名は区別しない。calls に呼び出し回数を数える。
+    """
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._pits = 0
+
+    def __call__(self, method, url, params, body):
+        with self._lock:
+            self.calls += 1
+        started = time.perf_counter()
+        path = url.split('?')[0]
+        if path.endswith('/_pit'):
+            if method == 'DELETE':
+                return {'succeeded': True, 'num_freed': 1}
+            with self._lock:
+                self._pits += 1
+                return {'id': "pit" + str(self._pits)}
+        if not path.endswith('/_search'):
+            raise UnsupportedQuery(method + " " + url)
+        result = self.search(body or {})
+        result['took'] = int((time.perf_counter() - started) * 1000)
+        if body and 'pit' in body:
+            result['pit_id'] = body['pit']['id']
+        return result
+
+    def search(self, body):
+        match = compile_query(body.get('query'))
+        docs = [doc for doc in self.docs if match(doc)]
+        result = {'timed_out': False, 'hits': {'hits': []}}
+
+        aggs = body.get('aggs') or body.get('aggregations')
+        if aggs:
+            result['aggregations'] = {name: aggregate(agg, docs) for name, agg in aggs.items()}
+
+        if 'post_filter' in body:
+            post_filter = compile_query(body['post_filter'])
+            docs = [doc for doc in docs if post_filter(doc)]
+        if body.get('track_total_hits', True) is not False:
+            result['hits']['total'] = {'value': len(docs), 'relation': 'eq'}
+
+        size = body.get('size', 10)
+        if size:
+            fields, orders = _sort_spec(body.get('sort') or [])
+            if fields:
+                docs = _sorted(docs, lambda doc: [doc[field] for field in fields], orders)
+            if 'search_after' in body:
+                after = body['search_after']
+                docs = [doc for doc in docs
+                        if _compare([doc[field] for field in fields], after, orders) > 0]
+            start = body.get('from', 0)
+            for doc in docs[start:start + size]:
+                result['hits']['hits'].append({
+                    '_id': str(doc['id']),
+                    '_source': _source(doc, body.get('_source')),
+                    'sort': [doc[field] for field in fields],
+                })
+        return result
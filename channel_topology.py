@@ -0,0 +1,113 @@
+"""
+チャンネル・グループ構成のプロセス内キャッシュ
+
+検索画面の選択肢作成とグループ→チャンネル展開を辞書参照で行う。
+構成のバージョンを共有キャッシュに持ち、channel_edit/channel_del で
+invalidate() すると各プロセスが次のアクセス時に読み直す。
+"""
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+from comment.models import Channel, ChannelGroup
+
+CHANNEL_TOPOLOGY_CACHE_ALIAS = getattr(
+    settings, 'CHANNEL_TOPOLOGY_CACHE_ALIAS', 'default')
+# 管理画面など invalidate() を通らない変更を拾うための再読込間隔(秒)
+CHANNEL_TOPOLOGY_MAX_AGE = getattr(settings, 'CHANNEL_TOPOLOGY_MAX_AGE', 600)
+
+VERSION_KEY = "channel_topology:version"
+
+
+class Topology:
+    def __init__(self, version):
+        self.version = version
+        self.loaded = time.monotonic()
+
+        group_list = list(ChannelGroup.objects.all().values_list(
+            'id', 'groupName', 'no').order_by('no'))
+        channel_list = list(Channel.objects.all().values_list(
+            'id', 'channelName', 'group_id', 'enable').order_by('no'))
+
+        # グループID→所属チャンネルID(無効チャンネルも含む)
+        self.group_channels = {}
+        for channel_id, _, group_id, _ in channel_list:
+            self.group_channels.setdefault(group_id, []).append(channel_id)
+
+        # 検索画面の選択肢(my用は全グループ、通常はno>0のグループ)
+        self.channel_choice = {
+            True: self._make_choice(group_list, channel_list, True),
+            False: self._make_choice(group_list, channel_list, False),
+        }
+
+    @staticmethod
+    def _make_choice(group_list, channel_list, my_flag):
+        groups = [(group_id, groupName) for group_id, groupName, no in group_list
+                  if my_flag or no > 0]
+        group_channel_choice = {}
+        for channel_id, channelName, group_id, enable in channel_list:
+            if enable:
+                group_channel_choice.setdefault(
+                    group_id, []).append((channel_id, channelName))
+
+        channel_choice = [('グループ', tuple(groups))]
+        for group_id, groupName in groups:
+            channel_choice.append(
+                (groupName, tuple(group_channel_choice.get(group_id, []))))
+        return tuple(channel_choice)
+
+    def expand(self, channelList):
+        """グループIDを所属チャンネルIDに展開する"""
+        tmp_channel_list = []
+        for channel in channelList:
+            try:
+                group_id = int(channel)
+            except ValueError:
+                if channel not in tmp_channel_list:
+                    tmp_channel_list.append(channel)
+                continue
+            for channel_id in self.group_channels.get(group_id, []):
+                if channel_id not in tmp_channel_list:
+                    tmp_channel_list.append(channel_id)
+        return tuple(tmp_channel_list)
+
+
+_topology = None
+_lock = threading.Lock()
+
+
+def _current_version():
+    cache = caches[CHANNEL_TOPOLOGY_CACHE_ALIAS]
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(VERSION_KEY, version, None):
+            version = cache.get(VERSION_KEY, version)
+    return version
+
+
+def get_topology():
+    """最新バージョンの構成を返す(変更がなければDBアクセスなし)"""
+    global _topology
+    version = _current_version()
+    topology = _topology
+    if topology is None or topology.version != version or \
+            time.monotonic() - topology.loaded > CHANNEL_TOPOLOGY_MAX_AGE:
+        with _lock:
+            topology = _topology
+            if topology is None or topology.version != version or \
+                    time.monotonic() - topology.loaded > CHANNEL_TOPOLOGY_MAX_AGE:
+                topology = Topology(version)
+                _topology = topology
+    return topology
+
+
+def invalidate():
+    """構成の変更を全プロセスに通知する"""
+    global _topology
+    caches[CHANNEL_TOPOLOGY_CACHE_ALIAS].set(
+        VERSION_KEY, uuid.uuid4().hex, None)
+    _topology = None
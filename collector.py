@@ -0,0 +1,240 @@
+"""
+チャンネルの動画一覧の収集
+
+再生リストの動画IDとDB上の動画IDを一括で突き合わせ、新規の動画だけ
+詳細を取得して登録する。既存の動画は50件ずつ videos.list で取得し、
+公開状態かスニペットの内容(タイトル・配信予定時刻・配信かどうか)が
+DBと異なるものだけ check_video() で更新する。
+複数チャンネルは上限付きのワーカーで並行して処理し、YouTube APIの
+呼び出しはプロセス全体で秒間回数を制限する。
+"""
+import logging
+import threading
+import time
+from concurrent import futures
+from datetime import datetime, timezone, timedelta
+from urllib.parse import unquote
+
+import emoji
+from django.conf import settings
+from django.db import connection
+
+import comment.video_availability as video_availability
+import comment.youtube as yt
+from comment.models import Video
+from comment.utils import check_video
+
+logger = logging.getLogger(__name__)
+
+# 並行して処理するチャンネル数
+COLLECTOR_WORKERS = getattr(settings, 'COLLECTOR_WORKERS', 4)
+# YouTube APIの秒間呼び出し回数の上限
+COLLECTOR_API_RATE = getattr(settings, 'COLLECTOR_API_RATE', 5)
+# videos.list 1回で指定できる動画ID数
+VIDEO_BATCH_SIZE = 50
+# DB照会1回あたりの動画ID数
+DB_BATCH_SIZE = 1000
+
+executor = futures.ThreadPoolExecutor(
+    max_workers=COLLECTOR_WORKERS, thread_name_prefix='collector')
+
+
+class RateLimiter:
+    """秒間 rate 回までに呼び出しを制限する(トークンバケット)"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._tokens = rate
+        self._updated = time.monotonic()
+
+    def wait(self):
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens +
+                                   (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+api_limiter = RateLimiter(COLLECTOR_API_RATE)
+
+
+def _chunks(id_list, size):
+    for i in range(0, len(id_list), size):
+        yield id_list[i:i + size]
+
+
+def snippet_list(video_id_list):
+    """動画詳細の取得(50件ずつ、呼び出し回数制限付き) [[動画ID, item], ...]"""
+    infos = []
+    for chunk in _chunks(list(video_id_list), VIDEO_BATCH_SIZE):
+        api_limiter.wait()
+        infos.extend(yt.get_video_snippet_list(chunk))
+    return infos
+
+
+def existing_ids(video_id_list):
+    """DBに登録済みの動画IDの集合"""
+    existing = set()
+    for chunk in _chunks(list(video_id_list), DB_BATCH_SIZE):
+        existing.update(Video.objects.filter(
+            id__in=chunk).values_list('id', flat=True))
+    return existing
+
+
+def _time_text(value):
+    """配信予定時刻の比較用の文字列(APIの形式に揃える)"""
+    if isinstance(value, datetime):
+        return value.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    return value or None
+
+
+def snippet_changed(video, item):
+    """動画詳細の内容が登録済みの動画と異なるか
+
+    make_video() が動画詳細から設定する項目(タイトル・配信予定時刻・
+    配信かどうか)を比較する。
+    """
+    if unquote(emoji.demojize(item['snippet']['title'])) != video.title:
+        return True
+    details = item.get('liveStreamingDetails')
+    if details is None:
+        return bool(video.enable)
+    return _time_text(details.get('scheduledStartTime')) != _time_text(video.scheduledStartTime)
+
+
+def recheck_videos(video_id_list):
+    """既存動画を一括で確認し、変わったものを check_video() で更新する
+
+    videos.list で取得できなくなった(非公開・削除)か再び取得できるようになった
+    動画と、動画詳細の内容が変わった動画が対象。変更のあった件数を返す。
+    変更のあった動画は表示用の確認結果(video_availability)のキャッシュも消す。
+    """
+    changed = 0
+    for chunk in _chunks(list(video_id_list), VIDEO_BATCH_SIZE):
+        api_limiter.wait()
+        items = dict((video_id, item) for video_id,
+                     item in yt.get_video_snippet_list(chunk))
+        changed_ids = []
+        for video in Video.objects.filter(id__in=chunk):
+            item = items.get(video.id)
+            if (item is not None) != bool(video.public) or (
+                    item is not None and snippet_changed(video, item)):
+                check_video(video)
+                changed_ids.append(video.id)
+        if changed_ids:
+            video_availability.invalidate(changed_ids)
+            changed += len(changed_ids)
+    return changed
+
+
+def make_video(channel, video_id, item):
+    """動画詳細から登録用の Video を作成"""
+    title = item['snippet']['title']
+    publishedAt = item['snippet']['publishedAt']
+
+    video = Video()
+    video.channel = channel
+    video.id = video_id
+    video.title = unquote(emoji.demojize(title))
+    video.description = ""
+    video.publishedAt = datetime.strptime(publishedAt, '%Y-%m-%dT%H:%M:%SZ').replace(
+        tzinfo=timezone(timedelta(hours=+9)))
+    video.enable = True
+    video.public = True
+    video.collecting_flag = True
+
+    if 'liveStreamingDetails' in item:
+        if 'scheduledStartTime' in item['liveStreamingDetails']:
+            video.scheduledStartTime = item['liveStreamingDetails']['scheduledStartTime']
+    else:
+        logger.info("非配信:" + video.id)
+        video.enable = False
+    return video
+
+
+def collect_channel(channel, new_flag=True, db_only_flag=False):
+    """1チャンネルの動画一覧を収集し、件数と処理時間(秒)を返す"""
+    result = {
+        'channel_id': channel.id,
+        'playlist': 0,
+        'new': 0,
+        'rechecked': 0,
+        'changed': 0,
+        'timings': {},
+        'error': None,
+    }
+    timings = result['timings']
+    started = time.monotonic()
+    try:
+        if not (db_only_flag):
+            # 動画一覧情報
+            api_limiter.wait()
+            etag, infos = yt.get_video_id_list_by_playlist_id(
+                channel.id, not (new_flag), channel.etag)
+            channel.etag = etag
+            channel.save(update_fields=['etag'])
+            playlist = list(dict.fromkeys(infos))
+            result['playlist'] = len(playlist)
+            timings['playlist'] = time.monotonic() - started
+
+            mark = time.monotonic()
+            existing = existing_ids(playlist)
+            new_id_list = [
+                video_id for video_id in playlist if video_id not in existing]
+            timings['diff'] = time.monotonic() - mark
+
+            mark = time.monotonic()
+            result['rechecked'] = len(existing)
+            result['changed'] = recheck_videos(
+                [video_id for video_id in playlist if video_id in existing])
+            timings['recheck'] = time.monotonic() - mark
+
+            mark = time.monotonic()
+            db_new_video_list = [make_video(channel, video_id, item)
+                                 for video_id, item in snippet_list(new_id_list)]
+            Video.objects.bulk_create(
+                db_new_video_list, ignore_conflicts=True)
+            result['new'] = len(db_new_video_list)
+            timings['insert'] = time.monotonic() - mark
+    except Exception as e:
+        result['error'] = repr(e)
+        logger.info("想定外エラー:" + channel.id, exc_info=True)
+    timings['total'] = time.monotonic() - started
+    logger.info("collet_videolist完了：" + channel.id + " " + format_result(result))
+    return result
+
+
+def format_result(result):
+    text = "動画" + str(result['playlist']) + "件,新規" + str(result['new']) + \
+        "件,再確認" + str(result['rechecked']) + "件,変更" + str(result['changed']) + "件"
+    for key, value in result['timings'].items():
+        text += "," + key + "=" + "%.2f" % value + "秒"
+    return text
+
+
+def _collect_in_worker(channel, new_flag, db_only_flag):
+    try:
+        return collect_channel(channel, new_flag, db_only_flag)
+    finally:
+        connection.close()
+
+
+def submit(channel, new_flag=True, db_only_flag=False):
+    """1チャンネルの収集をワーカーで開始する(Future を返す)"""
+    return executor.submit(_collect_in_worker, channel, new_flag, db_only_flag)
+
+
+def collect_channels(channels, new_flag=True, db_only_flag=False):
+    """複数チャンネルを並行して収集し、チャンネルごとの結果のリストを返す"""
+    future_list = [submit(channel, new_flag, db_only_flag)
+                   for channel in channels]
+    return [future.result() for future in future_list]
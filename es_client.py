@@ -0,0 +1,408 @@
+"""
+Elasticsearch接続の共有管理
+
+プロセス内で1つのクライアント(keep-aliveのコネクションプール)を使い回す。
+ビューは get_client() / search() 経由でESにアクセスし、ループ毎に
+クライアントを生成しないこと。
+非同期ビュー用に AsyncElasticsearch 版(get_async_client() / async_search())も持つ。
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+import weakref
+
+import elasticsearch
+from django.conf import settings
+
+import comment.request_metrics as request_metrics
+from vtuber.settings import ES_HOST
+
+logger = logging.getLogger(__name__)
+
+ES_URL = "http://" + ES_HOST + ":9200"
+
+# ホストごとのコネクションプール上限
+ES_POOL_MAXSIZE = getattr(settings, 'ES_POOL_MAXSIZE', 25)
+# 1リクエストあたりの既定タイムアウト(秒)
+ES_TIMEOUT = getattr(settings, 'ES_TIMEOUT', 60)
+# 再試行回数と初回待機時間(秒)。待機は指数的に伸ばす
+ES_RETRY_MAX = getattr(settings, 'ES_RETRY_MAX', 3)
+ES_RETRY_BACKOFF = getattr(settings, 'ES_RETRY_BACKOFF', 0.5)
+ES_RETRY_BACKOFF_MAX = 8
+# プロセス全体で同時に実行するES呼び出しの上限(超えた分は空きを待つ)
+ES_MAX_IN_FLIGHT = getattr(settings, 'ES_MAX_IN_FLIGHT', ES_POOL_MAXSIZE)
+
+# 再試行対象のHTTPステータス(競合・過負荷・一時的なゲートウェイエラー)
+RETRY_STATUS = (409, 429, 502, 503, 504)
+
+_client = None
+_client_lock = threading.Lock()
+_transport_class = elasticsearch.Transport
+
+_in_flight_slots = threading.BoundedSemaphore(ES_MAX_IN_FLIGHT)
+
+_metrics_lock = threading.Lock()
+_metrics = {
+    'requests': 0,
+    'retries': 0,
+    'errors': 0,
+    'in_flight': 0,
+}
+
+
+def get_client():
+    """共有クライアントの取得(初回のみ生成)"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = elasticsearch.Elasticsearch(
+                    ES_URL,
+                    timeout=ES_TIMEOUT,
+                    maxsize=ES_POOL_MAXSIZE,
+                    http_compress=True,
+                    # 再試行は call() 側でバックオフ付きで行う
+                    max_retries=0,
+                    retry_on_timeout=False,
+                    transport_class=_transport_class)
+    return _client
+
+
+def reset_client():
+    """共有クライアントの破棄(設定変更時・テスト用)"""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            try:
+                _client.transport.close()
+            except Exception:
+                logger.info("ESクライアント破棄失敗", exc_info=True)
+        _client = None
+
+
+def get_transport_class():
+    """現在のトランスポート(set_transport_class() で戻すため)"""
+    return _transport_class
+
+
+def set_transport_class(transport_class):
+    """トランスポートの差し替え(FakeTransport 等)。次回 get_client() から有効"""
+    global _transport_class
+    _transport_class = transport_class
+    reset_client()
+
+
+def _is_retryable(e):
+    # タイムアウトは重い検索のため再試行しない(呼び出し元でメッセージ表示)
+    if isinstance(e, elasticsearch.ConnectionTimeout):
+        return False
+    if isinstance(e, elasticsearch.ConnectionError):
+        return True
+    if isinstance(e, elasticsearch.TransportError):
+        return e.status_code in RETRY_STATUS
+    return False
+
+
+def _backoff(attempt):
+    wait = min(ES_RETRY_BACKOFF * (2 ** attempt), ES_RETRY_BACKOFF_MAX)
+    # 同時再試行の集中を避けるため揺らぎを入れる
+    return wait / 2 + random.uniform(0, wait / 2)
+
+
+def _count(key, value=1):
+    with _metrics_lock:
+        _metrics[key] += value
+
+
+def _record(started, result):
+    """実行中のリクエストにES呼び出し1回分の時間(通信込み)と took を記録"""
+    request_metrics.add('es', time.perf_counter() - started)
+    if isinstance(result, dict) and 'took' in result:
+        request_metrics.add('es_took', result['took'] / 1000)
+
+
+def call(method_name, *args, timeout=None, **kwargs):
+    """共有クライアントのAPIを再試行付きで呼び出す
+
+    timeout はこの呼び出しのみのタイムアウト(秒)。
+    method_name は 'indices.create' のように名前空間付きでもよい。
+    """
+    es = get_client()
+    method = es
+    for name in method_name.split('.'):
+        method = getattr(method, name)
+    kwargs['request_timeout'] = timeout if timeout else ES_TIMEOUT
+    attempt = 0
+    _count('in_flight')
+    try:
+        while True:
+            _count('requests')
+            try:
+                with _in_flight_slots:
+                    started = time.perf_counter()
+                    result = None
+                    try:
+                        result = method(*args, **kwargs)
+                    finally:
+                        _record(started, result)
+                    return result
+            except elasticsearch.TransportError as e:
+                if attempt >= ES_RETRY_MAX or not _is_retryable(e):
+                    _count('errors')
+                    raise
+                wait = _backoff(attempt)
+                attempt += 1
+                _count('retries')
+                logger.info("ES再試行(" + str(attempt) + "回目," +
+                            str(e.status_code) + "):" + method_name)
+                time.sleep(wait)
+    finally:
+        _count('in_flight', -1)
+
+
+def search(index, body, timeout=None, **kwargs):
+    """検索(共有クライアント・再試行付き)"""
+    return call('search', index=index, body=body, timeout=timeout, **kwargs)
+
+
+def pool_stats():
+    """コネクションプールと呼び出し回数の統計"""
+    with _metrics_lock:
+        stats = dict(_metrics)
+    stats['pool_maxsize'] = ES_POOL_MAXSIZE
+    stats['max_in_flight'] = ES_MAX_IN_FLIGHT
+    stats['pool_connections'] = 0
+    stats['pool_idle'] = 0
+    if _client is not None:
+        for connection in _client.transport.connection_pool.connections:
+            pool = getattr(connection, 'pool', None)
+            if pool is None:
+                continue
+            # urllib3 のプール: 生成済み接続数とプール内の待機接続数
+            stats['pool_connections'] += pool.num_connections
+            if pool.pool is not None:
+                stats['pool_idle'] += sum(
+                    1 for conn in list(pool.pool.queue) if conn is not None)
+    return stats
+
+
+class FakeTransport(elasticsearch.Transport):
+    """ESクラスタなしで共有クライアントを動かすための代替トランスポート
+
+    handler(method, url, params, body) を設定すると応答をその戻り値にする。
+    未設定時は0件の検索結果を返す。呼び出し内容は calls に記録される。
+    delay(秒)を設定すると応答前に待機し、ESの処理時間を模擬する。
+    """
+    handler = None
+    delay = 0
+
+    def __init__(self, hosts, *args, **kwargs):
+        super().__init__(hosts, *args, **kwargs)
+        self.calls = []
+
+    def perform_request(self, method, url, headers=None, params=None, body=None):
+        self.calls.append((method, url, params, body))
+        if type(self).delay:
+            time.sleep(type(self).delay)
+        handler = type(self).handler
+        if handler is None:
+            return empty_result()
+        return handler(method, url, params, body)
+
+
+def empty_result():
+    return {
+        'took': 0,
+        'timed_out': False,
+        'hits': {'total': {'value': 0, 'relation': 'eq'}, 'hits': []},
+        'aggregations': {'group_by_video_id': {'buckets': []}},
+    }
+
+
+def search_after_scan(index, body, size=1000, sort=None, keep_alive='1m', timeout=None):
+    """point-in-time + search_after によるヒットの逐次取得(ジェネレータ)
+
+    from/size と違い深いページでも1ページあたりのコストが一定で、
+    index.max_result_window の上限も受けない。
+    sort には一意になるよう tiebreaker を含めること。
+    """
+    body = dict(body)
+    body.pop('from', None)
+    body['size'] = size
+    if sort:
+        body['sort'] = sort
+    # 件数は不要なため総数の集計を省略
+    body['track_total_hits'] = False
+
+    pit_id = None
+    try:
+        pit_id = call('open_point_in_time', index=index,
+                      keep_alive=keep_alive, timeout=timeout)['id']
+    except elasticsearch.TransportError:
+        # PIT未対応のクラスタではインデックスへの search_after で代替
+        logger.info("PIT取得不可:" + str(index), exc_info=True)
+
+    try:
+        while True:
+            if pit_id:
+                body['pit'] = {'id': pit_id, 'keep_alive': keep_alive}
+                result = call('search', body=body, timeout=timeout)
+                # PIT idは応答ごとに更新されうる
+                pit_id = result.get('pit_id', pit_id)
+            else:
+                result = search(index, body, timeout=timeout)
+            hits = result['hits']['hits']
+            for hit in hits:
+                yield hit
+            if len(hits) < size:
+                break
+            body['search_after'] = hits[-1]['sort']
+    finally:
+        if pit_id:
+            try:
+                call('close_point_in_time', body={'id': pit_id})
+            except elasticsearch.TransportError:
+                logger.info("PIT解放失敗", exc_info=True)
+
+
+# ---- 非同期(ASGI)用 ----
+
+_async_clients = weakref.WeakKeyDictionary()
+_async_slots = weakref.WeakKeyDictionary()
+_async_transport_class = None
+
+
+def get_async_client():
+    """実行中のイベントループ用の共有 AsyncElasticsearch を取得"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        transport_class = _async_transport_class or elasticsearch.AsyncTransport
+        client = elasticsearch.AsyncElasticsearch(
+            ES_URL,
+            timeout=ES_TIMEOUT,
+            maxsize=ES_POOL_MAXSIZE,
+            http_compress=True,
+            max_retries=0,
+            retry_on_timeout=False,
+            transport_class=transport_class)
+        _async_clients[loop] = client
+        _async_slots[loop] = asyncio.Semaphore(ES_MAX_IN_FLIGHT)
+    return client
+
+
+def get_async_transport_class():
+    """現在の非同期トランスポート(None は既定の AsyncTransport)"""
+    return _async_transport_class
+
+
+def set_async_transport_class(transport_class):
+    """非同期トランスポートの差し替え(FakeAsyncTransport 等)"""
+    global _async_transport_class
+    _async_transport_class = transport_class
+    _async_clients.clear()
+    _async_slots.clear()
+
+
+async def async_call(method_name, *args, timeout=None, **kwargs):
+    """call() の非同期版"""
+    es = get_async_client()
+    slots = _async_slots[asyncio.get_running_loop()]
+    method = es
+    for name in method_name.split('.'):
+        method = getattr(method, name)
+    kwargs['request_timeout'] = timeout if timeout else ES_TIMEOUT
+    attempt = 0
+    _count('in_flight')
+    try:
+        while True:
+            _count('requests')
+            try:
+                async with slots:
+                    started = time.perf_counter()
+                    result = None
+                    try:
+                        result = await method(*args, **kwargs)
+                    finally:
+                        _record(started, result)
+                    return result
+            except elasticsearch.TransportError as e:
+                if attempt >= ES_RETRY_MAX or not _is_retryable(e):
+                    _count('errors')
+                    raise
+                wait = _backoff(attempt)
+                attempt += 1
+                _count('retries')
+                logger.info("ES再試行(" + str(attempt) + "回目," +
+                            str(e.status_code) + "):" + method_name)
+                await asyncio.sleep(wait)
+    finally:
+        _count('in_flight', -1)
+
+
+async def async_search(index, body, timeout=None, **kwargs):
+    """search() の非同期版"""
+    return await async_call('search', index=index, body=body, timeout=timeout, **kwargs)
+
+
+async def async_search_after_scan(index, body, size=1000, sort=None, keep_alive='1m', timeout=None):
+    """search_after_scan() の非同期版(非同期ジェネレータ)"""
+    body = dict(body)
+    body.pop('from', None)
+    body['size'] = size
+    if sort:
+        body['sort'] = sort
+    body['track_total_hits'] = False
+
+    pit_id = None
+    try:
+        pit_id = (await async_call('open_point_in_time', index=index,
+                                   keep_alive=keep_alive, timeout=timeout))['id']
+    except elasticsearch.TransportError:
+        logger.info("PIT取得不可:" + str(index), exc_info=True)
+
+    try:
+        while True:
+            if pit_id:
+                body['pit'] = {'id': pit_id, 'keep_alive': keep_alive}
+                result = await async_call('search', body=body, timeout=timeout)
+                pit_id = result.get('pit_id', pit_id)
+            else:
+                result = await async_search(index, body, timeout=timeout)
+            hits = result['hits']['hits']
+            for hit in hits:
+                yield hit
+            if len(hits) < size:
+                break
+            body['search_after'] = hits[-1]['sort']
+    finally:
+        if pit_id:
+            try:
+                await async_call('close_point_in_time', body={'id': pit_id})
+            except elasticsearch.TransportError:
+                logger.info("PIT解放失敗", exc_info=True)
+
+
+class FakeAsyncTransport(elasticsearch.AsyncTransport):
+    """FakeTransport の非同期版
+
+    handler は FakeTransport と同じ形式。delay(秒)を設定すると
+    応答前に待機し、ESの処理時間を模擬する。
+    """
+    handler = None
+    delay = 0
+
+    def __init__(self, hosts, *args, **kwargs):
+        super().__init__(hosts, *args, **kwargs)
+        self.calls = []
+
+    async def perform_request(self, method, url, headers=None, params=None, body=None):
+        self.calls.append((method, url, params, body))
+        if type(self).delay:
+            await asyncio.sleep(type(self).delay)
+        handler = type(self).handler
+        if handler is None:
+            return empty_result()
+        return handler(method, url, params, body)
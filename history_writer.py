@@ -0,0 +1,163 @@
+"""
+検索履歴(SearchHistory)のまとめ書き
+
+検索リクエストでは履歴をキューに積むだけにして、バックグラウンドの
+スレッドが件数または経過時間でまとめて bulk_create する。
+書き込んだ分は同じスレッドで search_ranking の集計にも反映する。
+キューが一杯のときは破棄して件数を数える(検索は止めない)。
+プロセス終了時には残りを書き込む。
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+import comment.search_ranking as search_ranking
+from comment.models import SearchHistory
+
+logger = logging.getLogger(__name__)
+
+# 1回にまとめて書き込む件数
+SEARCH_HISTORY_BATCH_SIZE = getattr(settings, 'SEARCH_HISTORY_BATCH_SIZE', 100)
+# 件数に満たなくても書き込むまでの時間(秒)
+SEARCH_HISTORY_FLUSH_INTERVAL = getattr(settings, 'SEARCH_HISTORY_FLUSH_INTERVAL', 2)
+# 書き込み待ちの上限件数
+SEARCH_HISTORY_QUEUE_MAX = getattr(settings, 'SEARCH_HISTORY_QUEUE_MAX', 10000)
+# 終了時の書き込み待ち(秒)
+SEARCH_HISTORY_SHUTDOWN_TIMEOUT = getattr(settings, 'SEARCH_HISTORY_SHUTDOWN_TIMEOUT', 10)
+
+_queue = queue.Queue(maxsize=SEARCH_HISTORY_QUEUE_MAX)
+_stop = threading.Event()
+_thread = None
+_thread_lock = threading.Lock()
+# 書き込み処理の排他(flush() と書き込みスレッド)
+_write_lock = threading.Lock()
+
+_stats_lock = threading.Lock()
+_stats = {
+    'written': 0,
+    'dropped': 0,
+    'errors': 0,
+    'batches': 0,
+}
+
+
+def _count(key, value=1):
+    with _stats_lock:
+        _stats[key] += value
+
+
+def _start():
+    global _thread
+    if _thread is None or not _thread.is_alive():
+        with _thread_lock:
+            if _thread is None or not _thread.is_alive():
+                _stop.clear()
+                _thread = threading.Thread(
+                    target=_run, name='search_history_writer', daemon=True)
+                _thread.start()
+
+
+def add(history):
+    """保存前の SearchHistory を書き込み待ちに追加"""
+    if _stop.is_set():
+        # 終了処理中は直接保存
+        _write([history], from_queue=False)
+        return
+    _start()
+    try:
+        _queue.put_nowait(history)
+    except queue.Full:
+        _count('dropped')
+        logger.info("検索履歴破棄(書き込み待ち超過):" + str(history.keyword))
+
+
+def _take(batch, timeout):
+    try:
+        batch.append(_queue.get(timeout=timeout))
+    except queue.Empty:
+        return False
+    return True
+
+
+def _drain(limit):
+    batch = []
+    while len(batch) < limit and _take(batch, 0):
+        pass
+    return batch
+
+
+def _write(batch, from_queue=True):
+    if not batch:
+        return
+    with _write_lock:
+        close_old_connections()
+        try:
+            SearchHistory.objects.bulk_create(batch)
+            _count('written', len(batch))
+            _count('batches')
+        except Exception:
+            _count('errors')
+            _count('dropped', len(batch))
+            logger.error("検索履歴書き込みエラー:" + str(len(batch)) + "件", exc_info=True)
+        else:
+            try:
+                search_ranking.record_many(batch)
+            except Exception:
+                logger.error("検索ランキング集計エラー:" + str(len(batch)) + "件", exc_info=True)
+        finally:
+            if from_queue:
+                for _ in batch:
+                    _queue.task_done()
+
+
+def _run():
+    try:
+        while not _stop.is_set():
+            batch = []
+            deadline = time.monotonic() + SEARCH_HISTORY_FLUSH_INTERVAL
+            while len(batch) < SEARCH_HISTORY_BATCH_SIZE and not _stop.is_set():
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    break
+                _take(batch, min(wait, 0.5))
+            _write(batch)
+    finally:
+        connection.close()
+
+
+def flush(wait=True):
+    """書き込み待ちをすべて書き込む
+
+    wait が真なら書き込みスレッドが取り出し済みの分の完了も待つ。
+    """
+    while True:
+        batch = _drain(SEARCH_HISTORY_BATCH_SIZE)
+        if not batch:
+            break
+        _write(batch)
+    if wait:
+        _queue.join()
+
+
+def shutdown(timeout=SEARCH_HISTORY_SHUTDOWN_TIMEOUT):
+    """書き込みスレッドを止め、残りを書き込む"""
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout)
+    # 書き込みスレッドが止まらない場合はその分を待たない
+    flush(wait=_thread is None or not _thread.is_alive())
+
+
+def stats():
+    with _stats_lock:
+        result = dict(_stats)
+    result['queued'] = _queue.qsize()
+    return result
+
+
+atexit.register(shutdown)
@@ -0,0 +1,272 @@
+"""
+コメントインデックスの版管理と別名(alias)の切り替え
+
+ビューが参照するインデックス名(commentall / commentrecent / mycomment /
+mycommentall / comment_YYYY_Nh)は読み取り用の別名とし、実体は <別名>_v<版> の版付き
+インデックスにする。版付きインデックスは settings.txt / mapping.txt
+(GET _settings / _mapping の出力)の TEMPLATE_SOURCE の定義を元に、
+シャード数・レプリカ数だけを別名ごとに指定して作成する。
+作成後は _reindex(スライス並列・秒間件数の制限付き)で現在の実体から複写する。
+複写元の版番号を引き継ぐ(version_type: external)ため、複写元への書き込みを
+止めてからもう一度全体を複写すると、複写中に追加・更新された分だけが書き込まれ、
+件数が一致する。その後、別名を1回の _aliases で切り替える。
+別名と同名の実体インデックスがある場合(初回)は、実体を <別名>_v0 に複製
+(_clone)してから実体を削除して別名に置き換える。元のデータは _v0 として残り、
+削除は確認後に別の操作で行う。
+"""
+import json
+import logging
+import os
+import re
+import time
+
+import elasticsearch
+from django.conf import settings
+
+import comment.es_client as es_client
+import comment.index_router as index_router
+from .utils import commentall_index, mycomment_index, mycommentall_index
+
+logger = logging.getLogger(__name__)
+
+DEFINITION_DIR = os.path.dirname(os.path.abspath(__file__))
+# 版付きインデックスの定義(解析器・マッピング)の元にするインデックス
+TEMPLATE_SOURCE = getattr(settings, 'ES_INDEX_TEMPLATE_SOURCE', "commentall")
+
+# 別名ごとのシャード数(未指定は1)。ES_INDEX_SHARDS で上書きする
+INDEX_SHARDS = {
+    commentall_index: 10,
+    index_router.commentrecent_index: 10,
+    mycomment_index: 3,
+    mycommentall_index: 3,
+}
+INDEX_SHARDS.update(getattr(settings, 'ES_INDEX_SHARDS', {}))
+INDEX_REPLICAS = getattr(settings, 'ES_INDEX_REPLICAS', 1)
+
+# 複写の既定値(スライス数、秒間件数の上限、1回の取得件数)
+REINDEX_SLICES = getattr(settings, 'ES_REINDEX_SLICES', 'auto')
+REINDEX_REQUESTS_PER_SECOND = getattr(settings, 'ES_REINDEX_REQUESTS_PER_SECOND', 5000)
+REINDEX_BATCH_SIZE = getattr(settings, 'ES_REINDEX_BATCH_SIZE', 1000)
+TASK_POLL_INTERVAL = 5
+# 別名と同名の実体インデックスの複製に使う版
+BACKUP_VERSION = 0
+
+VERSION_RE = re.compile(r'_v(\d+)$')
+
+
+def alias_names():
+    """版管理の対象の別名の一覧
+
+    半期インデックスは index_router.PARTITION_INDICES の実在するものだけ。
+    綴り違いの cooment_2021_1h はマッピングが空でビューからも参照されないため対象外
+    (2021年上期は comment_2021_1h)。
+    """
+    names = [commentall_index, index_router.commentrecent_index,
+             mycomment_index, mycommentall_index]
+    return names + index_router.partition_names()
+
+
+def _load(filename):
+    with open(os.path.join(DEFINITION_DIR, filename), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def template(alias, shards=None, replicas=None):
+    """版付きインデックスの作成内容(settings / mappings)"""
+    source_settings = _load('settings.txt')[TEMPLATE_SOURCE]['settings']['index']
+    mappings = _load('mapping.txt')[TEMPLATE_SOURCE]['mappings']
+    return {
+        'settings': {
+            'index': {
+                'number_of_shards': shards or INDEX_SHARDS.get(alias, 1),
+                'number_of_replicas': INDEX_REPLICAS if replicas is None else replicas,
+                'analysis': source_settings['analysis'],
+            }
+        },
+        'mappings': mappings,
+    }
+
+
+def versioned_name(alias, version):
+    return alias + "_v" + str(version)
+
+
+def versions(alias):
+    """作成済みの版付きインデックス [(版, 名前), ...](版の昇順)"""
+    indices = es_client.call('indices.get', index=versioned_name(alias, "*"),
+                             allow_no_indices=True, expand_wildcards='open,closed')
+    result = []
+    for name in indices:
+        match = VERSION_RE.search(name)
+        if match and name == versioned_name(alias, match.group(1)):
+            result.append((int(match.group(1)), name))
+    return sorted(result)
+
+
+def is_concrete(alias):
+    """別名と同名の実体インデックスがあるか(版管理への移行前)"""
+    return (es_client.call('indices.exists', index=alias) and
+            not es_client.call('indices.exists_alias', name=alias))
+
+
+def alias_targets(alias):
+    """別名の現在の実体。移行前は同名の実体インデックス"""
+    if is_concrete(alias):
+        return [alias]
+    try:
+        return sorted(es_client.call('indices.get_alias', name=alias))
+    except elasticsearch.NotFoundError:
+        return []
+
+
+def create(alias, shards=None, replicas=None):
+    """次の版のインデックスを作成する
+
+    複写の間はレプリカなし・リフレッシュなしで作成し、finish() で戻す。
+    """
+    current = versions(alias)
+    name = versioned_name(alias, current[-1][0] + 1 if current else 1)
+    body = template(alias, shards, replicas)
+    body['settings']['index']['number_of_replicas'] = 0
+    body['settings']['index']['refresh_interval'] = "-1"
+    es_client.call('indices.create', index=name, body=body)
+    logger.info("版付きインデックス作成:" + name)
+    return name
+
+
+def _requests_per_second(value):
+    """秒間件数の指定値(無制限は "-1" の文字列だけが受け付けられるため -1.0 等を直す)"""
+    if value < 0:
+        return "-1"
+    return value
+
+
+def start_reindex(source, dest, slices=None, requests_per_second=None, batch_size=None,
+                  catchup=False):
+    """_reindex をタスクとして開始し、タスクIDを返す
+
+    複写元の版番号を引き継ぐ。catchup=True は2回目以降の複写で、
+    複写先に同じ版以上があるドキュメントは競合として読み飛ばす。
+    """
+    body = {
+        'source': {'index': source, 'size': batch_size or REINDEX_BATCH_SIZE},
+        'dest': {'index': dest, 'version_type': 'external'},
+    }
+    if catchup:
+        body['conflicts'] = 'proceed'
+    result = es_client.call(
+        'reindex', body=body, wait_for_completion=False,
+        slices=slices or REINDEX_SLICES,
+        requests_per_second=_requests_per_second(
+            requests_per_second or REINDEX_REQUESTS_PER_SECOND))
+    return result['task']
+
+
+def wait_task(task_id, progress=None):
+    """タスクの完了待ち。progress(status) で途中経過を通知する"""
+    while True:
+        result = es_client.call('tasks.get', task_id=task_id)
+        if result.get('completed'):
+            break
+        if progress:
+            progress(result['task']['status'])
+        time.sleep(TASK_POLL_INTERVAL)
+    if result.get('error'):
+        raise RuntimeError("複写失敗:" + json.dumps(result['error'], ensure_ascii=False))
+    response = result.get('response') or {}
+    if response.get('failures'):
+        raise RuntimeError("複写失敗:" + json.dumps(response['failures'][:5], ensure_ascii=False))
+    return response
+
+
+def cancel_task(task_id):
+    try:
+        es_client.call('tasks.cancel', task_id=task_id)
+    except elasticsearch.TransportError:
+        logger.info("タスク取消失敗:" + task_id, exc_info=True)
+
+
+def rethrottle(task_id, requests_per_second):
+    """実行中の複写の秒間件数の変更(-1で無制限)"""
+    return es_client.call('reindex_rethrottle', task_id=task_id,
+                          requests_per_second=_requests_per_second(requests_per_second))
+
+
+def set_write_block(index, blocked):
+    """書き込みの停止・再開(読み取りはそのまま。存在しないインデックスは無視)"""
+    es_client.call('indices.put_settings', index=index, ignore_unavailable=True,
+                   body={'index': {'blocks.write': True if blocked else None}})
+    logger.info("書き込み" + ("停止:" if blocked else "再開:") + index)
+
+
+def finish(name, replicas=None):
+    """複写後にレプリカ数・リフレッシュ間隔を戻す"""
+    es_client.call('indices.put_settings', index=name, body={'index': {
+        'number_of_replicas': INDEX_REPLICAS if replicas is None else replicas,
+        'refresh_interval': None,
+    }})
+    es_client.call('indices.refresh', index=name)
+
+
+def count(index):
+    es_client.call('indices.refresh', index=index)
+    return es_client.call('count', index=index)['count']
+
+
+def backup(alias):
+    """別名と同名の実体インデックスを <別名>_v0 に複製し、件数を確認する
+
+    複製元は書き込みを停止する(_clone の条件)。複製先の名前を返す。
+    """
+    name = versioned_name(alias, BACKUP_VERSION)
+    set_write_block(alias, True)
+    try:
+        es_client.call('indices.clone', index=alias, target=name)
+        if count(name) != count(alias):
+            raise ValueError("複製の件数が一致しません:" + name)
+    except Exception:
+        set_write_block(alias, False)
+        raise
+    logger.info("実体インデックス複製:" + alias + " -> " + name)
+    return name
+
+
+def swap(alias, name, replace_index=False):
+    """別名を新しい版に付け替える(1回の _aliases で行う)
+
+    別名と同名の実体インデックスがある場合は replace_index=True のときだけ、
+    実体を backup() で複製してから、同じ操作で実体を削除して別名に置き換える。
+    """
+    targets = alias_targets(alias)
+    actions = []
+    if targets == [alias]:
+        if not replace_index:
+            raise ValueError("別名と同名の実体インデックスあり:%s(--replace-index で置き換え)" % alias)
+        backup(alias)
+        actions.append({'remove_index': {'index': alias}})
+    else:
+        for target in targets:
+            if target != name:
+                actions.append({'remove': {'index': target, 'alias': alias}})
+    actions.append({'add': {'index': name, 'alias': alias, 'is_write_index': True}})
+    # _v0 は書き込みを止めた状態で複製されるため、戻す場合に備えて再開しておく
+    set_write_block(name, False)
+    es_client.call('indices.update_aliases', body={'actions': actions})
+    logger.info("別名切り替え:" + alias + " " + ",".join(targets) + " -> " + name)
+    return targets
+
+
+def unused_versions(alias, keep=1):
+    """別名の付いていない古い版(新しい方から keep 件は残す)"""
+    targets = set(alias_targets(alias))
+    old = [name for version, name in versions(alias) if name not in targets]
+    return old[:-keep] if keep else old
+
+
+def delete(name):
+    """版付きインデックスの削除(別名の付いているものは削除しない)"""
+    if not VERSION_RE.search(name):
+        raise ValueError("版付きインデックスではありません:" + name)
+    if es_client.call('indices.exists_alias', index=name, name="*"):
+        raise ValueError("別名の付いているインデックスです:" + name)
+    es_client.call('indices.delete', index=name)
@@ -0,0 +1,108 @@
+"""
+検索期間に応じたESインデックスの振り分け
+
+直近の検索は小さい commentrecent へ、過去の検索は半期ごとの
+comment_YYYY_1h / comment_YYYY_2h のうち期間に掛かるものだけへ送る。
+半期インデックスは実在するものだけを PARTITION_INDICES に列挙する
+(2021年下期はインデックスがない)。期間が表にない半期に掛かる場合と、
+どちらにも収まらない場合は従来どおり commentall を使う。
+インデックス名はいずれも読み取り用の別名で、実体の版付きインデックスは
+index_alias(reindex_comment_index コマンド)で作成・切り替える。
+"""
+from datetime import datetime, timezone, timedelta
+
+from django.conf import settings
+
+from .utils import commentall_index, mycommentall_index
+
+JST = timezone(timedelta(hours=9))
+
+commentrecent_index = "commentrecent"
+
+# commentrecent に保持されている日数
+RECENT_INDEX_DAYS = getattr(settings, 'ES_RECENT_INDEX_DAYS', 7)
+
+# 実在する半期インデックス (年, 半期(1:1-6月, 2:7-12月)) -> インデックス名
+# 2021年上期は comment_2021_1h(綴り違いの cooment_2021_1h はマッピングが空で
+# コメントを持たない)。2021年下期はインデックスがないため commentall で検索する
+PARTITION_INDICES = {
+    (2018, 1): "comment_2018_1h",
+    (2018, 2): "comment_2018_2h",
+    (2019, 1): "comment_2019_1h",
+    (2019, 2): "comment_2019_2h",
+    (2020, 1): "comment_2020_1h",
+    (2020, 2): "comment_2020_2h",
+    (2021, 1): "comment_2021_1h",
+    (2022, 1): "comment_2022_1h",
+    (2022, 2): "comment_2022_2h",
+}
+PARTITION_FIRST = min(PARTITION_INDICES)
+PARTITION_LAST = max(PARTITION_INDICES)
+
+# 配信日時のタイムゾーン差などで境界をまたぐ分の余裕
+PARTITION_MARGIN = timedelta(days=1)
+
+
+def partition_index(year, half):
+    """半期インデックス名(half は 1:1-6月, 2:7-12月)。インデックスがない半期は None"""
+    return PARTITION_INDICES.get((year, half))
+
+
+def partition_names():
+    """実在する半期インデックス名の一覧(古い順)"""
+    return [PARTITION_INDICES[key] for key in sorted(PARTITION_INDICES)]
+
+
+def _half_start(year, half):
+    return datetime(year, 1 if half == 1 else 7, 1, tzinfo=JST)
+
+
+def _next_half(year, half):
+    return (year, 2) if half == 1 else (year + 1, 1)
+
+
+def partition_indices(start, end):
+    """期間に掛かる半期インデックスの一覧
+
+    範囲外か、インデックスのない半期を含む場合は None。
+    """
+    start = start - PARTITION_MARGIN
+    end = end + PARTITION_MARGIN
+    first = _half_start(*PARTITION_FIRST)
+    last_end = _half_start(*_next_half(*PARTITION_LAST))
+    if end >= last_end:
+        return None
+    # 最初の半期より前はデータがない
+    if start < first:
+        start = first
+
+    index_list = []
+    year = start.astimezone(JST).year
+    half = 1 if start.astimezone(JST).month <= 6 else 2
+    while _half_start(year, half) <= end:
+        name = partition_index(year, half)
+        if name is None:
+            return None
+        index_list.append(name)
+        year, half = _next_half(year, half)
+    return index_list
+
+
+def route_index(search_datatime_start, search_datatime_end, my_flag=False, nowtime=None):
+    """検索期間から最小限のインデックス(カンマ区切り)を返す"""
+    if my_flag:
+        return mycommentall_index
+    if not (search_datatime_start and search_datatime_end):
+        return commentall_index
+
+    if nowtime is None:
+        nowtime = datetime.now(JST)
+
+    # 直近モード相当
+    if search_datatime_start >= nowtime - timedelta(days=RECENT_INDEX_DAYS):
+        return commentrecent_index
+
+    index_list = partition_indices(search_datatime_start, search_datatime_end)
+    if index_list:
+        return ",".join(index_list)
+    return commentall_index
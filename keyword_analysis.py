@@ -0,0 +1,155 @@
+"""
+検索キーワードの解析
+
+キーワードを語に分け、語ごとの検索方法(ngram / 通常 / 記号 / ワイルドカード)を
+判定した結果をキーワード単位でLRUキャッシュする。
+文字種の判定は unicodedata.name() の代わりにコードポイントの範囲表で行う。
+"""
+import bisect
+import functools
+import re
+from collections import namedtuple
+
+import emoji
+from django.conf import settings
+
+# 解析結果を保持するキーワード数
+KEYWORD_PLAN_CACHE_SIZE = getattr(settings, 'KEYWORD_PLAN_CACHE_SIZE', 1024)
+# 絵文字・ハングル・記号を含む語を message.symbol(1文字ずつのngram)で検索する
+# (インデックスに message.symbol を追加して再作成するまでは False のまま)
+KEYWORD_SYMBOL_FIELD = getattr(settings, 'KEYWORD_SYMBOL_FIELD', False)
+
+# ひらがな扱いの文字(文字名に HIRAGANA を含むもの。カタカナは含まない)
+JP_RANGES = (
+    (0x3041, 0x3096),
+    (0x3099, 0x30A0),
+    (0x30FC, 0x30FC),
+    (0xFF70, 0xFF70),
+    (0x1B001, 0x1B001),
+    (0x1B11F, 0x1B11F),
+    (0x1B150, 0x1B152),
+    (0x1F200, 0x1F200),
+)
+# 特別に日本語扱いする語
+JP_SPECIAL_WORDS = ("魔界ノ",)
+
+# ハングル(가-힣)
+HANGUL_RANGES = (
+    (0xAC00, 0xD7A3),
+)
+
+# ワイルドカード検索にする記号
+SYMBOL_RE = re.compile('[!-/:-@\\[-`{-~！-／：-＠［-｀｛-～、-〜”’・]')
+
+# 1語の検索条件 (否定, 種類, 値)。種類は 'wildcard' / 'symbol' / 'ngram' / 'phrase'
+# 'symbol' の値は元の語のまま(ワイルドカードのパターンは wildcard_pattern() で作る)
+Term = namedtuple('Term', ['negative', 'kind', 'value'])
+
+
+def _range_table(ranges):
+    return [start for start, _ in ranges], [end for _, end in ranges]
+
+
+_jp_table = _range_table(JP_RANGES)
+_hangul_table = _range_table(HANGUL_RANGES)
+
+
+def _in_table(word, table):
+    starts, ends = table
+    for ch in word:
+        code = ord(ch)
+        i = bisect.bisect_right(starts, code) - 1
+        if i >= 0 and code <= ends[i]:
+            return True
+    return False
+
+
+def split_words(keyword):
+    """全角・半角スペース区切りの語(空の語は除く)"""
+    return [word for word in keyword.replace('　', ' ').split(' ') if word]
+
+
+def is_jp(word):
+    """ngram のサブフィールドで検索する語か"""
+    if word in JP_SPECIAL_WORDS:
+        return True
+    return _in_table(word, _jp_table)
+
+
+def is_wildcard(word):
+    """絵文字・ハングル・記号を含む語はワイルドカード"""
+    if emoji.emoji_count(word) > 0:
+        return True
+    if _in_table(word, _hangul_table):
+        return True
+    if SYMBOL_RE.search(word):
+        return True
+    return False
+
+
+@functools.lru_cache(maxsize=KEYWORD_PLAN_CACHE_SIZE)
+def is_valid(keyword):
+    """検索可能なキーワードか(否定以外の語が1つ以上あり、不正な語がない)"""
+    count = 0
+    for word in split_words(keyword):
+        if word in ("*", "-", "-*", "\t"):
+            return False
+        if word[0] != "-":
+            count += 1
+    return count > 0
+
+
+def wildcard_pattern(word):
+    """語を含む文字列にマッチするワイルドカードのパターン"""
+    return "*" + word.replace('?', '\\?').replace('*', '\\*') + "*"
+
+
+@functools.lru_cache(maxsize=KEYWORD_PLAN_CACHE_SIZE)
+def message_terms(keyword):
+    """コメント本文の検索条件 (Term のタプル)"""
+    terms = []
+    for word in split_words(keyword):
+        if is_wildcard(word):
+            negative = word[0] == '-'
+            if negative:
+                word = word[1:]
+            if KEYWORD_SYMBOL_FIELD:
+                terms.append(Term(negative, 'symbol', word))
+            else:
+                terms.append(Term(negative, 'wildcard', wildcard_pattern(word)))
+        else:
+            kind = 'ngram' if is_jp(word) else 'phrase'
+            if word[0] == '-':
+                terms.append(Term(True, kind, word[1:]))
+            else:
+                terms.append(Term(False, kind, word))
+    return tuple(terms)
+
+
+@functools.lru_cache(maxsize=KEYWORD_PLAN_CACHE_SIZE)
+def title_terms(title_keyword):
+    """タイトルの検索条件 (Term のタプル)
+
+    ワイルドカードの語は値を元の語のまま返す(ES側では使わない)。
+    """
+    terms = []
+    for word in split_words(title_keyword):
+        negative = len(word) > 1 and word[0] == "-"
+        if negative:
+            word = word[1:]
+        if is_wildcard(word):
+            kind = 'wildcard'
+        elif is_jp(word):
+            kind = 'ngram'
+        else:
+            kind = 'phrase'
+        terms.append(Term(negative, kind, word))
+    return tuple(terms)
+
+
+def cache_info():
+    return {
+        'is_valid': is_valid.cache_info()._asdict(),
+        'message_terms': message_terms.cache_info()._asdict(),
+        'title_terms': title_terms.cache_info()._asdict(),
+    }
@@ -0,0 +1,78 @@
+"""
+同期ビューと非同期ビューのスループット比較
+
+ESは FakeTransport / FakeAsyncTransport で置き換え、--latency 秒の応答時間を
+模擬する。同期ビューは --concurrency 本のスレッド、非同期ビューは1つの
+イベントループ上で同数のリクエストを同時に処理する。
+検索履歴の登録を避けるため2ページ目を要求する。
+benchmark.isolated() のテスト用DB・プロセス内キャッシュで実行し、
+本番のDB・キャッシュには接続しない(ESは0件の結果を返す)。
+"""
+import asyncio
+import time
+from concurrent import futures
+
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+
+import comment.benchmark as benchmark
+import comment.es_client as es_client
+import comment.views as views
+
+
+class Command(BaseCommand):
+    help = "動画検索ビューの同期版・非同期版のスループットを比較する"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--concurrency', type=int, default=50)
+        parser.add_argument('--latency', type=float, default=0.05,
+                            help="模擬するESの応答時間(秒)")
+        parser.add_argument('--mode', default='0')
+
+    def handle(self, *args, **options):
+        with benchmark.isolated():
+            self.run(options)
+
+    def run(self, options):
+        total = options['requests']
+        concurrency = options['concurrency']
+        latency = options['latency']
+        factory = RequestFactory()
+
+        def make_request(i, label):
+            # キャッシュ・single-flight に掛からないよう毎回別のキーワード
+            return factory.get('/', {'keyword': "bench" + label + str(i),
+                                     'mode': options['mode'], 'page': '2'})
+
+        es_client.FakeTransport.handler = None
+        es_client.FakeTransport.delay = latency
+        es_client.set_transport_class(es_client.FakeTransport)
+        view = views.VideoListES.as_view()
+        start = time.monotonic()
+        with futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+            statuses = list(pool.map(lambda i: view(make_request(i, "sync")).status_code,
+                                     range(total)))
+        self.report("sync", total, time.monotonic() - start, statuses)
+
+        es_client.FakeAsyncTransport.handler = None
+        es_client.FakeAsyncTransport.delay = latency
+        es_client.set_async_transport_class(es_client.FakeAsyncTransport)
+        async_view = views.AsyncVideoListES.as_view()
+
+        async def run_async():
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def one(i):
+                async with semaphore:
+                    return (await async_view(make_request(i, "async"))).status_code
+            return await asyncio.gather(*(one(i) for i in range(total)))
+
+        start = time.monotonic()
+        statuses = asyncio.run(run_async())
+        self.report("async", total, time.monotonic() - start, statuses)
+
+    def report(self, label, total, elapsed, statuses):
+        errors = sum(1 for status in statuses if status != 200)
+        self.stdout.write("%-5s %d件 %.2f秒 %.1f req/s (エラー %d件)" %
+                          (label, total, elapsed, total / elapsed, errors))
@@ -0,0 +1,129 @@
+"""
+キーワード解析・クエリ作成のマイクロベンチマーク
+
+unicodedata.name() と都度の正規表現による従来の解析(この中に保持)と、
+keyword_analysis による解析を比較する。結果のクエリが一致することも確認する。
+"""
+import re
+import time
+import unicodedata
+from datetime import datetime, timezone, timedelta
+
+import emoji
+from django.core.management.base import BaseCommand
+
+import comment.keyword_analysis as keyword_analysis
+import comment.views as views
+
+KEYWORDS = [
+    "草", "かわいい", "てぇてぇ -切り抜き", "ナイス 魔界ノ", "www 草 かわいい",
+    "😂", "ㅋㅋㅋ", "!?", "えっ！？", "-あ いい", "Good morning", "カタカナ",
+    "こんばんは ★ おつ", "ママ ぺこら", "a*b? c",
+]
+
+
+def legacy_jp_check(word):
+    if word == "魔界ノ":
+        return True
+    for ch in word:
+        name = unicodedata.name(ch)
+        if "CJK KATAKANA" in name or "HIRAGANA" in name:
+            return True
+    return False
+
+
+def legacy_wildcard_check(word):
+    if emoji.emoji_count(word) > 0:
+        return True
+    if re.search('[가-힣]', word):
+        return True
+    if re.search('[!-/:-@\\[-`{-~！-／：-＠［-｀｛-～、-〜”’・]', word):
+        return True
+    return False
+
+
+def legacy_base_query(keyword, liverNameId):
+    not_word_list = []
+    word_list = []
+    for word in keyword.replace('　', ' ').split(' '):
+        if not (word):
+            continue
+        if legacy_wildcard_check(word):
+            word = word.replace('?', '\\?').replace('*', '\\*')
+            if word[0] == '-':
+                not_word_list.append(
+                    {"wildcard": {"message.wildcard": {"value": "*" + word[1:] + "*"}}})
+            else:
+                word_list.append(
+                    {"wildcard": {"message.wildcard": {"value": "*" + word + "*"}}})
+        else:
+            target = "message"
+            if legacy_jp_check(word):
+                target = target + ".ngram"
+            if word[0] == '-':
+                not_word_list.append({"match_phrase": {target: word[1:]}})
+            else:
+                word_list.append({"match_phrase": {target: word}})
+
+    query = {"query": {"bool": {"must": []}}}
+    if liverNameId:
+        query['query']['bool']['must'].append(
+            {"bool": {"should": word_list, "minimum_should_match": 1}})
+    else:
+        query['query']['bool']['must'].append({"bool": {"must": word_list}})
+    if not_word_list:
+        query['query']['bool']['must'].append(
+            {"bool": {"must_not": not_word_list}})
+    return query
+
+
+class Command(BaseCommand):
+    help = "キーワード解析・クエリ作成の従来方式と現方式を比較する"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loops', type=int, default=2000)
+        parser.add_argument('--pages', type=int, default=20,
+                            help="1回の検索で作成するクエリ数(composite のページ数)")
+
+    def handle(self, *args, **options):
+        loops = options['loops']
+        pages = options['pages']
+        start = datetime(2021, 1, 1, tzinfo=timezone(timedelta(hours=9)))
+        end = start + timedelta(days=30)
+        after_key = {'video_publishedat': 0, 'video_id': 'x'}
+
+        # message.symbol を使う設定では記号を含む語のクエリが従来と異なる
+        if not keyword_analysis.KEYWORD_SYMBOL_FIELD:
+            for keyword in KEYWORDS:
+                if legacy_base_query(keyword, None) != views.make_base_query(keyword, None):
+                    self.stderr.write("クエリ不一致:" + keyword)
+
+        def legacy():
+            for keyword in KEYWORDS:
+                for page in range(pages):
+                    # 従来はページごとにキーワード解析からクエリを作り直していた
+                    legacy_base_query(keyword, None)
+
+        def current():
+            for keyword in KEYWORDS:
+                template = views.make_video_query_template(
+                    keyword, None, (), (), '0')
+                for page in range(pages):
+                    views.apply_video_window(template, start, end, after_key)
+
+        def current_full():
+            for keyword in KEYWORDS:
+                for page in range(pages):
+                    views.make_video_query(
+                        keyword, None, (), (), start, end, after_key, '0')
+
+        for label, fn in (('legacy base', legacy), ('full query', current_full),
+                          ('template', current)):
+            begin = time.perf_counter()
+            for i in range(loops):
+                fn()
+            elapsed = time.perf_counter() - begin
+            count = loops * len(KEYWORDS) * pages
+            self.stdout.write("%-12s %.3f秒 %.2fus/クエリ" %
+                              (label, elapsed, elapsed / count * 1000000))
+        self.stdout.write(str(keyword_analysis.cache_info()))
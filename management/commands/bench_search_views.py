@@ -0,0 +1,197 @@
+"""
+検索画面のベンチマーク
+
+テスト用DBに benchmark.generate() の合成データを登録し、ESを
+benchmark.FakeSearch(プロセス内の代替ES)に置き換えて、検索条件ごとの
+シナリオ(mode / sort_mode、深いページ、グループ・チャンネル条件、
+コメント画面)を繰り返し実行する。
+シナリオごとに応答時間のパーセンタイル、1リクエストあたりのES呼び出し回数・
+時間、DBクエリ数・時間、描画時間を表示する(request_metrics の記録を使用)。
+キャッシュはこのコマンドの間だけプロセス内キャッシュに置き換え、
+既定では毎回クリアして検索キャッシュに当たらない状態で測る。
+本番のDB・キャッシュ・ESには接続しない。
+"""
+import asyncio
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+
+import comment.benchmark as benchmark
+import comment.es_client as es_client
+import comment.request_metrics as request_metrics
+import comment.views as views
+
+
+def percentile(values, rate):
+    """最近順位法のパーセンタイル"""
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, int(len(values) * rate + 0.999999) - 1))
+    return values[index]
+
+
+def make_scenarios(corpus):
+    """シナリオの一覧 [(名前, ビュー名, GETパラメータ, ビューの引数), ...]"""
+    scenarios = []
+    for mode in ('0', '1'):
+        for sort_mode in ('0', '1', '2', '3', '4'):
+            scenarios.append(("video mode=%s sort=%s" % (mode, sort_mode), 'VideoListES',
+                              {'keyword': "草", 'mode': mode, 'sort_mode': sort_mode}, {}))
+    # 語の種類(英字の語句・絵文字とハングルのワイルドカード・除外語)
+    for keyword in ("www", "😂", "ㅋㅋㅋ", "かわいい -草"):
+        scenarios.append(("video keyword=" + keyword, 'VideoListES',
+                          {'keyword': keyword, 'mode': '1'}, {}))
+    # 深いページ
+    for sort_mode, page in (('0', 5), ('0', 20), ('1', 20), ('2', 5)):
+        scenarios.append(("video page=%d sort=%s" % (page, sort_mode), 'VideoListES',
+                          {'keyword': "草", 'mode': '1', 'sort_mode': sort_mode,
+                           'page': str(page)}, {}))
+    # コメント数・タイトル・グループ・チャンネル条件
+    group = corpus.groups[0]
+    scenarios += [
+        ("video least_count=5", 'VideoListES',
+         {'keyword': "草", 'mode': '1', 'least_count': '5'}, {}),
+        ("video title_keyword", 'VideoListES',
+         {'keyword': "草", 'mode': '1', 'title_keyword': "歌枠"}, {}),
+        ("video group", 'VideoListES',
+         {'keyword': "草", 'mode': '1', 'channelName': [str(group.id)]}, {}),
+        ("video group page=5", 'VideoListES',
+         {'keyword': "草", 'mode': '1', 'channelName': [str(group.id)], 'page': '5'}, {}),
+        ("video channels", 'VideoListES',
+         {'keyword': "草", 'mode': '1',
+          'channelName': [channel.id for channel in corpus.channels[:3]]}, {}),
+        ("video ex_group", 'VideoListES',
+         {'keyword': "草", 'mode': '1', 'ex_channelName': [str(group.id)]}, {}),
+    ]
+    # コメント画面(コメントの最も多い動画)
+    counts = {}
+    for doc in corpus.docs:
+        counts[doc['video_id']] = counts.get(doc['video_id'], 0) + 1
+    video_id = max(counts, key=counts.get)
+    scenarios += [
+        ("comment", 'CommentListES', {'keyword': "草"}, {'pk': video_id}),
+        ("comment jump", 'CommentListES', {'keyword': "草", 't': '1800'}, {'pk': video_id}),
+        ("comment timeline", 'CommentListES',
+         {'keyword': "草", 'timeline': '1'}, {'pk': video_id}),
+    ]
+    return scenarios
+
+
+class Command(BaseCommand):
+    help = "合成データと代替ESで検索画面の処理時間・ES呼び出し・DBクエリを計測する"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--groups', type=int, default=3)
+        parser.add_argument('--channels', type=int, default=12)
+        parser.add_argument('--videos', type=int, default=40,
+                            help="チャンネルあたりの動画数")
+        parser.add_argument('--comments', type=int, default=60,
+                            help="動画あたりの平均コメント数")
+        parser.add_argument('--years', type=int, default=4)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--repeat', type=int, default=5,
+                            help="シナリオごとの計測回数")
+        parser.add_argument('--latency', type=float, default=0,
+                            help="ES呼び出し1回に加える待ち時間(秒)")
+        parser.add_argument('--warm', action='store_true',
+                            help="計測の間でキャッシュをクリアしない")
+        parser.add_argument('--async', action='store_true', dest='async_flag',
+                            help="非同期ビューで計測する")
+        parser.add_argument('--scenario', default='',
+                            help="名前にこの文字列を含むシナリオのみ実行")
+        parser.add_argument('--json', default='',
+                            help="結果をJSONで保存するファイル")
+
+    def handle(self, *args, **options):
+        with benchmark.isolated():
+            results = self.run(options)
+
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump(results, f, ensure_ascii=False, indent=1)
+
+    def run(self, options):
+        started = time.monotonic()
+        corpus = benchmark.generate(
+            groups=options['groups'], channels=options['channels'], videos=options['videos'],
+            comments=options['comments'], years=options['years'], seed=options['seed'])
+        fake = benchmark.FakeSearch(corpus.docs)
+        self.stdout.write("合成データ: チャンネル%d件 動画%d件 コメント%d件 (%.1f秒)" % (
+            len(corpus.channels), len(corpus.videos), len(corpus.docs),
+            time.monotonic() - started))
+
+        es_client.FakeTransport.handler = fake
+        es_client.FakeTransport.delay = options['latency']
+        es_client.set_transport_class(es_client.FakeTransport)
+        es_client.FakeAsyncTransport.handler = fake
+        es_client.FakeAsyncTransport.delay = options['latency']
+        es_client.set_async_transport_class(es_client.FakeAsyncTransport)
+
+        timings = []
+        request_metrics.add_listener(timings.append)
+        factory = RequestFactory()
+        results = []
+        self.stdout.write("%-26s %8s %8s %8s %8s %7s %8s %7s %8s %8s" % (
+            "scenario", "p50", "p90", "p99", "max", "ES回数", "ES(ms)", "DB回数", "DB(ms)",
+            "描画(ms)"))
+        try:
+            for name, view_name, params, view_kwargs in make_scenarios(corpus):
+                if options['scenario'] not in name:
+                    continue
+                if options['async_flag']:
+                    view = getattr(views, 'Async' + view_name).as_view()
+                else:
+                    view = getattr(views, view_name).as_view()
+
+                elapsed_list = []
+                errors = 0
+                del timings[:]
+                for _ in range(options['repeat']):
+                    if not options['warm']:
+                        for alias in settings.CACHES:
+                            caches[alias].clear()
+                    request = factory.get('/', params)
+                    mark = time.perf_counter()
+                    if options['async_flag']:
+                        response = asyncio.run(view(request, **view_kwargs))
+                    else:
+                        response = view(request, **view_kwargs)
+                    elapsed_list.append(time.perf_counter() - mark)
+                    if response.status_code != 200:
+                        errors += 1
+                results.append(self.report(name, elapsed_list, timings, errors))
+        finally:
+            request_metrics.remove_listener(timings.append)
+        return results
+
+    def report(self, name, elapsed_list, timings, errors):
+        count = max(len(timings), 1)
+
+        def average(values):
+            return sum(values) / count
+
+        result = {
+            'scenario': name,
+            'requests': len(elapsed_list),
+            'errors': errors,
+            'p50_ms': percentile(elapsed_list, 0.5) * 1000,
+            'p90_ms': percentile(elapsed_list, 0.9) * 1000,
+            'p99_ms': percentile(elapsed_list, 0.99) * 1000,
+            'max_ms': max(elapsed_list) * 1000,
+            'es_calls': average([timing.counts['es'] for timing in timings]),
+            'es_ms': average([timing.times['es'] for timing in timings]) * 1000,
+            'db_queries': average([timing.counts['db'] for timing in timings]),
+            'db_ms': average([timing.times['db'] for timing in timings]) * 1000,
+            'render_ms': average([timing.times['render'] for timing in timings]) * 1000,
+        }
+        line = "%-26s %8.1f %8.1f %8.1f %8.1f %7.1f %8.1f %7.1f %8.1f %8.1f" % (
+            name, result['p50_ms'], result['p90_ms'], result['p99_ms'], result['max_ms'],
+            result['es_calls'], result['es_ms'], result['db_queries'], result['db_ms'],
+            result['render_ms'])
+        if errors:
+            line += " (エラー%d件)" % errors
+        self.stdout.write(line)
+        return result
@@ -0,0 +1,41 @@
+"""
+チャンネルの動画一覧の一括収集
+
+指定したチャンネル(省略時は有効な全チャンネル)を collector のワーカーで
+並行して収集し、チャンネルごとの件数と処理時間を表示する。
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+import comment.collector as collector
+from comment.models import Channel
+
+
+class Command(BaseCommand):
+    help = "チャンネルの動画一覧を並行して収集する"
+
+    def add_arguments(self, parser):
+        parser.add_argument('channel_id', nargs='*')
+        parser.add_argument('--all-videos', action='store_true',
+                            help="新着分だけでなく再生リスト全体を取得する")
+        parser.add_argument('--db-only', action='store_true')
+
+    def handle(self, *args, **options):
+        channels = Channel.objects.all().order_by('no')
+        if options['channel_id']:
+            channels = channels.filter(id__in=options['channel_id'])
+        else:
+            channels = channels.filter(enable=True)
+
+        started = time.monotonic()
+        results = collector.collect_channels(
+            list(channels), not options['all_videos'], options['db_only'])
+        for result in results:
+            line = result['channel_id'] + " " + collector.format_result(result)
+            if result['error']:
+                self.stderr.write(line + " エラー:" + result['error'])
+            else:
+                self.stdout.write(line)
+        self.stdout.write("%dチャンネル %.2f秒" %
+                          (len(results), time.monotonic() - started))
@@ -0,0 +1,196 @@
+"""
+コメントインデックスの再作成と別名の切り替え
+
+別名(commentall 等)ごとに settings.txt / mapping.txt の定義から次の版の
+インデックスを作成し、現在の実体から _reindex(スライス並列・秒間件数の制限付き)で
+複写する。その後、複写元への書き込みを止めて追加・更新分を追いかけて複写し、
+件数が一致した場合だけ別名を新しい版に切り替える。書き込みの停止中は
+コメントの登録が失敗するため、登録処理の少ない時間帯に実行する。
+シャード数の変更や解析器の変更の反映に使う。
+別名と同名の実体インデックスがある場合(初回)は --replace-index の指定が必要で、
+実体を <別名>_v0 に複製してから別名に置き換える。古い版と _v0 は残し
+(--switch-to で戻せる)、確認後に --delete で削除する。
+--all では複写元(実体)のない別名は読み飛ばす。
+実行中の複写の秒間件数は --rethrottle <タスクID> --requests-per-second で変更できる。
+"""
+import json
+import time
+
+import elasticsearch
+from django.core.management.base import BaseCommand, CommandError
+
+import comment.index_alias as index_alias
+
+
+class Command(BaseCommand):
+    help = "コメントインデックスを新しい版に複写し、別名を切り替える"
+
+    def add_arguments(self, parser):
+        parser.add_argument('alias', nargs='*',
+                            help="対象の別名(省略時は --all か --list が必要)")
+        parser.add_argument('--all', action='store_true', help="全ての別名を対象にする")
+        parser.add_argument('--list', action='store_true',
+                            help="別名ごとの実体と版の一覧を表示する")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="作成内容と複写元を表示するだけにする")
+        parser.add_argument('--source', default='',
+                            help="複写元のインデックス(カンマ区切り。既定は別名の現在の実体)")
+        parser.add_argument('--shards', type=int, default=None)
+        parser.add_argument('--replicas', type=int, default=None)
+        parser.add_argument('--slices', default=str(index_alias.REINDEX_SLICES),
+                            help="_reindex の並列スライス数(auto または数値)")
+        parser.add_argument('--requests-per-second', type=float,
+                            default=index_alias.REINDEX_REQUESTS_PER_SECOND,
+                            help="複写の秒間件数の上限(-1で無制限)")
+        parser.add_argument('--batch-size', type=int, default=index_alias.REINDEX_BATCH_SIZE)
+        parser.add_argument('--no-swap', action='store_true',
+                            help="複写まで行い、別名は切り替えない")
+        parser.add_argument('--replace-index', action='store_true',
+                            help="別名と同名の実体インデックスを _v0 に複製して別名に置き換える")
+        parser.add_argument('--switch-to', default='',
+                            help="複写せず、指定した版付きインデックスに別名を切り替える")
+        parser.add_argument('--delete-old', action='store_true',
+                            help="切り替え後、別名の付いていない古い版を直前の1つを残して削除する")
+        parser.add_argument('--delete', default='',
+                            help="別名の付いていない版付きインデックスを削除する(カンマ区切り)")
+        parser.add_argument('--rethrottle', default='', metavar='TASK_ID',
+                            help="実行中の複写タスクの秒間件数の上限を --requests-per-second の値に変更する")
+
+    def handle(self, *args, **options):
+        aliases = options['alias']
+        if options['all']:
+            aliases = index_alias.alias_names()
+        if options['list']:
+            for alias in aliases or index_alias.alias_names():
+                self.write_status(alias)
+            return
+        if options['delete']:
+            for name in options['delete'].split(','):
+                try:
+                    index_alias.delete(name)
+                except ValueError as e:
+                    raise CommandError(str(e))
+                self.stdout.write("削除:" + name)
+            return
+        if options['rethrottle']:
+            self.rethrottle(options['rethrottle'], options['requests_per_second'])
+            return
+        if not aliases:
+            raise CommandError("別名を指定してください(--all で全て)")
+        if options['switch_to'] and len(aliases) != 1:
+            raise CommandError("--switch-to は別名を1つだけ指定してください")
+        if options['all'] and options['source']:
+            raise CommandError("--source は --all と同時に指定できません")
+
+        for alias in aliases:
+            if options['all'] and not index_alias.alias_targets(alias):
+                self.stdout.write("%s 複写元がないため読み飛ばします" % alias)
+                continue
+            if options['switch_to']:
+                self.swap(alias, options['switch_to'], options)
+            else:
+                self.migrate(alias, options)
+
+    def rethrottle(self, task_id, requests_per_second):
+        try:
+            index_alias.rethrottle(task_id, requests_per_second)
+        except elasticsearch.NotFoundError:
+            raise CommandError("タスクがありません:" + task_id)
+        self.stdout.write("%s 秒間上限:%s" % (task_id, requests_per_second))
+
+    def write_status(self, alias):
+        targets = index_alias.alias_targets(alias)
+        versions = [name for version, name in index_alias.versions(alias)]
+        if not targets:
+            state = "なし"
+        elif targets == [alias]:
+            state = "実体"
+        else:
+            state = "別名"
+        self.stdout.write("%-16s %s -> %s 版:%s シャード:%d" % (
+            alias, state, ",".join(targets) or "(なし)", ",".join(versions) or "(なし)",
+            index_alias.template(alias)['settings']['index']['number_of_shards']))
+
+    def migrate(self, alias, options):
+        source = options['source'] or ",".join(index_alias.alias_targets(alias))
+        if not source:
+            raise CommandError("複写元がありません:" + alias)
+        if (index_alias.is_concrete(alias) and not options['replace_index'] and
+                not options['no_swap'] and not options['dry_run']):
+            raise CommandError("別名と同名の実体インデックスあり:%s(--replace-index で置き換え)" % alias)
+        slices = options['slices']
+        if slices != 'auto':
+            slices = int(slices)
+
+        if options['dry_run']:
+            self.stdout.write("%s 複写元:%s" % (alias, source))
+            self.stdout.write(json.dumps(
+                index_alias.template(alias, options['shards'], options['replicas']),
+                ensure_ascii=False, indent=1))
+            return
+
+        name = index_alias.create(alias, options['shards'], options['replicas'])
+        self.stdout.write("%s 作成:%s 複写元:%s" % (alias, name, source))
+        begin = time.monotonic()
+        self.reindex(source, name, slices, options)
+
+        # 書き込みを止めて、複写中に追加・更新された分を複写する(秒間件数の制限なし)
+        index_alias.set_write_block(source, True)
+        self.stdout.write("%s 書き込み停止" % source)
+        try:
+            self.reindex(source, name, slices, dict(options, requests_per_second=-1),
+                         catchup=True)
+            index_alias.finish(name, options['replicas'])
+
+            source_count = index_alias.count(source)
+            dest_count = index_alias.count(name)
+            self.stdout.write("%s 複写完了 %d件/%d件 %.0f秒" % (
+                name, dest_count, source_count, time.monotonic() - begin))
+            if dest_count != source_count:
+                raise CommandError("複写先の件数が一致しません。切り替えずに終了します:" + name)
+            if options['no_swap']:
+                self.stdout.write("別名は切り替えていません(以降の書き込みは %s に複写されないため、"
+                                  "切り替えは再実行で行ってください)" % name)
+                return
+            self.swap(alias, name, options)
+        finally:
+            # 切り替え後の古い版は別名から外れているため、書き込みを戻しても参照されない
+            index_alias.set_write_block(source, False)
+            self.stdout.write("%s 書き込み再開" % source)
+
+    def reindex(self, source, name, slices, options, catchup=False):
+        task_id = index_alias.start_reindex(
+            source, name, slices, options['requests_per_second'],
+            options['batch_size'], catchup)
+        self.stdout.write("  タスク:" + task_id)
+        try:
+            response = index_alias.wait_task(task_id, self.write_progress)
+        except KeyboardInterrupt:
+            index_alias.cancel_task(task_id)
+            raise CommandError("中断しました(複写先 %s は残っています)" % name)
+        except RuntimeError as e:
+            raise CommandError(str(e))
+        self.stdout.write("  作成%d件 更新%d件 複写済み%d件 %dms" % (
+            response.get('created', 0), response.get('updated', 0),
+            response.get('version_conflicts', 0), response.get('took', 0)))
+
+    def write_progress(self, status):
+        done = status.get('created', 0) + status.get('updated', 0)
+        self.stdout.write("  %d/%d件 秒間上限:%s" % (
+            done, status.get('total', 0), status.get('requests_per_second')))
+
+    def swap(self, alias, name, options):
+        if name not in [version_name for version, version_name in index_alias.versions(alias)]:
+            raise CommandError("%s の版付きインデックスではありません:%s" % (alias, name))
+        try:
+            previous = index_alias.swap(alias, name, options['replace_index'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write("%s 切り替え:%s -> %s" % (alias, ",".join(previous), name))
+        if previous == [alias]:
+            self.stdout.write("  元の実体は %s に複製しました(確認後に --delete で削除)" %
+                              index_alias.versioned_name(alias, index_alias.BACKUP_VERSION))
+        if options['delete_old']:
+            for old in index_alias.unused_versions(alias):
+                index_alias.delete(old)
+                self.stdout.write("  削除:" + old)
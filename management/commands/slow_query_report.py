@@ -0,0 +1,68 @@
+"""
+遅い検索の集計の表示
+
+slow_query が記録したクエリの形(シグネチャ)ごとに、合計処理時間の順で
+件数・合計/平均/最大の処理時間・平均 took・平均ES検索回数を表示する。
+--profile で保存済みの profile 結果(シャードごとの内訳)も表示する。
+"""
+import json
+
+from django.core.management.base import BaseCommand
+
+import comment.slow_query as slow_query
+
+
+class Command(BaseCommand):
+    help = "遅い検索をクエリの形ごとに合計処理時間の順で表示する"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=20)
+        parser.add_argument('--profile', action='store_true',
+                            help="保存済みの profile 結果の内訳も表示する")
+        parser.add_argument('--query', action='store_true',
+                            help="直近のクエリも表示する")
+        parser.add_argument('--clear', action='store_true',
+                            help="集計を削除する")
+
+    def handle(self, *args, **options):
+        if options['clear']:
+            slow_query.clear()
+            self.stdout.write("集計を削除しました")
+            return
+
+        entries = slow_query.report()
+        if not entries:
+            self.stdout.write("記録なし(閾値 %.2f秒)" % slow_query.SLOW_QUERY_THRESHOLD)
+            return
+
+        self.stdout.write("%4s %6s %9s %8s %8s %9s %7s  %s" % (
+            "順位", "件数", "合計(秒)", "平均(秒)", "最大(秒)", "took(ms)", "ES回数", "シグネチャ"))
+        for rank, entry in enumerate(entries[:options['limit']], 1):
+            count = entry['count']
+            self.stdout.write("%4d %6d %9.1f %8.2f %8.2f %9.0f %7.1f  %s" % (
+                rank, count, entry['total_time'], entry['total_time'] / count,
+                entry['max_time'], entry['total_took'] / count,
+                entry['total_pages'] / count, entry['signature']))
+            self.stdout.write("     id=%s 最終=%s" % (
+                entry['id'], entry['last_at'].strftime('%Y-%m-%d %H:%M:%S')))
+            if options['query']:
+                self.stdout.write("     index=" + str(entry['sample_index']))
+                self.stdout.write("     " + json.dumps(entry['sample_query'], ensure_ascii=False))
+            if options['profile']:
+                for summary in slow_query.profiles(entry['id']):
+                    self.write_profile(summary)
+
+    def write_profile(self, summary):
+        self.stdout.write("     profile %s took=%sms" % (
+            summary['at'].strftime('%Y-%m-%d %H:%M:%S'), summary['took']))
+        for shard in summary['shards']:
+            self.stdout.write("       %s query=%.1fms collector=%.1fms aggs=%.1fms" % (
+                shard['id'], shard['query_ms'], shard['collector_ms'], shard['aggregation_ms']))
+            for node in shard['query'] + shard['aggregations']:
+                self.write_node(node, 8)
+
+    def write_node(self, node, indent):
+        self.stdout.write("%s%.1fms %s %s" % (
+            " " * indent, node['time_ms'], node['type'], node['description'][:120]))
+        for child in node.get('children', []):
+            self.write_node(child, indent + 2)
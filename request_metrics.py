@@ -0,0 +1,261 @@
+"""
+リクエストごとの処理時間の内訳と集計
+
+検索画面のリクエスト中に、ES呼び出し(回数・took・通信を含む時間)、
+DBクエリ(件数・時間)、同一検索の完了待ち、テンプレート描画の時間を記録する。
+内訳は Server-Timing ヘッダで返し(ストリーミング応答は応答開始までの分)、プロセス内のヒストグラムに集計して
+Prometheus形式(render_prometheus())で出力する。
+記録先はコンテキスト変数のため、sync_to_async や asyncio のタスク、
+contextvars.copy_context() で実行したスレッドにも引き継がれる。
+DBクエリの記録はリクエストの処理中だけ接続に execute_wrapper を付けて行うため、
+非同期ビューからDBを使う処理は request_metrics.sync_to_async() で実行する。
+"""
+import contextvars
+import functools
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from asgiref.sync import sync_to_async as asgiref_sync_to_async
+from django.db import connections
+from django.shortcuts import render as django_render
+
+# 秒単位のヒストグラムの区切り
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# ラベルに使う値(それ以外は other にまとめる)
+MODE_VALUES = ('0', '1')
+SORT_MODE_VALUES = ('0', '1', '2', '3', '4')
+
+# Server-Timing の項目 (記録名, ヘッダの名前, 説明)
+# ヘッダはASCIIのみのため説明は英語
+TIMING_ITEMS = (
+    ('es', 'es', "ES"),
+    ('es_took', 'es-took', "ES took"),
+    ('db', 'db', "DB"),
+    ('lock', 'lock', "lock wait"),
+    ('render', 'render', "render"),
+)
+
+_current = contextvars.ContextVar('request_timing', default=None)
+# リクエスト完了時に RequestTiming を受け取る関数(ベンチマーク等)
+_listeners = []
+
+
+class RequestTiming:
+    """1リクエストの処理時間の内訳"""
+
+    def __init__(self, view, mode, sort_mode):
+        self.labels = (view, mode, sort_mode)
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self.times = {name: 0.0 for name, _, _ in TIMING_ITEMS}
+        self.counts = {name: 0 for name, _, _ in TIMING_ITEMS}
+
+    def add(self, name, seconds, count=1):
+        with self._lock:
+            self.times[name] += seconds
+            self.counts[name] += count
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        items = []
+        for name, header_name, desc in TIMING_ITEMS:
+            if self.counts[name] == 0:
+                continue
+            if name in ('es', 'db'):
+                desc = desc + " x" + str(self.counts[name])
+            items.append('%s;dur=%.1f;desc="%s"' %
+                         (header_name, self.times[name] * 1000, desc))
+        items.append('total;dur=%.1f' % (self.elapsed() * 1000))
+        return ", ".join(items)
+
+
+def current():
+    return _current.get()
+
+
+def add(name, seconds, count=1):
+    """実行中のリクエストに時間を加算(リクエスト外では何もしない)"""
+    timing = _current.get()
+    if timing is not None:
+        timing.add(name, seconds, count)
+
+
+@contextmanager
+def timer(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(name, time.perf_counter() - started)
+
+
+def render(*args, **kwargs):
+    """django.shortcuts.render の描画時間を記録する版"""
+    with timer('render'):
+        return django_render(*args, **kwargs)
+
+
+# ---- DBクエリ ----
+
+def _execute_wrapper(execute, sql, params, many, context):
+    timing = _current.get()
+    if timing is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timing.add('db', time.perf_counter() - started)
+
+
+@contextmanager
+def db_timing():
+    """このスレッドのDB接続のクエリ時間を記録する(抜けると記録をやめる)"""
+    with ExitStack() as stack:
+        for conn in connections.all():
+            stack.enter_context(conn.execute_wrapper(_execute_wrapper))
+        yield
+
+
+def sync_to_async(func, **kwargs):
+    """asgiref の sync_to_async で、実行中のDBクエリ時間も記録する版"""
+    @functools.wraps(func)
+    def run(*args, **func_kwargs):
+        with db_timing():
+            return func(*args, **func_kwargs)
+    return asgiref_sync_to_async(run, **kwargs)
+
+
+# ---- 集計 ----
+
+class Histogram:
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = {
+                    'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self, label_names):
+        lines = ["# HELP " + self.name + " " + self.help,
+                 "# TYPE " + self.name + " histogram"]
+        with self._lock:
+            for labels, series in sorted(self._series.items()):
+                label_text = ",".join('%s="%s"' % (name, value)
+                                      for name, value in zip(label_names, labels))
+                for bound, count in zip(self.buckets, series['buckets']):
+                    lines.append('%s_bucket{%s,le="%s"} %d' %
+                                 (self.name, label_text, bound, count))
+                lines.append('%s_bucket{%s,le="+Inf"} %d' %
+                             (self.name, label_text, series['count']))
+                lines.append('%s_sum{%s} %s' %
+                             (self.name, label_text, series['sum']))
+                lines.append('%s_count{%s} %d' %
+                             (self.name, label_text, series['count']))
+        return lines
+
+
+LABEL_NAMES = ('view', 'mode', 'sort_mode')
+
+request_seconds = Histogram(
+    'comment_request_seconds', "検索画面のリクエスト処理時間", LATENCY_BUCKETS)
+part_seconds = {
+    name: Histogram('comment_request_' + name + '_seconds',
+                    "リクエストあたりの" + desc + "の時間", LATENCY_BUCKETS)
+    for name, _, desc in TIMING_ITEMS
+}
+es_calls = Histogram('comment_request_es_calls',
+                     "リクエストあたりのES呼び出し回数", COUNT_BUCKETS)
+db_queries = Histogram('comment_request_db_queries',
+                       "リクエストあたりのDBクエリ数", COUNT_BUCKETS)
+
+
+def start(view, request):
+    mode = request.GET.get('mode') or '0'
+    sort_mode = request.GET.get('sort_mode') or '0'
+    return RequestTiming(view,
+                         mode if mode in MODE_VALUES else 'other',
+                         sort_mode if sort_mode in SORT_MODE_VALUES else 'other')
+
+
+def finish(timing, response):
+    """集計に反映し、Server-Timing ヘッダを付ける"""
+    request_seconds.observe(timing.labels, timing.elapsed())
+    for name, histogram in part_seconds.items():
+        histogram.observe(timing.labels, timing.times[name])
+    es_calls.observe(timing.labels, timing.counts['es'])
+    db_queries.observe(timing.labels, timing.counts['db'])
+    response['Server-Timing'] = timing.server_timing()
+    for listener in list(_listeners):
+        listener(timing)
+    return response
+
+
+def add_listener(listener):
+    _listeners.append(listener)
+
+
+def remove_listener(listener):
+    _listeners.remove(listener)
+
+
+class RequestMetricsMixin:
+    """ビューのリクエスト処理時間を記録する(同期・非同期ビュー共通)"""
+
+    def dispatch(self, request, *args, **kwargs):
+        timing = start(type(self).__name__, request)
+        if self.view_is_async:
+            async def run():
+                token = _current.set(timing)
+                try:
+                    response = await super(RequestMetricsMixin, self).dispatch(request, *args, **kwargs)
+                finally:
+                    _current.reset(token)
+                return finish(timing, response)
+            return run()
+
+        token = _current.set(timing)
+        try:
+            with db_timing():
+                response = super().dispatch(request, *args, **kwargs)
+        finally:
+            _current.reset(token)
+        return finish(timing, response)
+
+
+def render_prometheus(extra_gauges=None, extra_counters=None):
+    """集計のPrometheus形式テキスト
+
+    extra_gauges は {メトリクス名: 値} の辞書(接続プール等の現在値)、
+    extra_counters は同じ形式の起動からの累計値。
+    """
+    lines = request_seconds.render(LABEL_NAMES)
+    for histogram in part_seconds.values():
+        lines += histogram.render(LABEL_NAMES)
+    lines += es_calls.render(LABEL_NAMES)
+    lines += db_queries.render(LABEL_NAMES)
+    for name, value in sorted((extra_gauges or {}).items()):
+        lines.append("# TYPE " + name + " gauge")
+        lines.append(name + " " + str(value))
+    for name, value in sorted((extra_counters or {}).items()):
+        lines.append("# TYPE " + name + " counter")
+        lines.append(name + " " + str(value))
+    return "\n".join(lines) + "\n"
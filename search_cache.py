@@ -0,0 +1,99 @@
+"""
+動画検索結果のキャッシュ
+
+検索条件を正規化したシグネチャをキーに、VideoSearch の状態
+(順序付きの動画ID/コメント数リストと続きの検索位置)を保存する。
+Djangoのキャッシュフレームワークを使い、容量の上限と追い出し(LRU)は
+バックエンド側(locmem の MAX_ENTRIES 等)に任せる。
+"""
+import hashlib
+import json
+import threading
+
+import emoji
+from django.conf import settings
+from django.core.cache import caches
+
+# 使用するキャッシュ(settings.CACHES のエイリアス)
+SEARCH_CACHE_ALIAS = getattr(settings, 'SEARCH_CACHE_ALIAS', 'default')
+# 直近モード・終了日時未指定の検索(新着で結果が変わる)
+SEARCH_CACHE_TTL_RECENT = getattr(settings, 'SEARCH_CACHE_TTL_RECENT', 60)
+# 終了日時が確定した過去期間の検索
+SEARCH_CACHE_TTL_CLOSED = getattr(settings, 'SEARCH_CACHE_TTL_CLOSED', 60 * 60)
+# 1エントリに保持する最大件数(これを超えた分は保存しない)
+SEARCH_CACHE_MAX_ITEMS = getattr(settings, 'SEARCH_CACHE_MAX_ITEMS', 1000)
+
+KEY_PREFIX = "video_search:"
+
+_stats_lock = threading.Lock()
+_stats = {
+    'hit': 0,
+    'miss': 0,
+    'set': 0,
+}
+
+
+def _cache():
+    return caches[SEARCH_CACHE_ALIAS]
+
+
+def normalize_keyword(keyword):
+    if not keyword:
+        return ''
+    words = [word for word in keyword.replace('　', ' ').split(' ') if word]
+    return emoji.demojize(' '.join(words))
+
+
+def make_signature(keyword, liverNameId, channelList, ex_channelList, mode,
+                   search_datatime_start_str, search_datatime_end_str,
+                   sort_mode, least_count, title_keyword, my_flag):
+    """検索条件の正規化シグネチャ
+
+    期間は画面から指定された文字列を使う(未指定時の現在時刻起点の
+    期間は毎回変わるため含めない)。
+    """
+    signature = {
+        'keyword': normalize_keyword(keyword),
+        'liverNameId': liverNameId,
+        'channel': sorted(str(channel) for channel in channelList or ()),
+        'ex_channel': sorted(str(channel) for channel in ex_channelList or ()),
+        'mode': mode,
+        'start': search_datatime_start_str or '',
+        'end': search_datatime_end_str or '',
+        'sort_mode': sort_mode,
+        'least_count': least_count,
+        'title_keyword': normalize_keyword(title_keyword),
+        'my_flag': bool(my_flag),
+    }
+    text = json.dumps(signature, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def timeout_for(mode, search_datatime_end, nowtime):
+    """検索期間に応じたTTL(秒)"""
+    if mode == '0' or search_datatime_end is None or search_datatime_end >= nowtime:
+        return SEARCH_CACHE_TTL_RECENT
+    return SEARCH_CACHE_TTL_CLOSED
+
+
+def _count(key):
+    with _stats_lock:
+        _stats[key] += 1
+
+
+def load(signature):
+    state = _cache().get(KEY_PREFIX + signature)
+    _count('miss' if state is None else 'hit')
+    return state
+
+
+def store(signature, state, timeout):
+    if len(state['items']) > SEARCH_CACHE_MAX_ITEMS:
+        return
+    _cache().set(KEY_PREFIX + signature, state, timeout)
+    _count('set')
+
+
+def stats():
+    with _stats_lock:
+        return dict(_stats)
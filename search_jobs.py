@@ -0,0 +1,129 @@
+"""
+動画検索の非同期ジョブ
+
+全期間検索のように時間のかかる検索を上限付きのワーカーで実行し、
+リクエストにはジョブIDだけをすぐ返す。検索状況と途中までの結果は
+期間(月)ごとに共有キャッシュへ書き込み、search_job_status から取得する。
+完了した結果は検索結果キャッシュにも保存し、通常のページ表示で再利用する。
+"""
+import logging
+import threading
+import uuid
+from concurrent import futures
+
+import elasticsearch
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+
+import comment.search_cache as search_cache
+
+logger = logging.getLogger(__name__)
+
+SEARCH_JOB_CACHE_ALIAS = getattr(settings, 'SEARCH_JOB_CACHE_ALIAS', 'default')
+# 同時に実行するジョブ数
+SEARCH_JOB_WORKERS = getattr(settings, 'SEARCH_JOB_WORKERS', 4)
+# 実行待ちを含めて受け付けるジョブ数(プロセスごと)
+SEARCH_JOB_QUEUE_MAX = getattr(settings, 'SEARCH_JOB_QUEUE_MAX', 20)
+# ジョブ結果の保持期間(秒)
+SEARCH_JOB_TTL = getattr(settings, 'SEARCH_JOB_TTL', 10 * 60)
+# 1ジョブで集める最大件数
+SEARCH_JOB_MAX_ITEMS = getattr(settings, 'SEARCH_JOB_MAX_ITEMS', 200)
+
+KEY_PREFIX = "search_job:"
+
+executor = futures.ThreadPoolExecutor(
+    max_workers=SEARCH_JOB_WORKERS, thread_name_prefix='search_job')
+
+_slots = threading.BoundedSemaphore(SEARCH_JOB_QUEUE_MAX)
+
+
+class SearchJobFull(Exception):
+    """受付上限を超えた"""
+    pass
+
+
+def _cache():
+    return caches[SEARCH_JOB_CACHE_ALIAS]
+
+
+def load(job_id):
+    return _cache().get(KEY_PREFIX + job_id)
+
+
+def _save(job_id, job):
+    _cache().set(KEY_PREFIX + job_id, job, SEARCH_JOB_TTL)
+
+
+def _progress(video_search):
+    return {
+        'try_count': video_search.try_count,
+        'window_start': video_search.search_datatime_start.isoformat(),
+        'window_end': video_search.search_datatime_end.isoformat(),
+        'item_count': len(video_search.items),
+    }
+
+
+def submit(video_search, signature, cache_timeout, max_items=SEARCH_JOB_MAX_ITEMS):
+    """ジョブを登録してIDを返す。同一条件のジョブが実行中ならそのIDを返す"""
+    cache = _cache()
+    job_id = cache.get(KEY_PREFIX + "signature:" + signature)
+    if job_id:
+        job = load(job_id)
+        if job and job['status'] in ('queued', 'running'):
+            return job_id
+
+    if not _slots.acquire(blocking=False):
+        raise SearchJobFull()
+
+    job_id = uuid.uuid4().hex
+    _save(job_id, {
+        'status': 'queued',
+        'my_flag': video_search.my_flag,
+        'liverNameId': video_search.liverNameId,
+        'progress': _progress(video_search),
+        'items': [],
+        'exhausted': False,
+        'message': "",
+    })
+    cache.set(KEY_PREFIX + "signature:" + signature, job_id, SEARCH_JOB_TTL)
+    try:
+        executor.submit(_run, job_id, video_search,
+                        signature, cache_timeout, max_items)
+    except Exception:
+        _slots.release()
+        raise
+    return job_id
+
+
+def _run(job_id, video_search, signature, cache_timeout, max_items):
+    job = load(job_id) or {}
+    job['status'] = 'running'
+
+    def progress(video_search):
+        # 1回の検索(1期間分)ごとに途中結果を公開
+        job['progress'] = _progress(video_search)
+        job['items'] = list(video_search.items)
+        _save(job_id, job)
+
+    try:
+        _save(job_id, job)
+        video_search.fill(max_items, progress)
+        search_cache.store(signature, video_search.to_state(), cache_timeout)
+        job['status'] = 'done'
+        job['exhausted'] = video_search.exhausted
+        job['progress'] = _progress(video_search)
+        job['items'] = list(video_search.items)
+        logger.info("検索ジョブ完了:" + job_id)
+    except elasticsearch.ConnectionTimeout:
+        logger.error("ESタイムアウト(ジョブ):" + job_id, exc_info=True)
+        job['status'] = 'error'
+        job['message'] = "検索結果が多いか、アクセスが集中しています。期間などを絞り込むか、時間をおいてお試しください。"
+    except Exception:
+        logger.error("想定外エラー(ジョブ):" + job_id, exc_info=True)
+        job['status'] = 'error'
+        job['message'] = "エラーが発生しました。お手数おかけしますが事象が解消されない場合は問い合わせをお願い致します。"
+    finally:
+        _save(job_id, job)
+        _slots.release()
+        connection.close()
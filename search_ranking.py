@@ -0,0 +1,252 @@
+"""
+人気検索キーワードと検索履歴の集計
+
+検索履歴の書き込み(history_writer のバックグラウンドスレッド)のたびに
+共有キャッシュ上の時間帯別カウンタ(既定10分単位)をまとめて更新し、
+トップページでは直近24時間分を合算した上位K件だけを返す。
+過去の時間帯の合算は時間帯が切り替わるときに1回だけ行い、
+表示ごとに SearchHistory を全件読むことはしない。
+キャッシュが空のとき(再起動直後など)は SearchHistory からバックグラウンドで
+1回だけ再構築する(再構築中の表示は空または途中の集計)。
+集計は従来どおり (キーワード, クライアントIP) の重複を除いた件数。
+キャッシュは専用の SEARCH_RANKING_CACHE_ALIAS(CACHES に無い場合は default)を使う。
+"""
+import hashlib
+import logging
+import time
+import uuid
+from concurrent import futures
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import close_old_connections
+
+from comment.models import SearchHistory
+
+logger = logging.getLogger(__name__)
+
+SEARCH_RANKING_CACHE_ALIAS = getattr(settings, 'SEARCH_RANKING_CACHE_ALIAS', 'search_ranking')
+# 集計期間(秒)
+SEARCH_RANKING_WINDOW = getattr(settings, 'SEARCH_RANKING_WINDOW', 24 * 60 * 60)
+# カウンタの時間帯の幅(秒)
+SEARCH_RANKING_BUCKET = getattr(settings, 'SEARCH_RANKING_BUCKET', 10 * 60)
+# 表示する件数
+SEARCH_RANKING_TOP = getattr(settings, 'SEARCH_RANKING_TOP', 50)
+# 過去の時間帯の合算で保持するキーワード数
+SEARCH_RANKING_KEEP = getattr(settings, 'SEARCH_RANKING_KEEP', 1000)
+# 上位リストの再計算間隔(秒)
+SEARCH_RANKING_TOP_TTL = getattr(settings, 'SEARCH_RANKING_TOP_TTL', 60)
+# my画面の検索履歴として保持する件数
+SEARCH_HISTORY_RECENT_MAX = getattr(settings, 'SEARCH_HISTORY_RECENT_MAX', 1000)
+
+KEY_PREFIX = "search_ranking:"
+LOCK_TTL = 5
+# 再構築の実行中の印の有効期間(秒)
+REBUILD_LOCK_TTL = 5 * 60
+
+# 再構築用(検索リクエストの処理を待たせない)
+rebuild_executor = futures.ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix='search_ranking_rebuild')
+
+
+def _cache():
+    if SEARCH_RANKING_CACHE_ALIAS in settings.CACHES:
+        return caches[SEARCH_RANKING_CACHE_ALIAS]
+    return caches['default']
+
+
+def _bucket_id(searchAt):
+    return int(searchAt.timestamp()) // SEARCH_RANKING_BUCKET
+
+
+def _bucket_count():
+    return SEARCH_RANKING_WINDOW // SEARCH_RANKING_BUCKET
+
+
+def _bucket_key(bucket_id):
+    return KEY_PREFIX + "bucket:" + str(bucket_id)
+
+
+def _seen_key(keyword, clientIP):
+    text = keyword + "\n" + str(clientIP)
+    return KEY_PREFIX + "seen:" + hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+def _seen_timeout(searchAt, nowtime):
+    """(キーワード, クライアントIP) の印の有効期間(検索日時から集計期間が過ぎるまで)"""
+    return max(1, SEARCH_RANKING_WINDOW - int((nowtime - searchAt).total_seconds()))
+
+
+def _locked(fn):
+    """カウンタ更新の排他(キャッシュのロック。取れない場合も短時間で実行する)"""
+    cache = _cache()
+    lock_key = KEY_PREFIX + "lock"
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + 1
+    while not cache.add(lock_key, token, LOCK_TTL):
+        if time.monotonic() > deadline:
+            logger.info("検索ランキングのロック待ちタイムアウト")
+            token = None
+            break
+        time.sleep(0.01)
+    try:
+        return fn()
+    finally:
+        if token and cache.get(lock_key) == token:
+            cache.delete(lock_key)
+
+
+def _ensure_built(nowtime):
+    """未構築ならバックグラウンドで再構築する(待たない)"""
+    if _cache().get(KEY_PREFIX + "built") is None:
+        if _cache().add(KEY_PREFIX + "rebuilding", 1, REBUILD_LOCK_TTL):
+            rebuild_executor.submit(_rebuild_task, nowtime)
+
+
+def _rebuild_task(nowtime):
+    close_old_connections()
+    try:
+        rebuild(nowtime)
+    except Exception:
+        logger.error("検索ランキング再構築エラー", exc_info=True)
+    finally:
+        _cache().delete(KEY_PREFIX + "rebuilding")
+        close_old_connections()
+
+
+def record_many(history_list):
+    """書き込み済みの検索履歴をまとめて集計に反映する(ライバー名検索はランキング対象外)
+
+    history_writer の書き込みスレッドから呼ぶ。
+    """
+    if not history_list:
+        return
+    cache = _cache()
+    nowtime = max(history.searchAt for history in history_list)
+    if cache.get(KEY_PREFIX + "built") is None:
+        # 未構築なら書き込み済みの分を含めて作り直す
+        if cache.add(KEY_PREFIX + "rebuilding", 1, REBUILD_LOCK_TTL):
+            try:
+                rebuild(nowtime)
+            finally:
+                cache.delete(KEY_PREFIX + "rebuilding")
+            return
+
+    entries = [(history.keyword, history.liverNameId_id, history.clientIP, history.searchAt)
+               for history in history_list]
+
+    # 重複の判定は (キーワード, クライアントIP) ごとの印を cache.add で付ける。
+    # add は原子的なので、並行して反映しても同じ組を二重に数えず、互いの印も上書きしない
+    counts = {}
+    for keyword, liverNameId, clientIP, searchAt in entries:
+        if not keyword or liverNameId:
+            continue
+        if not cache.add(_seen_key(keyword, clientIP), searchAt.timestamp(),
+                         _seen_timeout(searchAt, nowtime)):
+            continue
+        bucket = counts.setdefault(_bucket_key(_bucket_id(searchAt)), {})
+        bucket[keyword] = bucket.get(keyword, 0) + 1
+
+    def update():
+        bucket_dict = cache.get_many(list(counts))
+        for key, bucket_counts in counts.items():
+            bucket = bucket_dict.get(key) or {}
+            for keyword, count in bucket_counts.items():
+                bucket[keyword] = bucket.get(keyword, 0) + count
+            bucket_dict[key] = bucket
+        cache.set_many({key: bucket_dict[key] for key in counts},
+                       SEARCH_RANKING_WINDOW + SEARCH_RANKING_BUCKET)
+
+        # 書き込みの順序が前後しても検索日時の新しい順にする
+        recent = sorted(entries + (cache.get(KEY_PREFIX + "recent") or []),
+                        key=lambda entry: entry[3], reverse=True)
+        cache.set(KEY_PREFIX + "recent",
+                  recent[:SEARCH_HISTORY_RECENT_MAX], SEARCH_RANKING_WINDOW)
+    _locked(update)
+
+
+def _closed_total(current_id):
+    """現在の時間帯より前の合算(時間帯ごとに1回だけ計算)"""
+    cache = _cache()
+    key = KEY_PREFIX + "closed:" + str(current_id)
+    total = cache.get(key)
+    if total is None:
+        total = {}
+        first_id = current_id - _bucket_count() + 1
+        bucket_dict = cache.get_many(
+            [_bucket_key(bucket_id) for bucket_id in range(first_id, current_id)])
+        for bucket in bucket_dict.values():
+            for keyword, count in bucket.items():
+                total[keyword] = total.get(keyword, 0) + count
+        if len(total) > SEARCH_RANKING_KEEP:
+            total = dict(sorted(total.items(), key=lambda i: i[1],
+                                reverse=True)[:SEARCH_RANKING_KEEP])
+        cache.set(key, total, SEARCH_RANKING_BUCKET * 2)
+    return total
+
+
+def top(nowtime, limit=SEARCH_RANKING_TOP):
+    """直近の人気キーワード [(キーワード, 件数), ...](件数の降順)"""
+    _ensure_built(nowtime)
+    cache = _cache()
+    current_id = _bucket_id(nowtime)
+    key = KEY_PREFIX + "top:" + str(limit)
+    cached = cache.get(key)
+    if cached and cached[0] == current_id:
+        return cached[1]
+
+    total = dict(_closed_total(current_id))
+    for keyword, count in (cache.get(_bucket_key(current_id)) or {}).items():
+        total[keyword] = total.get(keyword, 0) + count
+    ranking = sorted(total.items(), key=lambda i: i[1], reverse=True)[:limit]
+    cache.set(key, (current_id, ranking), SEARCH_RANKING_TOP_TTL)
+    return ranking
+
+
+def recent(nowtime):
+    """直近の検索履歴 [(キーワード, ライバー名ID, クライアントIP, 検索日時), ...](新しい順)"""
+    _ensure_built(nowtime)
+    since = nowtime - timedelta(seconds=SEARCH_RANKING_WINDOW)
+    return [entry for entry in _cache().get(KEY_PREFIX + "recent") or []
+            if entry[3] >= since]
+
+
+def rebuild(nowtime):
+    """SearchHistory から集計を作り直す"""
+    since = nowtime - timedelta(seconds=SEARCH_RANKING_WINDOW)
+    history_list = list(SearchHistory.objects.filter(searchAt__gte=since).values_list(
+        'keyword', 'liverNameId_id', 'clientIP', 'searchAt').order_by('searchAt'))
+
+    buckets = {}
+    seen = set()
+    # 印は有効期間ごとに書き込むため、最初に検索された時間帯ごとにまとめる
+    seen_groups = {}
+    for keyword, liverNameId_id, clientIP, searchAt in history_list:
+        if not keyword or liverNameId_id:
+            continue
+        seen_key = _seen_key(keyword, clientIP)
+        if seen_key in seen:
+            continue
+        seen.add(seen_key)
+        bucket_id = _bucket_id(searchAt)
+        seen_groups.setdefault(bucket_id, {})[seen_key] = searchAt.timestamp()
+        bucket = buckets.setdefault(_bucket_key(bucket_id), {})
+        bucket[keyword] = bucket.get(keyword, 0) + 1
+
+    recent_list = [tuple(history) for history in reversed(
+        history_list[-SEARCH_HISTORY_RECENT_MAX:])]
+
+    def update():
+        cache = _cache()
+        for bucket_id, seen_dict in seen_groups.items():
+            bucket_end = datetime.fromtimestamp(
+                (bucket_id + 1) * SEARCH_RANKING_BUCKET, nowtime.tzinfo)
+            cache.set_many(seen_dict, _seen_timeout(bucket_end, nowtime))
+        cache.set_many(buckets, SEARCH_RANKING_WINDOW + SEARCH_RANKING_BUCKET)
+        cache.set(KEY_PREFIX + "recent", recent_list, SEARCH_RANKING_WINDOW)
+        cache.delete_many([KEY_PREFIX + "closed:" + str(_bucket_id(nowtime)),
+                           KEY_PREFIX + "top:" + str(SEARCH_RANKING_TOP)])
+        cache.set(KEY_PREFIX + "built", 1, SEARCH_RANKING_WINDOW)
+    _locked(update)
+    logger.info("検索ランキング再構築:" + str(len(history_list)) + "件")
@@ -0,0 +1,223 @@
+"""
+同一検索の多重実行防止(single-flight)
+
+同じキーの処理が実行中なら、後続のリクエストは処理をせずに
+その結果を待って受け取る。
+- LocalBackend: プロセス内(スレッド間)でのまとめ
+- CacheBackend: Djangoキャッシュ(Redis等)のロックでプロセス間もまとめる
+ロックにはTTLがあり、実行中のワーカーが落ちても自動で解除される。
+非同期ビューからは ado() を使う(同一イベントループ内でまとめる)。
+"""
+import asyncio
+import functools
+import logging
+import threading
+import time
+import uuid
+import weakref
+
+from django.conf import settings
+from django.core.cache import caches
+
+import comment.request_metrics as request_metrics
+
+logger = logging.getLogger(__name__)
+
+# 'local' または 'cache'
+SINGLEFLIGHT_BACKEND = getattr(settings, 'SEARCH_SINGLEFLIGHT_BACKEND', 'local')
+SINGLEFLIGHT_CACHE_ALIAS = getattr(settings, 'SEARCH_SINGLEFLIGHT_CACHE', 'default')
+# 実行中ロックの有効期間(秒)。これを過ぎたロックは無視される
+SINGLEFLIGHT_LOCK_TTL = getattr(settings, 'SEARCH_SINGLEFLIGHT_LOCK_TTL', 120)
+# 後続リクエストの待機上限(秒)
+SINGLEFLIGHT_WAIT_TIMEOUT = getattr(settings, 'SEARCH_SINGLEFLIGHT_WAIT_TIMEOUT', 60)
+
+KEY_PREFIX = "singleflight:"
+
+
+class SingleFlightTimeout(Exception):
+    """先行する処理の完了待ちがタイムアウトした"""
+    pass
+
+
+class _Flight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.started = time.monotonic()
+        self.result = None
+        self.error = None
+
+    def expired(self, lock_ttl):
+        return time.monotonic() - self.started > lock_ttl
+
+
+class LocalBackend:
+    """プロセス内のスレッド間で処理をまとめる"""
+
+    def __init__(self, lock_ttl=SINGLEFLIGHT_LOCK_TTL):
+        self.lock_ttl = lock_ttl
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.stats = {'leader': 0, 'follower': 0, 'timeout': 0}
+
+    def do(self, key, fn, timeout=SINGLEFLIGHT_WAIT_TIMEOUT):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None or flight.expired(self.lock_ttl):
+                flight = _Flight()
+                self._flights[key] = flight
+                leader = True
+                self.stats['leader'] += 1
+            else:
+                leader = False
+                self.stats['follower'] += 1
+
+        if leader:
+            try:
+                flight.result = fn()
+                return flight.result
+            except Exception as e:
+                flight.error = e
+                raise
+            finally:
+                with self._lock:
+                    if self._flights.get(key) is flight:
+                        del self._flights[key]
+                flight.event.set()
+
+        waited = time.perf_counter()
+        done = flight.event.wait(timeout)
+        request_metrics.add('lock', time.perf_counter() - waited)
+        if not done:
+            self.count('timeout')
+            raise SingleFlightTimeout(key)
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+
+class CacheBackend:
+    """共有キャッシュのロックでプロセス間の処理をまとめる
+
+    同一プロセス内の後続は LocalBackend で待ち、他プロセスの後続は
+    キャッシュ上の結果を間隔を伸ばしながら確認する。
+    """
+    POLL_INTERVAL = 0.05
+    POLL_INTERVAL_MAX = 0.5
+
+    def __init__(self, alias=SINGLEFLIGHT_CACHE_ALIAS, lock_ttl=SINGLEFLIGHT_LOCK_TTL):
+        self.alias = alias
+        self.lock_ttl = lock_ttl
+        self._local = LocalBackend(lock_ttl)
+        self.stats = self._local.stats
+
+    def do(self, key, fn, timeout=SINGLEFLIGHT_WAIT_TIMEOUT):
+        return self._local.do(key, lambda: self._shared_do(key, fn, timeout), timeout)
+
+    def _shared_do(self, key, fn, timeout):
+        cache = caches[self.alias]
+        lock_key = KEY_PREFIX + "lock:" + key
+        deadline = time.monotonic() + timeout
+        while True:
+            token = uuid.uuid4().hex
+            if cache.add(lock_key, token, self.lock_ttl):
+                try:
+                    result = fn()
+                    cache.set(KEY_PREFIX + "result:" + key + ":" + token,
+                              result, self.lock_ttl)
+                    return result
+                finally:
+                    if cache.get(lock_key) == token:
+                        cache.delete(lock_key)
+
+            # 他プロセスが実行中。結果が出るかロックが消えるまで待つ
+            with request_metrics.timer('lock'):
+                token = cache.get(lock_key)
+                interval = self.POLL_INTERVAL
+                while token is not None:
+                    result = cache.get(KEY_PREFIX + "result:" + key + ":" + token)
+                    if result is not None:
+                        return result
+                    if time.monotonic() > deadline:
+                        self._local.count('timeout')
+                        raise SingleFlightTimeout(key)
+                    time.sleep(interval)
+                    interval = min(interval * 2, self.POLL_INTERVAL_MAX)
+                    if cache.get(lock_key) != token:
+                        # 結果を保存してからロックを外すため、最後にもう一度確認
+                        result = cache.get(
+                            KEY_PREFIX + "result:" + key + ":" + token)
+                        if result is not None:
+                            return result
+                        token = None
+            # 先行処理が失敗・異常終了した場合は自分で実行する
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """設定に応じた共有インスタンス"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if SINGLEFLIGHT_BACKEND == 'cache':
+                    _backend = CacheBackend()
+                else:
+                    _backend = LocalBackend()
+    return _backend
+
+
+def set_backend(backend):
+    """バックエンドの差し替え(テスト用)"""
+    global _backend
+    _backend = backend
+
+
+def do(key, fn, timeout=SINGLEFLIGHT_WAIT_TIMEOUT):
+    """key の処理を1回だけ実行し、同時リクエストには同じ結果を返す"""
+    return get_backend().do(key, fn, timeout)
+
+
+# イベントループごとの実行中の処理 (key -> Task)
+_async_flights = weakref.WeakKeyDictionary()
+async_stats = {'leader': 0, 'follower': 0, 'timeout': 0}
+
+
+def _async_done(flights, key, flight):
+    if flights.get(key) is flight:
+        del flights[key]
+    # 待機者がいない場合の未取得警告を抑止
+    if not flight.cancelled():
+        flight.exception()
+
+
+async def ado(key, coro_fn, timeout=SINGLEFLIGHT_WAIT_TIMEOUT):
+    """do() の非同期版。coro_fn() のコルーチンを1回だけ実行する
+
+    まとめるのは同一イベントループ内のリクエストのみ。
+    処理は独立したタスクで実行し、先行リクエストが切断等でキャンセルされても
+    止めずに後続へ結果を渡す(キャンセルされるのは各リクエストの待機のみ)。
+    """
+    loop = asyncio.get_running_loop()
+    flights = _async_flights.setdefault(loop, {})
+    flight = flights.get(key)
+    if flight is None:
+        async_stats['leader'] += 1
+        flight = loop.create_task(coro_fn())
+        flights[key] = flight
+        flight.add_done_callback(functools.partial(_async_done, flights, key))
+        return await asyncio.shield(flight)
+
+    async_stats['follower'] += 1
+    try:
+        with request_metrics.timer('lock'):
+            return await asyncio.wait_for(asyncio.shield(flight), timeout)
+    except asyncio.TimeoutError:
+        async_stats['timeout'] += 1
+        raise SingleFlightTimeout(key)
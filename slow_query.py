@@ -0,0 +1,303 @@
+"""
+遅い検索の記録
+
+検索1回(動画検索の fill、コメントの1ページ取得)の処理時間が閾値を超えたら、
+クエリを形(シグネチャ)に正規化して、形ごとに件数・処理時間・ES took・
+ES検索回数を共有キャッシュに集計する。
+シグネチャは検索語の種類(ngram / kuromoji / symbol / wildcard、除外語は先頭に -)、
+チャンネル条件・除外チャンネル条件の数、検索期間の長さ、並び順など。
+記録した検索の一部(SLOW_QUERY_PROFILE_RATE)は "profile": true で
+バックグラウンドで再実行し、シャードごとの内訳を保存する。再実行は同時に
+SLOW_QUERY_PROFILE_MAX_PENDING 件までとし、それを超える分とタイムアウトした
+検索は再実行しない。
+集計は slow_query_report コマンドで合計時間の順に表示する。
+"""
+import hashlib
+import logging
+import random
+import threading
+import time
+import uuid
+from concurrent import futures
+from datetime import datetime, timezone, timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+
+import comment.es_client as es_client
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_CACHE_ALIAS = getattr(settings, 'SLOW_QUERY_CACHE_ALIAS', 'default')
+# 記録する処理時間の閾値(秒)
+SLOW_QUERY_THRESHOLD = getattr(settings, 'SLOW_QUERY_THRESHOLD', 1.0)
+# 記録した検索を profile 付きで再実行する割合(0で無効)
+SLOW_QUERY_PROFILE_RATE = getattr(settings, 'SLOW_QUERY_PROFILE_RATE', 0.05)
+# シグネチャごとに保持する profile 結果の数
+SLOW_QUERY_PROFILE_KEEP = getattr(settings, 'SLOW_QUERY_PROFILE_KEEP', 5)
+# profile 付き再実行の実行中・待ちの上限(超える分は再実行しない)
+SLOW_QUERY_PROFILE_MAX_PENDING = getattr(settings, 'SLOW_QUERY_PROFILE_MAX_PENDING', 1)
+# 集計するシグネチャ数の上限
+SLOW_QUERY_MAX_SIGNATURES = getattr(settings, 'SLOW_QUERY_MAX_SIGNATURES', 500)
+# 集計の保持期間(秒)
+SLOW_QUERY_TTL = getattr(settings, 'SLOW_QUERY_TTL', 7 * 24 * 60 * 60)
+
+KEY_PREFIX = "slow_query:"
+LOCK_TTL = 5
+
+# 検索語のフィールドと種類
+TERM_KINDS = {
+    ('match_phrase', 'message'): 'kuromoji',
+    ('match_phrase', 'message.ngram'): 'ngram',
+    ('match_phrase', 'message.symbol'): 'symbol',
+    ('wildcard', 'message.wildcard'): 'wildcard',
+    ('wildcard', 'video_title.wildcard'): 'title',
+}
+# 検索期間の長さの区分 (上限日数, 表示)
+WINDOW_LABELS = ((1, "1d"), (7, "7d"), (31, "31d"), (92, "92d"), (366, "1y"))
+
+# profile 付き再実行用(検索リクエストの処理を待たせない)
+profile_executor = futures.ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix='slow_query_profile')
+_profile_slots = threading.BoundedSemaphore(SLOW_QUERY_PROFILE_MAX_PENDING)
+
+
+def _cache():
+    return caches[SLOW_QUERY_CACHE_ALIAS]
+
+
+def _walk(clause, negative, shape):
+    for kind, condition in clause.items():
+        if kind == 'bool':
+            for name in ('must', 'filter', 'should'):
+                for child in condition.get(name, []):
+                    _walk(child, negative, shape)
+            for child in condition.get('must_not', []):
+                _walk(child, not negative, shape)
+        elif kind == 'range':
+            for field, bounds in condition.items():
+                shape['range'].setdefault(field, {}).update(bounds)
+        elif isinstance(condition, dict):
+            for field in condition:
+                if field == 'video_channel_id':
+                    shape['ex_channels' if negative else 'channels'] += 1
+                elif field == 'video_id':
+                    shape['target'] = 'comment'
+                else:
+                    term = TERM_KINDS.get((kind, field), kind + ":" + field)
+                    shape['terms'].append(("-" if negative else "") + term)
+
+
+def _window_label(bounds):
+    if 'gt' not in bounds and 'gte' not in bounds:
+        return "open"
+    start = bounds.get('gt', bounds.get('gte'))
+    end = bounds.get('lte', bounds.get('lt'))
+    if end is None:
+        return "open"
+    days = (end - start) / (24 * 60 * 60 * 1000)
+    for limit, label in WINDOW_LABELS:
+        if days <= limit:
+            return label
+    return ">1y"
+
+
+def _sort_label(query):
+    group = (query.get('aggs') or {}).get('group_by_video_id')
+    if group and 'composite' in group:
+        (name, source), = group['composite']['sources'][0].items()
+        terms = source['terms']
+        label = terms['field'] + ":" + terms.get('order', 'asc')
+    elif group and 'terms' in group:
+        label = "count"
+    elif query.get('aggs'):
+        label = "aggs:" + ",".join(sorted(query['aggs']))
+    else:
+        label = ",".join(list(item)[0] if isinstance(item, dict) else item
+                         for item in query.get('sort') or []) or "score"
+    return label
+
+
+def signature(query):
+    """クエリの形を表す文字列
+
+    検索語の値・チャンネルID・期間の日時・after などの値は含めない。
+    """
+    shape = {'target': 'video', 'terms': [], 'channels': 0, 'ex_channels': 0, 'range': {}}
+    _walk(query.get('query') or {}, False, shape)
+    group = (query.get('aggs') or {}).get('group_by_video_id') or {}
+
+    parts = [shape['target'], "sort=" + _sort_label(query),
+             "terms=" + ",".join(sorted(shape['terms']))]
+    if shape['channels']:
+        parts.append("channels=" + str(shape['channels']))
+    if shape['ex_channels']:
+        parts.append("ex_channels=" + str(shape['ex_channels']))
+    if 'video_publishedat' in shape['range']:
+        parts.append("window=" + _window_label(shape['range']['video_publishedat']))
+    if 'aggs' in group or 'min_doc_count' in group.get('terms', {}):
+        parts.append("least_count")
+    return " ".join(parts)
+
+
+def signature_id(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+def is_slow(elapsed):
+    return elapsed >= SLOW_QUERY_THRESHOLD
+
+
+def _locked(fn):
+    """集計更新の排他(キャッシュのロック。取れない場合も短時間で実行する)"""
+    cache = _cache()
+    lock_key = KEY_PREFIX + "lock"
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + 1
+    while not cache.add(lock_key, token, LOCK_TTL):
+        if time.monotonic() > deadline:
+            logger.info("遅い検索の集計のロック待ちタイムアウト")
+            token = None
+            break
+        time.sleep(0.01)
+    try:
+        return fn()
+    finally:
+        if token and cache.get(lock_key) == token:
+            cache.delete(lock_key)
+
+
+def record(index, query, elapsed, pages, took, timed_out=False):
+    """検索1回の結果を記録する(閾値未満は何もしない)
+
+    elapsed は処理時間(秒)、pages はES検索回数、took はESの took の合計(ミリ秒)。
+    timed_out はES側でタイムアウトした検索を含むか(profile 付きで再実行しない)。
+    """
+    if not is_slow(elapsed) or not query:
+        return
+    text = signature(query)
+    sig_id = signature_id(text)
+    logger.warning("遅い検索:%.2f秒,ES%d回,took=%dms,%s" % (elapsed, pages, took, text))
+    now = datetime.now(timezone(timedelta(hours=9)))
+
+    def update():
+        cache = _cache()
+        index_list = cache.get(KEY_PREFIX + "index") or []
+        entry = cache.get(KEY_PREFIX + "sig:" + sig_id)
+        if entry is None:
+            if len(index_list) >= SLOW_QUERY_MAX_SIGNATURES:
+                return
+            entry = {'id': sig_id, 'signature': text, 'count': 0, 'total_time': 0.0,
+                     'max_time': 0.0, 'total_took': 0, 'total_pages': 0}
+        entry['count'] += 1
+        entry['total_time'] += elapsed
+        entry['max_time'] = max(entry['max_time'], elapsed)
+        entry['total_took'] += took
+        entry['total_pages'] += pages
+        entry['last_at'] = now
+        entry['sample_index'] = index
+        entry['sample_query'] = query
+        cache.set(KEY_PREFIX + "sig:" + sig_id, entry, SLOW_QUERY_TTL)
+        if sig_id not in index_list:
+            index_list.append(sig_id)
+            cache.set(KEY_PREFIX + "index", index_list, SLOW_QUERY_TTL)
+    _locked(update)
+
+    if not timed_out and SLOW_QUERY_PROFILE_RATE and random.random() < SLOW_QUERY_PROFILE_RATE:
+        submit_profile(sig_id, index, query)
+
+
+def submit_profile(sig_id, index, query):
+    """profile 付き再実行の開始(上限まで実行中・待ちがある場合は何もしない)"""
+    if not _profile_slots.acquire(blocking=False):
+        logger.info("遅い検索のprofile省略(実行中):" + sig_id)
+        return None
+    try:
+        future = profile_executor.submit(profile, sig_id, index, query)
+    except RuntimeError:
+        _profile_slots.release()
+        return None
+    future.add_done_callback(lambda future: _profile_slots.release())
+    return future
+
+
+def _profile_node(node, depth=0):
+    result = {
+        'type': node.get('type') or node.get('name'),
+        'description': (node.get('description') or node.get('reason') or "")[:200],
+        'time_ms': node.get('time_in_nanos', 0) / 1000000,
+    }
+    breakdown = {key: value / 1000000 for key, value in (node.get('breakdown') or {}).items()
+                 if not key.endswith('_count') and value}
+    if breakdown:
+        result['breakdown_ms'] = breakdown
+    if depth < 3 and node.get('children'):
+        result['children'] = [_profile_node(child, depth + 1) for child in node['children']]
+    return result
+
+
+def summarize_profile(result):
+    """profile 結果のシャードごとの内訳(クエリ・コレクタ・集計の時間)"""
+    shards = []
+    for shard in (result.get('profile') or {}).get('shards', []):
+        query_nodes = []
+        collectors = []
+        for search in shard.get('searches', []):
+            query_nodes += [_profile_node(node) for node in search.get('query', [])]
+            collectors += [_profile_node(node) for node in search.get('collector', [])]
+        aggregations = [_profile_node(node) for node in shard.get('aggregations', [])]
+        shards.append({
+            'id': shard.get('id'),
+            'query_ms': sum(node['time_ms'] for node in query_nodes),
+            'collector_ms': sum(node['time_ms'] for node in collectors),
+            'aggregation_ms': sum(node['time_ms'] for node in aggregations),
+            'query': query_nodes,
+            'collector': collectors,
+            'aggregations': aggregations,
+        })
+    shards.sort(key=lambda shard: shard['query_ms'] + shard['aggregation_ms'], reverse=True)
+    return {'took': result.get('took'), 'shards': shards}
+
+
+def profile(sig_id, index, query):
+    """クエリを profile 付きで再実行し、内訳を保存する"""
+    try:
+        result = es_client.search(index, dict(query, profile=True))
+    except Exception:
+        logger.info("遅い検索のprofile失敗:" + sig_id, exc_info=True)
+        return None
+    if result.get('timed_out'):
+        logger.info("遅い検索のprofileタイムアウト:" + sig_id)
+        return None
+    summary = summarize_profile(result)
+    summary['at'] = datetime.now(timezone(timedelta(hours=9)))
+
+    def update():
+        cache = _cache()
+        profiles = cache.get(KEY_PREFIX + "profile:" + sig_id) or []
+        profiles.insert(0, summary)
+        cache.set(KEY_PREFIX + "profile:" + sig_id,
+                  profiles[:SLOW_QUERY_PROFILE_KEEP], SLOW_QUERY_TTL)
+    _locked(update)
+    return summary
+
+
+def report():
+    """シグネチャごとの集計(合計処理時間の降順)"""
+    cache = _cache()
+    index_list = cache.get(KEY_PREFIX + "index") or []
+    entries = cache.get_many([KEY_PREFIX + "sig:" + sig_id for sig_id in index_list])
+    return sorted(entries.values(), key=lambda entry: entry['total_time'], reverse=True)
+
+
+def profiles(sig_id):
+    """シグネチャの profile 結果(新しい順)"""
+    return _cache().get(KEY_PREFIX + "profile:" + sig_id) or []
+
+
+def clear():
+    cache = _cache()
+    index_list = cache.get(KEY_PREFIX + "index") or []
+    cache.delete_many([KEY_PREFIX + "sig:" + sig_id for sig_id in index_list] +
+                      [KEY_PREFIX + "profile:" + sig_id for sig_id in index_list] +
+                      [KEY_PREFIX + "index"])
@@ -0,0 +1,479 @@
+import asyncio
+import json
+import threading
+import time
+from datetime import datetime, timezone, timedelta
+from unittest import mock
+
+from django.core.cache import caches
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+
+from comment.models import Channel, ChannelGroup, SearchHistory, Video
+import comment.collector as collector
+import comment.index_alias as index_alias
+import comment.index_router as index_router
+import comment.search_cache as search_cache
+import comment.search_ranking as search_ranking
+import comment.singleflight as singleflight
+import comment.views as views
+from comment.utils import commentall_index, mycommentall_index
+
+JST = timezone(timedelta(hours=9))
+LOCMEM_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                'LOCATION': 'comment_tests'},
+}
+
+
+def create_videos(count, channels=3):
+    group = ChannelGroup.objects.create(groupName="テスト", no=1)
+    channel_list = [Channel.objects.create(id="UCtest%04d" % i, channelName="チャンネル" + str(i),
+                                           group=group, no=i)
+                    for i in range(channels)]
+    start = datetime(2021, 1, 1, tzinfo=JST)
+    video_list = []
+    for i in range(count):
+        video_list.append(Video(id="vtest%04d" % i, channel=channel_list[i % channels],
+                                title="動画" + str(i), description="",
+                                publishedAt=start + timedelta(days=i),
+                                collectedAt=start + timedelta(days=i + 1),
+                                enable=(i % 5 != 4), public=True))
+    Video.objects.bulk_create(video_list)
+    return [video.id for video in video_list]
+
+
+class BulkVideosTest(TestCase):
+
+    def test_keeps_es_order(self):
+        video_ids = create_videos(6)
+        order = [video_ids[3], video_ids[0], video_ids[5], video_ids[1]]
+        self.assertEqual([video.id for video in views.bulk_videos(order)], order)
+
+    def test_skips_unknown_and_disabled(self):
+        video_ids = create_videos(6)
+        order = ["unknown", video_ids[4], video_ids[2]]
+        self.assertEqual([video.id for video in views.bulk_videos(order)],
+                         [video_ids[4], video_ids[2]])
+        self.assertEqual([video.id for video in views.bulk_videos(order, enable_only=True)],
+                         [video_ids[2]])
+
+    def test_query_count_does_not_depend_on_page_size(self):
+        video_ids = create_videos(40, channels=8)
+        for size in (1, 10, 40):
+            with self.assertNumQueries(1):
+                videos = views.bulk_videos(video_ids[:size])
+                [video.channel.channelName for video in videos]
+
+    def test_make_video_rows_query_count(self):
+        video_ids = create_videos(30, channels=6)
+        view = views.VideoListES()
+        for size in (3, 30):
+            page_items = [(video_id, i + 1) for i, video_id in enumerate(reversed(video_ids[:size]))]
+            with self.assertNumQueries(1):
+                rows = view.make_video_rows(page_items, None, False)
+            self.assertEqual([row.video_id for row in rows],
+                             [video_id for video_id, _ in page_items])
+            self.assertEqual(rows[0].channelName, Video.objects.get(
+                id=page_items[0][0]).channel.channelName)
+
+
+def snippet(video_id, title=None, scheduled="2021-01-01T12:00:00Z"):
+    item = {'snippet': {'title': title or "動画" + video_id,
+                        'publishedAt': "2021-01-01T00:00:00Z"}}
+    if scheduled is not None:
+        item['liveStreamingDetails'] = {'scheduledStartTime': scheduled}
+    return [video_id, item]
+
+
+class CollectorTest(TestCase):
+
+    def setUp(self):
+        group = ChannelGroup.objects.create(groupName="テスト", no=1)
+        self.channel = Channel.objects.create(id="UCcollect", channelName="チャンネル",
+                                              group=group, no=1, etag="etag1")
+        for video_id in ("v1", "v2", "v3"):
+            Video.objects.create(id=video_id, channel=self.channel, title="動画" + video_id,
+                                 description="", publishedAt=datetime(2021, 1, 1, tzinfo=JST),
+                                 scheduledStartTime="2021-01-01T12:00:00Z",
+                                 enable=True, public=True)
+        patchers = [mock.patch.object(collector, 'yt'),
+                    mock.patch.object(collector, 'check_video'),
+                    mock.patch.object(collector, 'api_limiter', collector.RateLimiter(0)),
+                    mock.patch.object(collector.video_availability, 'invalidate')]
+        self.yt, self.check_video, _, self.invalidate = [patcher.start() for patcher in patchers]
+        for patcher in patchers:
+            self.addCleanup(patcher.stop)
+
+    def test_etag_unchanged(self):
+        self.yt.get_video_id_list_by_playlist_id.return_value = ("etag1", [])
+        result = collector.collect_channel(self.channel, new_flag=False)
+        self.yt.get_video_id_list_by_playlist_id.assert_called_once_with(
+            "UCcollect", True, "etag1")
+        self.yt.get_video_snippet_list.assert_not_called()
+        self.check_video.assert_not_called()
+        self.assertEqual((result['playlist'], result['new'], result['changed']), (0, 0, 0))
+        self.assertIsNone(result['error'])
+        self.assertEqual(Channel.objects.get(id="UCcollect").etag, "etag1")
+
+    def test_unchanged_videos_are_not_checked(self):
+        self.yt.get_video_id_list_by_playlist_id.return_value = ("etag2", ["v1", "v2", "v3"])
+        self.yt.get_video_snippet_list.return_value = [snippet("v1"), snippet("v2"), snippet("v3")]
+        result = collector.collect_channel(self.channel)
+        self.check_video.assert_not_called()
+        self.invalidate.assert_not_called()
+        self.assertEqual((result['rechecked'], result['changed']), (3, 0))
+        self.assertEqual(Channel.objects.get(id="UCcollect").etag, "etag2")
+
+    def test_status_change(self):
+        Video.objects.filter(id="v3").update(public=False)
+        self.yt.get_video_id_list_by_playlist_id.return_value = (
+            "etag2", ["new1", "v1", "v2", "v3", "new1"])
+        # v1 は非公開・削除、v3 は再公開
+        self.yt.get_video_snippet_list.side_effect = [
+            [snippet("v2"), snippet("v3")],
+            [snippet("new1", scheduled=None)],
+        ]
+        result = collector.collect_channel(self.channel)
+        self.assertEqual(sorted(call.args[0].id for call in self.check_video.call_args_list),
+                         ["v1", "v3"])
+        self.assertEqual(sorted(self.invalidate.call_args.args[0]), ["v1", "v3"])
+        self.assertEqual((result['playlist'], result['new'], result['changed']), (4, 1, 2))
+        new_video = Video.objects.get(id="new1")
+        self.assertEqual(new_video.channel_id, "UCcollect")
+        self.assertFalse(new_video.enable)
+
+    def test_snippet_change(self):
+        self.yt.get_video_id_list_by_playlist_id.return_value = ("etag2", ["v1", "v2", "v3"])
+        self.yt.get_video_snippet_list.return_value = [
+            snippet("v1", title="新しいタイトル"),
+            snippet("v2", scheduled="2021-01-02T12:00:00Z"),
+            snippet("v3"),
+        ]
+        result = collector.collect_channel(self.channel)
+        self.assertEqual(sorted(call.args[0].id for call in self.check_video.call_args_list),
+                         ["v1", "v2"])
+        self.assertEqual(result['changed'], 2)
+
+
+class MetricsAllowedTest(SimpleTestCase):
+
+    def allowed(self, **extra):
+        return views.metrics_allowed(RequestFactory().get('/metrics', **extra))
+
+    def test_default_denies(self):
+        with mock.patch.object(views, 'METRICS_ALLOWED_IPS', ()), \
+                mock.patch.object(views, 'METRICS_TOKEN', ''):
+            self.assertFalse(self.allowed(REMOTE_ADDR='127.0.0.1'))
+
+    def test_client_ip_and_token(self):
+        with mock.patch.object(views, 'METRICS_ALLOWED_IPS', ('10.0.0.5',)), \
+                mock.patch.object(views, 'METRICS_TOKEN', 'secret'):
+            self.assertTrue(self.allowed(REMOTE_ADDR='10.0.0.5'))
+            self.assertFalse(self.allowed(REMOTE_ADDR='10.0.0.1'))
+            # リバースプロキシ経由は転送元のIPで判定する
+            self.assertFalse(self.allowed(REMOTE_ADDR='10.0.0.5',
+                                          HTTP_X_FORWARDED_FOR='203.0.113.9'))
+            self.assertTrue(self.allowed(REMOTE_ADDR='10.0.0.1', HTTP_AUTHORIZATION='Bearer secret'))
+            self.assertFalse(self.allowed(REMOTE_ADDR='10.0.0.1', HTTP_AUTHORIZATION='Bearer x'))
+
+
+class RouteIndexTest(SimpleTestCase):
+    now = datetime(2022, 12, 20, tzinfo=JST)
+
+    def route(self, start, end, **kwargs):
+        return index_router.route_index(start, end, nowtime=self.now, **kwargs)
+
+    def test_recent(self):
+        self.assertEqual(self.route(self.now - timedelta(days=3), self.now),
+                         index_router.commentrecent_index)
+
+    def test_half_years(self):
+        self.assertEqual(self.route(datetime(2020, 3, 1, tzinfo=JST),
+                                    datetime(2020, 4, 1, tzinfo=JST)), "comment_2020_1h")
+        self.assertEqual(self.route(datetime(2020, 6, 15, tzinfo=JST),
+                                    datetime(2021, 2, 1, tzinfo=JST)),
+                         "comment_2020_1h,comment_2020_2h,comment_2021_1h")
+        self.assertEqual(self.route(datetime(2022, 1, 10, tzinfo=JST),
+                                    datetime(2022, 8, 1, tzinfo=JST)),
+                         "comment_2022_1h,comment_2022_2h")
+
+    def test_2021(self):
+        # 2021年上期は comment_2021_1h(cooment_2021_1h ではない)
+        self.assertEqual(self.route(datetime(2021, 2, 1, tzinfo=JST),
+                                    datetime(2021, 3, 1, tzinfo=JST)), "comment_2021_1h")
+        # 2021年下期のインデックスはないため commentall
+        for start, end in ((datetime(2021, 8, 1), datetime(2021, 9, 1)),
+                           (datetime(2021, 5, 1), datetime(2022, 2, 1)),
+                           (datetime(2021, 1, 1), datetime(2021, 12, 31))):
+            self.assertEqual(self.route(start.replace(tzinfo=JST), end.replace(tzinfo=JST)),
+                             commentall_index)
+        self.assertIsNone(index_router.partition_index(2021, 2))
+
+    def test_out_of_range(self):
+        self.assertEqual(self.route(datetime(2017, 12, 1, tzinfo=JST),
+                                    datetime(2018, 2, 1, tzinfo=JST)), "comment_2018_1h")
+        self.assertEqual(self.route(datetime(2022, 11, 1, tzinfo=JST),
+                                    datetime(2023, 1, 5, tzinfo=JST)), commentall_index)
+        self.assertEqual(self.route(None, None), commentall_index)
+        self.assertEqual(self.route(None, None, my_flag=True), mycommentall_index)
+
+    def test_alias_names(self):
+        # 再作成の対象は経路の表と同じ実在のインデックス
+        names = index_alias.alias_names()
+        self.assertIn(mycommentall_index, names)
+        self.assertIn("comment_2021_1h", names)
+        self.assertNotIn("comment_2021_2h", names)
+        self.assertNotIn("cooment_2021_1h", names)
+        self.assertEqual(names[-len(index_router.partition_names()):], index_router.partition_names())
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SearchCacheTest(SimpleTestCase):
+
+    def signature(self, keyword="草 www", channels=(), **kwargs):
+        conditions = dict(liverNameId=None, ex_channelList=[], mode='1',
+                          search_datatime_start_str='', search_datatime_end_str='',
+                          sort_mode='0', least_count=None, title_keyword='', my_flag=False)
+        conditions.update(kwargs)
+        return search_cache.make_signature(keyword, channelList=list(channels), **conditions)
+
+    def test_signature_normalization(self):
+        self.assertEqual(self.signature("草 www"), self.signature("  草　　www "))
+        self.assertEqual(self.signature(channels=[3, 1, 2]), self.signature(channels=["1", "2", "3"]))
+        self.assertEqual(self.signature("😂"), self.signature(":face_with_tears_of_joy:"))
+        self.assertEqual(self.signature(my_flag=None), self.signature(my_flag=False))
+        self.assertNotEqual(self.signature("草 www"), self.signature("www 草"))
+        self.assertNotEqual(self.signature(), self.signature(sort_mode='1'))
+        self.assertNotEqual(self.signature(), self.signature(title_keyword="歌"))
+        self.assertNotEqual(self.signature(), self.signature(my_flag=True))
+
+    def test_load_store(self):
+        signature = self.signature()
+        before = search_cache.stats()
+        self.assertIsNone(search_cache.load(signature))
+        state = {'items': [["v1", 3], ["v2", 1]], 'after_key': None}
+        search_cache.store(signature, state, 60)
+        self.assertEqual(search_cache.load(signature), state)
+        # 上限を超える件数は保存しない
+        large = self.signature("大量")
+        search_cache.store(large, {'items': [["v", 1]] * (search_cache.SEARCH_CACHE_MAX_ITEMS + 1)}, 60)
+        self.assertIsNone(search_cache.load(large))
+        after = search_cache.stats()
+        self.assertEqual((after['hit'] - before['hit'], after['miss'] - before['miss'],
+                          after['set'] - before['set']), (1, 2, 1))
+
+    def test_timeout(self):
+        now = datetime(2022, 6, 1, tzinfo=JST)
+        self.assertEqual(search_cache.timeout_for('0', now - timedelta(days=1), now),
+                         search_cache.SEARCH_CACHE_TTL_RECENT)
+        self.assertEqual(search_cache.timeout_for('1', None, now),
+                         search_cache.SEARCH_CACHE_TTL_RECENT)
+        self.assertEqual(search_cache.timeout_for('1', now - timedelta(days=1), now),
+                         search_cache.SEARCH_CACHE_TTL_CLOSED)
+
+    def test_metrics(self):
+        search_cache.load(self.signature("metrics"))
+        with mock.patch.object(views, 'metrics_allowed', return_value=True):
+            response = views.metrics(RequestFactory().get('/metrics'))
+        text = response.content.decode()
+        self.assertIn("# TYPE comment_search_cache_miss_total counter", text)
+        self.assertIn("comment_search_cache_hit_total ", text)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SearchRankingTest(SimpleTestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.now = datetime(2022, 6, 1, 12, tzinfo=JST)
+        caches['default'].set(search_ranking.KEY_PREFIX + "built", 1)
+
+    def history(self, keyword, clientIP, minutes=0):
+        return SearchHistory(keyword=keyword, clientIP=clientIP,
+                             searchAt=self.now - timedelta(minutes=minutes))
+
+    def test_record_many_concurrent(self):
+        # 同時に反映しても (キーワード, クライアントIP) ごとに1件だけ数える
+        batches = [[self.history(keyword, "10.0.0.%d" % (i % 4), minutes=i % 30)
+                    for i in range(40) for keyword in ("草", "www")]
+                   for _ in range(4)]
+        threads = [threading.Thread(target=search_ranking.record_many, args=(batch,))
+                   for batch in batches]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(search_ranking.top(self.now)), [("www", 4), ("草", 4)])
+
+        # 別の反映で来た新しい組だけ加算する
+        search_ranking.record_many([self.history("草", "10.0.0.1"), self.history("草", "10.0.0.9")])
+        caches['default'].delete(search_ranking.KEY_PREFIX + "top:" + str(search_ranking.SEARCH_RANKING_TOP))
+        self.assertEqual(dict(search_ranking.top(self.now))["草"], 5)
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timeout")
+        time.sleep(0.01)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SingleFlightTest(SimpleTestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.gate = threading.Event()
+        self.calls = []
+
+    def slow(self, value=42):
+        def fn():
+            self.calls.append(threading.current_thread().name)
+            self.gate.wait(5)
+            return value
+        return fn
+
+    def run_threads(self, count, target):
+        results = [None] * count
+
+        def run(i):
+            try:
+                results[i] = target()
+            except Exception as e:
+                results[i] = e
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def test_local_one_leader(self):
+        backend = singleflight.LocalBackend()
+        threads, results = self.run_threads(8, lambda: backend.do("k", self.slow()))
+        wait_until(lambda: backend.stats['follower'] == 7)
+        self.gate.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [42] * 8)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(backend.stats['leader'], 1)
+        # 完了後は新しく実行する
+        self.assertEqual(backend.do("k", lambda: 43), 43)
+
+    def test_local_error_is_shared(self):
+        backend = singleflight.LocalBackend()
+
+        def fail():
+            self.gate.wait(5)
+            raise ValueError("失敗")
+        threads, results = self.run_threads(3, lambda: backend.do("k", fail))
+        wait_until(lambda: backend.stats['follower'] == 2)
+        self.gate.set()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+    def test_local_waiter_timeout(self):
+        backend = singleflight.LocalBackend()
+        threads, results = self.run_threads(1, lambda: backend.do("k", self.slow()))
+        wait_until(lambda: self.calls)
+        with self.assertRaises(singleflight.SingleFlightTimeout):
+            backend.do("k", self.slow(), timeout=0.05)
+        self.assertEqual(backend.stats['timeout'], 1)
+        self.gate.set()
+        threads[0].join()
+        self.assertEqual(results, [42])
+
+    def test_local_expired_flight(self):
+        backend = singleflight.LocalBackend(lock_ttl=0.05)
+        threads, results = self.run_threads(1, lambda: backend.do("k", self.slow()))
+        wait_until(lambda: self.calls)
+        time.sleep(0.1)
+        # 期限切れの実行中は待たずに自分で実行する
+        self.assertEqual(backend.do("k", lambda: 7, timeout=0.05), 7)
+        self.gate.set()
+        threads[0].join()
+
+    def test_cache_between_processes(self):
+        # 別プロセスの代わりに、キャッシュを共有する2つのバックエンド
+        first = singleflight.CacheBackend('default')
+        second = singleflight.CacheBackend('default')
+        threads, results = self.run_threads(1, lambda: first.do("k", self.slow()))
+        wait_until(lambda: self.calls)
+        waiters, waiter_results = self.run_threads(3, lambda: second.do("k", self.slow(0)))
+        wait_until(lambda: second.stats['follower'] == 2)
+        self.gate.set()
+        for thread in threads + waiters:
+            thread.join()
+        self.assertEqual(results + waiter_results, [42] * 4)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_cache_stale_lock(self):
+        # 実行中に落ちたワーカーのロック(結果は保存されない)
+        backend = singleflight.CacheBackend('default', lock_ttl=1)
+        caches['default'].add(singleflight.KEY_PREFIX + "lock:k", "dead", 1)
+        started = time.monotonic()
+        self.assertEqual(backend.do("k", lambda: 5, timeout=5), 5)
+        self.assertGreaterEqual(time.monotonic() - started, 0.5)
+
+    def test_cache_waiter_timeout(self):
+        backend = singleflight.CacheBackend('default')
+        caches['default'].add(singleflight.KEY_PREFIX + "lock:k", "other", 60)
+        with self.assertRaises(singleflight.SingleFlightTimeout):
+            backend.do("k", lambda: 5, timeout=0.1)
+        self.assertEqual(backend.stats['timeout'], 1)
+
+    def test_async_leader_cancelled(self):
+        calls = []
+
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 42
+
+        async def main():
+            leader = asyncio.ensure_future(singleflight.ado("k", work))
+            await asyncio.sleep(0)
+            followers = [asyncio.ensure_future(singleflight.ado("k", work)) for _ in range(3)]
+            await asyncio.sleep(0)
+            leader.cancel()
+            results = await asyncio.gather(*followers)
+            return leader.cancelled(), results
+        cancelled, results = asyncio.run(main())
+        self.assertTrue(cancelled)
+        self.assertEqual(results, [42] * 3)
+        self.assertEqual(len(calls), 1)
+
+    def test_async_waiter_timeout(self):
+        async def work():
+            await asyncio.sleep(0.2)
+            return 1
+
+        async def main():
+            leader = asyncio.ensure_future(singleflight.ado("k", work))
+            await asyncio.sleep(0)
+            with self.assertRaises(singleflight.SingleFlightTimeout):
+                await singleflight.ado("k", work, timeout=0.01)
+            return await leader
+        self.assertEqual(asyncio.run(main()), 1)
+
+
+class TitleQueryTest(SimpleTestCase):
+
+    def test_substring_wildcards(self):
+        query = views.make_title_query("歌 -切り抜き　a*b")
+        self.assertEqual(query['bool']['should'], [
+            {"wildcard": {"video_title.wildcard": {"value": "*歌*"}}},
+            {"wildcard": {"video_title.wildcard": {"value": "*a\\*b*"}}},
+        ])
+        self.assertEqual(query['bool']['must_not'], [
+            {"wildcard": {"video_title.wildcard": {"value": "*切り抜き*"}}},
+        ])
+        self.assertIsNone(views.make_title_query("  "))
+
+    def test_disabled_by_default(self):
+        query = views.make_video_query_template("草", None, [], [], '0', 0, "歌")
+        self.assertNotIn("video_title", json.dumps(query))
+        with mock.patch.object(views, 'SEARCH_TITLE_FIELD', True):
+            query = views.make_video_query_template("草", None, [], [], '0', 0, "歌")
+        self.assertIn("video_title.wildcard", json.dumps(query))
@@ -0,0 +1,89 @@
+"""
+動画の公開状態の確認
+
+表示のたびに1件ずつ check_video() を呼ぶ代わりに、確認が必要な動画を
+まとめて videos.list(50件ずつ)で照会し、結果を一定時間キャッシュする。
+照会結果がDB上の公開状態と異なる動画だけ check_video() でDBを更新する。
+"""
+import logging
+
+from django.conf import settings
+from django.core.cache import caches
+
+import comment.youtube as yt
+from comment.utils import check_video
+
+logger = logging.getLogger(__name__)
+
+VIDEO_AVAILABILITY_CACHE_ALIAS = getattr(
+    settings, 'VIDEO_AVAILABILITY_CACHE_ALIAS', 'default')
+# 確認結果の保持期間(秒)
+VIDEO_AVAILABILITY_TTL = getattr(settings, 'VIDEO_AVAILABILITY_TTL', 10 * 60)
+# videos.list 1回で指定できる動画ID数
+VIDEO_BATCH_SIZE = 50
+
+KEY_PREFIX = "video_availability:"
+
+
+def _cache():
+    return caches[VIDEO_AVAILABILITY_CACHE_ALIAS]
+
+
+def available_ids(video_id_list):
+    """YouTube上で取得できる動画IDの集合(50件ずつ照会)"""
+    available = set()
+    for i in range(0, len(video_id_list), VIDEO_BATCH_SIZE):
+        chunk = video_id_list[i:i + VIDEO_BATCH_SIZE]
+        available.update(
+            video_id for video_id, _ in yt.get_video_snippet_list(chunk))
+    return available
+
+
+def _resolve(video_list):
+    """キャッシュにない動画の確認結果 {動画ID: 可否}"""
+    try:
+        available = available_ids([video.id for video in video_list])
+    except Exception:
+        logger.info("動画の一括確認失敗。個別に確認します", exc_info=True)
+        return {video.id: check_video(video) != False for video in video_list}
+
+    result = {}
+    for video in video_list:
+        if (video.id in available) != bool(video.public):
+            # 公開状態が変わった動画はDBを更新
+            result[video.id] = check_video(video) != False
+        else:
+            result[video.id] = video.id in available
+    return result
+
+
+def check_many(video_list):
+    """動画の確認結果 {動画ID: 可否}(キャッシュ済みのものは照会しない)"""
+    if not video_list:
+        return {}
+    cache = _cache()
+    cached = cache.get_many([KEY_PREFIX + video.id for video in video_list])
+    result = {}
+    missing = []
+    for video in video_list:
+        key = KEY_PREFIX + video.id
+        if key in cached:
+            result[video.id] = cached[key]
+        elif video.id not in result:
+            missing.append(video)
+            result[video.id] = None
+    if missing:
+        resolved = _resolve(missing)
+        cache.set_many({KEY_PREFIX + video_id: verdict for video_id, verdict in resolved.items()},
+                       VIDEO_AVAILABILITY_TTL)
+        result.update(resolved)
+    return result
+
+
+def check(video):
+    """1件の動画の確認結果"""
+    return check_many([video])[video.id]
+
+
+def invalidate(video_id_list):
+    _cache().delete_many([KEY_PREFIX + video_id for video_id in video_id_list])
@@ -1,6 +1,6 @@
-from .utils import commentall_index, mycomment_index, mycommentall_index
-from django.shortcuts import render, get_object_or_404, redirect
-from django.http import HttpResponse, HttpResponseRedirect
+from .utils import commentall_index, mycomment_index
+from django.shortcuts import get_object_or_404, redirect
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseRedirect, StreamingHttpResponse
 from datetime import datetime, date, timezone, timedelta
 from dateutil.relativedelta import relativedelta
 from concurrent import futures
@@ -13,10 +13,14 @@ from django.urls import reverse_lazy, reverse
 from django.contrib.auth.decorators import login_required
 from django.http.response import JsonResponse
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.core import signing
+from django.conf import settings
+import asyncio
+import contextvars
+import hmac
 import re
 
 import json
-import unicodedata
 from ipware import get_client_ip
 import emoji
 from urllib.parse import quote, unquote
@@ -27,21 +31,67 @@ from django.db.models import Count, Sum, Max, Min
 import logging
 from django.core.exceptions import ObjectDoesNotExist
 
-from comment.models import Channel, Video, Comment, Search as SearchKey, SearchHistory, LiverName, ChannelGroup
+from comment.models import Channel, Video, Comment, SearchHistory, LiverName, ChannelGroup
 
 from comment.forms import ChannelForm, SearchFormES, SearchFormMYES, SearchCommentForm
 import comment.youtube as yt
-
-from comment.utils import check_video, converttimestampText
-
-from vtuber.settings import ES_HOST
-
-# 非同期実行用
-executor = futures.ThreadPoolExecutor(max_workers=2)
+import comment.es_client as es_client
+
+from comment.utils import converttimestampText
+from comment.index_router import route_index
+import comment.search_cache as search_cache
+import comment.singleflight as singleflight
+import comment.channel_topology as channel_topology
+import comment.search_jobs as search_jobs
+import comment.keyword_analysis as keyword_analysis
+import comment.search_ranking as search_ranking
+import comment.history_writer as history_writer
+import comment.collector as collector
+import comment.video_availability as video_availability
+import comment.request_metrics as request_metrics
+import comment.slow_query as slow_query
+from comment.request_metrics import render
+
+# 全期間検索の期間先読み用
+window_executor = futures.ThreadPoolExecutor(
+    max_workers=8, thread_name_prefix='search_window')
 
 logger = logging.getLogger(__name__)
 
 PAGE_PER_ITEM = 10
+# コメント数条件があるときのcomposite集計1回あたりの取得数
+FILTERED_COMPOSITE_SIZE = PAGE_PER_ITEM * 10
+# 全期間検索で並列に先読みする期間(月)の数
+FANOUT_WINDOWS = 4
+# 次ページ用カーソルの有効期間(秒)
+CURSOR_MAX_AGE = 60 * 60
+# コメント一覧の取得単位と順序(動画内位置 + id をカーソルにする)
+COMMENT_SCAN_SIZE = 1000
+COMMENT_SORT = [{"videooffsettimemsec": {"order": "asc"}},
+                {"id": {"order": "asc"}}]
+COMMENT_SORT_DESC = [{"videooffsettimemsec": {"order": "desc"}},
+                     {"id": {"order": "desc"}}]
+# タイムライン(コメント密度)の区間幅(秒)の既定値と範囲
+COMMENT_TIMELINE_INTERVAL = 60
+COMMENT_TIMELINE_INTERVAL_MIN = 5
+COMMENT_TIMELINE_INTERVAL_MAX = 60 * 60
+# コメントの id(long)の最大値
+COMMENT_ID_MAX = 2 ** 63 - 1
+# タイトル条件をESのコメントの video_title.wildcard で絞り込む
+# (現在のマッピング・インデクサは video_title を持たないため False。False の場合、
+# タイトル条件は filter_videos での判定のみで、ES側の絞り込みは least_count のみ)
+SEARCH_TITLE_FIELD = getattr(settings, 'SEARCH_TITLE_FIELD', False)
+# 集計(metrics)を参照できる接続元IPと、Authorization: Bearer で渡すトークン
+# (スタッフのログインユーザーはどちらも不要。接続元IPは検索履歴と同じく get_client_ip で判定する。
+# 既定は空で、許可IPかトークンを設定しない限りスタッフ以外は参照できない)
+METRICS_ALLOWED_IPS = getattr(settings, 'METRICS_ALLOWED_IPS', ())
+METRICS_TOKEN = getattr(settings, 'METRICS_TOKEN', '')
+# 起動からの累計のため counter として出力する項目
+ES_COUNTER_KEYS = ('requests', 'retries', 'errors')
+HISTORY_COUNTER_KEYS = ('written', 'dropped', 'errors', 'batches')
+# コメント一覧で取得する項目
+COMMENT_SOURCE_FIELDS = ["message", "timestamptext",
+                         "date", "videooffsettimemsec"]
 # es_flag = True
 
 
@@ -70,7 +120,7 @@ class coment_list_es_redirect(View):
         return redirect(url)
 
 
-class CommentListES(ListView, ModelFormMixin):
+class CommentListES(request_metrics.RequestMetricsMixin, ListView, ModelFormMixin):
     model = Video
     form_class = SearchCommentForm
     success_url = reverse_lazy('comment:comment_list')
@@ -81,26 +131,38 @@ class CommentListES(ListView, ModelFormMixin):
         if MAINTENANCE:
             return redirect(reverse('comment:maintenance'))
         else:
-            self.initialize_variables()
-            self.set_keyword_and_initial_delay()
-            self.set_object_and_url()
-            if 'my_flag' not in kwargs:
-                if not self.is_video_valid():
-                    if self.object.enable == False:
-                        logger.info("コメント取得不可対象：" + self.object.title)
-                        message = "該当動画はコメント取得不可となった可能性があります。トップページからやり直してください。"
-                    else:
-                        logger.info("非公開対象：" + self.object.title)
-                        message = "該当動画が検索対象外になった可能性があります。トップページからやり直してください。"
-                    return self.render_error_message(message)
-            else:
-                if not self.object.enable or not self.object.public:
-                    self.object.title = "★" + self.object.title
-            self.set_liver_list_and_keyword()
+            response = self.prepare(kwargs)
+            if response:
+                return response
             if self.keyword:
+                if self.request.GET.get('timeline') == '1':
+                    return self.timeline_response()
+                if self.request.GET.get('stream') == '1':
+                    return self.stream_response()
                 self.fetch_and_process_comments()
             return self.render_response()
 
+    def prepare(self, kwargs):
+        """動画・キーワードの準備。表示不可の場合はエラー画面を返す"""
+        self.initialize_variables()
+        self.my_flag = 'my_flag' in kwargs
+        self.set_keyword_and_initial_delay()
+        self.set_object_and_url()
+        if 'my_flag' not in kwargs:
+            if not self.is_video_valid():
+                if self.object.enable == False:
+                    logger.info("コメント取得不可対象：" + self.object.title)
+                    message = "該当動画はコメント取得不可となった可能性があります。トップページからやり直してください。"
+                else:
+                    logger.info("非公開対象：" + self.object.title)
+                    message = "該当動画が検索対象外になった可能性があります。トップページからやり直してください。"
+                return self.render_error_message(message)
+        else:
+            if not self.object.enable or not self.object.public:
+                self.object.title = "★" + self.object.title
+        self.set_liver_list_and_keyword()
+        return None
+
     def initialize_variables(self):
         self.object = None
         self.object_list = []
@@ -110,6 +172,7 @@ class CommentListES(ListView, ModelFormMixin):
         self.initial_delay = None
         self.video_id = None
         self.index = None
+        self.page_obj = None
 
     def set_keyword_and_initial_delay(self):
         self.keyword = self.request.GET.get('keyword')
@@ -119,13 +182,14 @@ class CommentListES(ListView, ModelFormMixin):
         self.initial_delay = initial_delay if initial_delay else -10
 
     def set_object_and_url(self):
-        self.object = Video.objects.get(id=self.video_id)
+        self.object = Video.objects.select_related(
+            'channel__group').get(id=self.video_id)
         self.object.title = emoji.emojize(self.object.title)
         self.object.url = "https://www.youtube.com/embed/" + self.object.id
 
     def is_video_valid(self):
         # ビデオが有効かどうかをチェックする
-        check_result = check_video(self.object)
+        check_result = video_availability.check(self.object)
 
         # ビデオが有効でない、またはタイトルに特定の文字列が含まれている場合、ビデオは無効とします
         if not self.object.enable or not check_result or "メン限" in self.object.title or "メンバーシップ限定" in self.object.title:
@@ -152,9 +216,243 @@ class CommentListES(ListView, ModelFormMixin):
                 return self.render_error_message(message)
 
     def fetch_and_process_comments(self):
+        """コメントを1ページ分(paginate_by 件)取得する"""
+        query = self.make_comment_query()
+        if query is None:
+            return
+        cursor = self.load_cursor()
+        page_query = self.make_page_query(query, cursor)
+        started = time.monotonic()
+        result = es_client.search(self.index, page_query)
+        slow_query.record(self.index, page_query,
+                          time.monotonic() - started, 1, result.get('took', 0),
+                          result.get('timed_out', False))
+        self.process_page(result, cursor)
+
+    async def afetch_and_process_comments(self):
+        """fetch_and_process_comments() の非同期版"""
+        query = self.make_comment_query()
+        if query is None:
+            return
+        cursor = self.load_cursor()
+        page_query = self.make_page_query(query, cursor)
+        started = time.monotonic()
+        result = await es_client.async_search(self.index, page_query)
+        elapsed = time.monotonic() - started
+        if slow_query.is_slow(elapsed):
+            await request_metrics.sync_to_async(slow_query.record)(
+                self.index, page_query, elapsed, 1, result.get('took', 0),
+                result.get('timed_out', False))
+        self.process_page(result, cursor)
+
+    def load_cursor(self):
+        """前後ページのカーソル(動画・キーワードが一致しない場合は None)"""
+        token = self.request.GET.get('cursor')
+        if not token:
+            return None
+        try:
+            cursor = signing.loads(token, salt='comment.CommentListES.cursor',
+                                   max_age=CURSOR_MAX_AGE)
+        except signing.BadSignature:
+            return None
+        if cursor['video_id'] != self.object.id or cursor['keyword'] != self.keyword:
+            return None
+        return cursor
+
+    def make_cursor(self, hit, prev_flag):
+        return signing.dumps({'video_id': self.object.id, 'keyword': self.keyword,
+                              'after': hit['sort'], 'prev': prev_flag},
+                             salt='comment.CommentListES.cursor')
+
+    def jump_offset(self):
+        """指定時刻(t=秒 または h:mm:ss)へのジャンプ位置(ミリ秒)"""
+        value = self.request.GET.get('t')
+        if not value:
+            return None
+        try:
+            if value.isdigit():
+                return int(value) * 1000
+            return converttimestampText(value) * 1000
+        except ValueError:
+            return None
+
+    def make_page_query(self, query, cursor):
+        """動画内位置順の1ページ分のクエリ
+
+        カーソルがあればその前後から、なければ指定時刻(なければ先頭)から取得する。
+        次ページ有無の判定のため1件多く取得する。
+        """
+        query = dict(query)
+        query['size'] = self.paginate_by + 1
+        query['track_total_hits'] = True
+        if cursor:
+            query['sort'] = COMMENT_SORT_DESC if cursor['prev'] else COMMENT_SORT
+            query['search_after'] = cursor['after']
+        else:
+            query['sort'] = COMMENT_SORT
+            jump_offset = self.jump_offset()
+            if jump_offset:
+                # 件数は動画全体のままにするため条件ではなく取得位置で指定する
+                # (post_filter はヒット件数にも反映される)。id は long のため
+                # 直前の位置の最大値の後ろから取得する
+                query['search_after'] = [jump_offset - 1, COMMENT_ID_MAX]
+        return query
+
+    def process_page(self, result, cursor):
+        hits = result['hits']['hits']
+        more_flag = len(hits) > self.paginate_by
+        hits = hits[:self.paginate_by]
+        prev_flag = bool(cursor and cursor['prev'])
+        if prev_flag:
+            hits.reverse()
+
+        self.object_list = [self.make_comment(hit) for hit in hits]
+        self.object.count = result['hits']['total']['value']
+
+        page_obj = Empty()
+        if prev_flag:
+            page_obj.has_previous = more_flag
+            page_obj.has_next = True
+        else:
+            page_obj.has_previous = cursor is not None or bool(self.jump_offset())
+            page_obj.has_next = more_flag
+        page_obj.has_previous = page_obj.has_previous and bool(hits)
+        page_obj.has_next = page_obj.has_next and bool(hits)
+        if page_obj.has_previous:
+            page_obj.previous_cursor = self.make_cursor(hits[0], True)
+        if page_obj.has_next:
+            page_obj.next_cursor = self.make_cursor(hits[-1], False)
+        page_obj.url_options = ""
+        for key, value in self.request.GET.items():
+            if key in ('cursor', 't', 'stream'):
+                continue
+            page_obj.url_options += "&" + key + "=" + str(value)
+        self.page_obj = page_obj
+
+    def timeline_interval(self):
+        """タイムラインの区間幅(秒)"""
+        try:
+            interval = int(self.request.GET.get('interval'))
+        except (TypeError, ValueError):
+            return COMMENT_TIMELINE_INTERVAL
+        return min(max(interval, COMMENT_TIMELINE_INTERVAL_MIN), COMMENT_TIMELINE_INTERVAL_MAX)
+
+    def make_timeline_query(self, query, interval):
+        """動画内位置ごとのヒット件数(histogram集計のみ、ドキュメントは取得しない)"""
+        query = dict(query)
+        query.pop('_source', None)
+        query['size'] = 0
+        query['track_total_hits'] = True
+        query['aggs'] = {
+            "timeline": {
+                "histogram": {
+                    "field": "videooffsettimemsec",
+                    "interval": interval * 1000,
+                    "min_doc_count": 1
+                }
+            }
+        }
+        return query
+
+    def make_timeline(self, result, interval):
+        buckets = result['aggregations']['timeline']['buckets']
+        max_count = max([bucket['doc_count'] for bucket in buckets], default=0)
+        if self.my_flag:
+            list_url = reverse('comment:comment_list_my',
+                               kwargs=dict(pk=self.object.id))
+        else:
+            list_url = reverse('comment:comment_list_es',
+                               kwargs=dict(pk=self.object.id))
+        if self.liverNameId:
+            list_url += "?liverNameId=" + str(self.liverNameId)
+        else:
+            list_url += "?keyword=" + quote(self.keyword)
+
+        timeline = []
+        for bucket in buckets:
+            offset = int(bucket['key'] / 1000)
+            timestamp = offset + self.initial_delay
+            if timestamp < 0:
+                timestamp = 0
+            timeline.append({
+                'offset': offset,
+                'timestampText': format_offset(offset),
+                'count': bucket['doc_count'],
+                # ヒートマップ表示用(最多の区間を1とした割合)
+                'level': bucket['doc_count'] / max_count,
+                'link': "https://youtu.be/" + self.object.id + "?t=" + str(timestamp),
+                'list_url': list_url + "&t=" + str(max(offset, 0)),
+            })
+        return {
+            'video_id': self.object.id,
+            'interval': interval,
+            'count': result['hits']['total']['value'],
+            'max_count': max_count,
+            'timeline': timeline,
+        }
+
+    def timeline_response(self):
+        """キーワードのヒット件数を動画内位置の区間ごとに集計したJSON"""
+        query = self.make_comment_query()
+        if query is None:
+            return JsonResponse({'message': "不正な検索ワードです。"}, status=400)
+        interval = self.timeline_interval()
+        result = es_client.search(
+            self.index, self.make_timeline_query(query, interval))
+        return JsonResponse(self.make_timeline(result, interval))
+
+    async def atimeline_response(self):
+        """timeline_response() の非同期版"""
+        query = self.make_comment_query()
+        if query is None:
+            return JsonResponse({'message': "不正な検索ワードです。"}, status=400)
+        interval = self.timeline_interval()
+        result = await es_client.async_search(
+            self.index, self.make_timeline_query(query, interval))
+        return JsonResponse(self.make_timeline(result, interval))
+
+    def stream_query(self):
+        """ストリーミング用のクエリ(不正なキーワードの場合は None)"""
+        query = self.make_comment_query()
+        if query is None:
+            return None
+        jump_offset = self.jump_offset()
+        if jump_offset:
+            query["query"]["bool"]["filter"].append(
+                {"range": {"videooffsettimemsec": {"gte": jump_offset}}})
+        return query
+
+    def make_comment_row(self, hit):
+        obj = self.make_comment(hit)
+        return json.dumps({'message': obj.message, 'timestampText': obj.timestampText,
+                           'link': obj.link, 'date': obj.date}, ensure_ascii=False) + "\n"
+
+    def stream_response(self):
+        """全コメントをESから届いた順に1行1件のJSONで返す(全件をメモリに持たない)"""
+        query = self.stream_query()
+        if query is None:
+            return HttpResponse(status=400)
+
+        def rows():
+            for hit in es_client.search_after_scan(self.index, query, size=COMMENT_SCAN_SIZE, sort=COMMENT_SORT):
+                yield self.make_comment_row(hit)
+        return StreamingHttpResponse(rows(), content_type='application/x-ndjson; charset=utf-8')
+
+    def astream_response(self):
+        """stream_response() の非同期版"""
+        query = self.stream_query()
+        if query is None:
+            return HttpResponse(status=400)
+
+        async def rows():
+            async for hit in es_client.async_search_after_scan(self.index, query, size=COMMENT_SCAN_SIZE, sort=COMMENT_SORT):
+                yield self.make_comment_row(hit)
+        return StreamingHttpResponse(rows(), content_type='application/x-ndjson; charset=utf-8')
+
+    def make_comment_query(self):
+        """コメント検索のクエリ(不正なキーワードの場合は None)"""
         if not (check_keyword(self.keyword)):
-            message = "不正な検索ワードです。"
-            return render(self.request, self.template_name, {'form': self.get_form(), 'message': message})
+            return None
 
         logger.info("検索ES(" + self.object.id + "):" +
                     emoji.demojize(self.keyword))
@@ -169,62 +467,36 @@ class CommentListES(ListView, ModelFormMixin):
         # Elasticsearchからコメントを取得するための基本クエリを作成
         query = make_base_query(self.keyword, self.liverNameId)
 
-        # クエリにビデオIDの条件を追加
-        query["query"]["bool"]["must"].append(
+        # クエリにビデオIDの条件を追加(スコア計算不要・キャッシュ可能な filter)
+        query["query"]["bool"]["filter"] = [
             {
-                "match_phrase": {
-                    "video_id": {
-                        "query": self.object.id
-                    }
+                "term": {
+                    "video_id": self.object.id
                 }
             }
-        )
-
-        # クエリにソートと取得数の条件を追加
-        query['sort'] = [{"date": {"order": "asc"}}]
-        query['size'] = 1000  # コメント取得単位
-
-        MAX_TRY = 100  # 最大試行回数
-
-        from_num = None
-        self.object_list = []
-        count = 0
-        for i in range(1, MAX_TRY):
-            if from_num:
-                query['from'] = from_num
-
-            # Elasticsearchからコメントを取得
-            es = elasticsearch.Elasticsearch(
-                "http://" + ES_HOST + ":9200", timeout=60)
-            # logger.info("query" + json.dumps(query))
-            result = es.search(index=self.index, body=query)
-            hits = result["hits"]["hits"]
-            count = result["hits"]["total"]["value"]
-
-            # 各コメントを処理
-            for hit in hits:
-                dict = hit['_source']
-                obj = Empty()
-                obj.message = dict['message']
-                obj.timestampText = dict['timestamptext']
-                timestamp = converttimestampText(
-                    obj.timestampText) + self.initial_delay
-                if timestamp < 0:
-                    timestamp = 0
-                obj.link = "https://youtu.be/" + \
-                    self.object.id + "?t=" + str(timestamp)
-                obj.date = dict['date']
-                self.object_list.append(obj)
-
-            from_num = len(self.object_list)
-            if from_num >= count:
-                break
-
-        self.object.count = len(self.object_list)
+        ]
+        # 表示に使う項目のみ取得
+        query["_source"] = COMMENT_SOURCE_FIELDS
+
+        return query
+
+    def make_comment(self, hit):
+        """ESのヒット1件から表示用のコメントを作成"""
+        dict = hit['_source']
+        obj = Empty()
+        obj.message = dict['message']
+        obj.timestampText = dict['timestamptext']
+        timestamp = offset_seconds(dict) + self.initial_delay
+        if timestamp < 0:
+            timestamp = 0
+        obj.link = "https://youtu.be/" + \
+            self.object.id + "?t=" + str(timestamp)
+        obj.date = dict['date']
+        return obj
 
     def render_response(self):
         form = self.get_form()
-        return render(self.request, self.template_name, {'form': form, 'object': self.object, 'object_list': self.object_list, 'liver_list': self.liver_list, 'liverNameId': self.liverNameId, 'keyword': self.keyword})
+        return render(self.request, self.template_name, {'form': form, 'object': self.object, 'object_list': self.object_list, 'page_obj': self.page_obj, 'liver_list': self.liver_list, 'liverNameId': self.liverNameId, 'keyword': self.keyword})
 
     def get_queryset(self):
         return Video.objects.none()
@@ -238,6 +510,51 @@ class CommentListMY(CommentListES):
         return response
 
 
+class AsyncCommentListES(CommentListES):
+    """CommentListES の非同期版(ASGI用)"""
+
+    async def get(self, request, *args, **kwargs):
+        if MAINTENANCE:
+            return redirect(reverse('comment:maintenance'))
+        else:
+            response = await request_metrics.sync_to_async(self.prepare)(kwargs)
+            if response:
+                return response
+            if self.keyword:
+                if self.request.GET.get('timeline') == '1':
+                    return await self.atimeline_response()
+                if self.request.GET.get('stream') == '1':
+                    return self.astream_response()
+                await self.afetch_and_process_comments()
+            return await request_metrics.sync_to_async(self.render_response)()
+
+
+class AsyncCommentListMY(AsyncCommentListES):
+    # @login_required
+    async def get(self, request, *args, **kwargs):
+        kwargs['my_flag'] = True
+        response = await super().get(request, *args, **kwargs)
+        return response
+
+
+def offset_seconds(source):
+    """コメントの動画内位置(秒)。videooffsettimemsec がない場合は表示用文字列から求める"""
+    offset = source.get('videooffsettimemsec')
+    if offset is None:
+        return converttimestampText(source['timestamptext'])
+    # 表示用文字列と同じく0方向に切り捨て
+    return int(offset / 1000)
+
+
+def format_offset(seconds):
+    """動画内位置(秒)の表示用文字列 (h:mm:ss / m:ss)"""
+    sign = "-" if seconds < 0 else ""
+    seconds = abs(seconds)
+    if seconds >= 60 * 60:
+        return sign + "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+    return sign + "%d:%02d" % (seconds // 60, seconds % 60)
+
+
 def video_list_es_redirect(request):
     redirect_url = reverse('comment:video_list_es')
     parameters = request.GET.urlencode()
@@ -245,7 +562,7 @@ def video_list_es_redirect(request):
     return redirect(url)
 
 
-class VideoListES(ListView, ModelFormMixin):
+class VideoListES(request_metrics.RequestMetricsMixin, ListView, ModelFormMixin):
     model = Video
     form_class = SearchFormES
     success_url = reverse_lazy('comment:video_list_es')
@@ -253,6 +570,14 @@ class VideoListES(ListView, ModelFormMixin):
     paginate_by = 15
 
     def get(self, request, *args, **kwargs):
+        return run_steps(self.search_steps(request, *args, **kwargs))
+
+    def search_steps(self, request, *args, **kwargs):
+        """検索画面の処理本体
+
+        ES検索は SearchStep として yield し、実行結果(検索状態)を受け取る。
+        同期ビュー(run_steps)と非同期ビュー(arun_steps)で共通に使う。
+        """
         if MAINTENANCE:
             return redirect(reverse('comment:maintenance'))
         else:
@@ -263,40 +588,19 @@ class VideoListES(ListView, ModelFormMixin):
             self.form_class.base_fields['search_datatime_start'].initial = ''
             self.form_class.base_fields['search_datatime_end'].initial = ''
 
-            channel_choice = []
             my_flag = True
-            if 'my_flag' in kwargs:
-                group_list = ChannelGroup.objects.all().values_list(
-                    'id', 'groupName').order_by('no')
-            else:
-                group_list = ChannelGroup.objects.filter(
-                    no__gt=0).values_list('id', 'groupName').order_by('no')
-
-                # TODO サービス利用停止
-                # if 'only_flag' not in kwargs:
-                #    my_flag = False
-                #    message = ""
-                #    return render(self.request, self.template_name,
-                #                  {'form': self.get_form(), 'message': message})
-
-            channel_choice.append(
-                ('グループ', tuple(list(group_list)))
-            )
+            topology = channel_topology.get_topology()
+            channel_choice = topology.channel_choice['my_flag' in kwargs]
+            # TODO サービス利用停止
+            # if 'my_flag' not in kwargs and 'only_flag' not in kwargs:
+            #    my_flag = False
+            #    message = ""
+            #    return render(self.request, self.template_name,
+            #                  {'form': self.get_form(), 'message': message})
 
-            channel_db_list = Channel.objects.filter(enable=True).values_list(
-                'id', 'channelName', 'group_id').order_by('no')
-            for gr in group_list:
-                tmp_gr = []
-                for ch in channel_db_list:
-                    if gr[0] == ch[2]:
-                        tmp_gr.append(ch[0:2])
-                channel_choice.append((gr[1], tuple(tmp_gr))),
-
-            self.form_class.base_fields['channelName'].choices = tuple(
-                channel_choice)
+            self.form_class.base_fields['channelName'].choices = channel_choice
             self.form_class.base_fields['channelName'].initial = []
-            self.form_class.base_fields['ex_channelName'].choices = tuple(
-                channel_choice)
+            self.form_class.base_fields['ex_channelName'].choices = channel_choice
             self.form_class.base_fields['ex_channelName'].initial = []
 
             log_message = ""
@@ -346,57 +650,21 @@ class VideoListES(ListView, ModelFormMixin):
                     history_flag = self.request.GET.get('history')
 
                     if (history_flag and history_flag == "True"):
-                        history_sub_list = SearchHistory.objects.filter(searchAt__gte=str(
-                            nowtime - timedelta(days=1))).distinct().values_list('keyword', 'liverNameId_id', 'clientIP')
-                        history_rank_list_dict = {}
-                        history_rank_list_Id_flag_dict = {}
-
-                        for history in history_sub_list:
-                            keyword, liverNameId_id, clientIP = history
-                            word = None
-                            if liverNameId_id:
-                                word = "b" + str(liverNameId_id)
-                            elif keyword:
-                                word = "a" + keyword
-
-                            if word:
-                                if word in history_rank_list_dict:
-                                    history_rank_list_dict[word] += 1
-                                else:
-                                    history_rank_list_dict[word] = 1
-
                         history_rank_list = []
                         rank = 1
-                        for tmp in sorted(history_rank_list_dict.items(), key=lambda i: i[1], reverse=True):
-                            # keywordとliverId型の分離
+                        for word, count in search_ranking.top(nowtime):
                             obj = Empty()
                             obj.rank = rank
-                            if tmp[0][0] == 'b':
-
-                                # debug
-                                if False:
-                                    obj.type = "ライバー名検索"
-                                    # obj.url = reverse('comment:video_list_es', kwargs=self.kwargs)
-                                    obj.url = reverse(
-                                        'comment:video_list_es') + "?liverNameId=" + tmp[0][1:]
-                                    obj.word = livername_get_liver_name(
-                                        int(tmp[0][1:]))
-                                continue
-                            else:
-                                obj.type = "キーワード検索"
-                                obj.url = "?keyword=" + \
-                                    emoji.emojize(tmp[0][1:])
-                                obj.word = tmp[0][1:]
-                            obj.count = tmp[1]
+                            obj.type = "キーワード検索"
+                            obj.url = "?keyword=" + emoji.emojize(word)
+                            obj.word = word
+                            obj.count = count
                             history_rank_list.append(obj)
                             rank += 1
-                            if rank > 50:
-                                break
 
                     # 検索履歴
                     if 'my_flag' in kwargs:
-                        history_sub_list = SearchHistory.objects.filter(searchAt__gte=str(
-                            nowtime - timedelta(days=1))).values_list('keyword', 'liverNameId_id', 'clientIP', 'searchAt').order_by('-searchAt')
+                        history_sub_list = search_ranking.recent(nowtime)
 
                         history_list = []
                         pre_word = ""
@@ -569,70 +837,20 @@ class VideoListES(ListView, ModelFormMixin):
                 log_message = log_message + ",mode=" + \
                     str(mode) + ",sort=" + str(sort_mode)
                 logger.info(emoji.demojize(log_message))
-                # キーワードごとに待機
-                keyword_count = 0
-                retry_count = 60
-                while keyword_count <= retry_count:
-                    obj = SearchKey.objects.filter(
-                        keyword=emoji.demojize(keyword)).first()
-                    check_now = datetime.now(timezone(timedelta(hours=9)))
-                    if obj is None or check_now > obj.createdAt + timedelta(seconds=60):
-                        break
-                    keyword_count += 1
-                    time.sleep(1)
-
-                if keyword_count >= retry_count:
-                    logger.info("検索中断:" + keyword)
-                    message = "検索中です。再度お試しください。"
-                    return render(self.request, self.template_name,
-                                  {'form': self.get_form(), 'message': message})
-
-                SearchKey.objects.create(
-                    keyword=emoji.demojize(keyword), createdAt=nowtime)
 
-                query = ""
+                video_search = None
                 try:
-                    queryset = None
-                    videoList = None
-                    queryset_list = []
-                    target_date_list = []
-
                     # 一週間以内なら直近モードへ変更
                     if search_datatime_start and search_datatime_start >= nowtime - timedelta(days=7):
                         mode = '0'
 
-                    if 'my_flag' in kwargs:
-                        index = mycommentall_index
-                    else:
-                        index = commentall_index
-
-                    # channelListの修正
+                    # channelListの修正(グループをチャンネルに展開)
                     if channelList:
-                        tmp_channel_list = []
-                        for channel in channelList:
-                            try:
-                                group_id = int(channel)
-                                for ch in Channel.objects.filter(group_id=group_id):
-                                    tmp_channel_list.append(ch.id)
-                            except:
-                                if channel not in tmp_channel_list:
-                                    tmp_channel_list.append(channel)
-
-                        channelList = tuple(tmp_channel_list)
+                        channelList = topology.expand(channelList)
 
                     # ex_channelListの修正
                     if ex_channelList:
-                        tmp_channel_list = []
-                        for channel in ex_channelList:
-                            try:
-                                group_id = int(channel)
-                                for ch in Channel.objects.filter(group_id=group_id):
-                                    tmp_channel_list.append(ch.id)
-                            except:
-                                if channel not in tmp_channel_list:
-                                    tmp_channel_list.append(channel)
-
-                        ex_channelList = tuple(tmp_channel_list)
+                        ex_channelList = topology.expand(ex_channelList)
 
                     result_summary = Empty()
                     # result_summary.video_count = 0 #廃止
@@ -649,33 +867,6 @@ class VideoListES(ListView, ModelFormMixin):
                         page_obj.number = 1
                         page_obj.has_previous = False
 
-                    MAX_TRY = 1000
-
-                    item_count = 0
-                    page_hit_flag = False
-                    after_key = None
-
-                    timeset_flag = False
-                    if mode == '1':
-                        if sort_mode == '0':
-                            req_search_datatime_start = search_datatime_start
-                            search_datatime_start = search_datatime_end - \
-                                relativedelta(months=1)
-                            # 時間未指定の場合の強制期間制限
-                            if not (req_search_datatime_start) or req_search_datatime_start < search_datatime_start:
-                                timeset_flag = True
-                            else:
-                                search_datatime_start = req_search_datatime_start
-                        elif sort_mode == '1':
-                            req_search_datatime_end = search_datatime_end
-                            search_datatime_end = search_datatime_start + \
-                                relativedelta(months=1)
-                            # 時間未指定の場合の強制期間制限
-                            if not (req_search_datatime_end) or req_search_datatime_end > search_datatime_end:
-                                timeset_flag = True
-                            else:
-                                search_datatime_end = req_search_datatime_end
-
                     if sort_mode == '2':
                         if page_obj.number > 5:
                             page_obj.number = 5
@@ -697,170 +888,77 @@ class VideoListES(ListView, ModelFormMixin):
 
                         history.clientIP = clientIP
                         history.searchAt = nowtime
-                        history.save()
+                        # 書き込みと検索ランキングの集計はまとめて別スレッドで行う
+                        history_writer.add(history)
 
                     # 時間によるタイムアウト
                     # TODO
 
-                    for i in range(1, MAX_TRY):
-                        es = elasticsearch.Elasticsearch(
-                            "http://" + ES_HOST + ":9200", timeout=60)
-                        query = make_video_query(keyword, liverNameId, channelList, ex_channelList,
-                                                 search_datatime_start, search_datatime_end, after_key, sort_mode)
-                        # logger.info("query" + json.dumps(query))
-                        result = es.search(index=index, body=query)
-                        after_key = result["aggregations"]["group_by_video_id"].get(
-                            "after_key")
-                        buckets = result["aggregations"]["group_by_video_id"]["buckets"]
-
-                        result_dict = {}
-                        video_id_list = []
-                        for bucket in buckets:
-                            if sort_mode == '2':
-                                video_id = bucket['key']
-                            else:
-                                video_id = bucket['key']['video_id']
-                            video_id_list.append(video_id)
-                            doc_count = bucket['doc_count']
-                            if doc_count >= least_count:
-                                result_dict[video_id] = doc_count
-
-                        if 'my_flag' in kwargs:
-                            queryset = Video.objects.filter(
-                                id__in=result_dict.keys())
-                        else:
-                            queryset = Video.objects.filter(
-                                id__in=result_dict.keys(), enable=True)
-                        video_list = []
-                        if sort_mode == '0':
-                            video_list = queryset.order_by('-publishedAt')
-                        elif sort_mode == '1':
-                            video_list = queryset.order_by('publishedAt')
-                        elif sort_mode == '3':
-                            video_list = queryset.order_by('-collectedAt')
-                        elif sort_mode == '4':
-                            video_list = queryset.order_by('collectedAt')
-                        else:
-                            for video_id in video_id_list:
-                                for video in queryset:
-                                    if video_id == video.id:
-                                        video_list.append(video)
-
-                        tmp_count = 0
-                        for video in video_list:
-                            tmp_count += 1
-                            if 'my_flag' in kwargs:
-                                if video is None:
-                                    continue
-                            else:
-                                # if video is None or check_video(video) == False:
-                                if video is None:
-                                    continue
-                                if not (video.enable and video.public) and check_video(video) == False:
-                                    continue
-                                '''
-                                if "メン限" in video.title or "メンバーシップ限定" in video.title:
-                                    # TODO 特殊対応　メン限が配信タイトルにあれば対象外とする
-                                    continue
-                                '''
-
-                            # タイトル条件判定
-                            # logger.info(video.title)
-                            title_hit_flag = False
-                            if title_keyword.replace('　', ' ').replace(' ', '') != '':
-                                for word in title_keyword.replace('　', ' ').split(' '):
-                                    # logger.info(word)
-                                    if len(word) > 1 and word[0] == "-":
-                                        if word[1:] in video.title:
-                                            # logger.info("hit1" + word)
-                                            title_hit_flag = False
-                                            break
-                                    elif len(word) > 0 and word in video.title:
-                                        # logger.info("hit2" + word)
-                                        title_hit_flag = True
-                                if not title_hit_flag:
-                                    continue
-
-                            obj = Empty()
-                            obj.img = "https://i3.ytimg.com/vi/" + video.id + "/mqdefault.jpg"
-                            if 'my_flag' in kwargs:
-                                if liverNameId:
-                                    # liverNameIdの値はhtml側で足す
-                                    obj.url = reverse('comment:comment_list_my', kwargs=dict(
-                                        pk=video.id)) + "?liverNameId="
-                                else:
-                                    # keywrodの値はhtml側で足す
-                                    obj.url = reverse('comment:comment_list_my', kwargs=dict(
-                                        pk=video.id)) + "?keyword="
-                            else:
-                                if liverNameId:
-                                    # liverNameIdの値はhtml側で足す
-                                    obj.url = reverse('comment:comment_list_es', kwargs=dict(
-                                        pk=video.id)) + "?liverNameId="
-                                else:
-                                    # keywrodの値はhtml側で足す
-                                    obj.url = reverse('comment:comment_list_es', kwargs=dict(
-                                        pk=video.id)) + "?keyword="
-
-                            obj.video_id = video.id
-                            if video.public and video.enable:
-                                obj.title = emoji.emojize(video.title)
-                            else:
-                                obj.title = "★" + emoji.emojize(video.title)
-                            obj.publishedAt = video.publishedAt
-                            obj.channelName = emoji.emojize(
-                                video.channel.channelName)
-                            obj.count = result_dict[video.id]
-                            self.object_list.append(obj)
-                            result_summary.zero_flag = False
-
-                            # PAGE_PER_ITEM超えていたら先頭の削除
-                            if len(self.object_list) > PAGE_PER_ITEM:
-                                self.object_list.pop(0)
-
-                            item_count += 1
-                            if (item_count-1)//PAGE_PER_ITEM == page_obj.number - 1 and item_count % PAGE_PER_ITEM == 0:
-                                break
-
-                        if after_key:
-                            if i == MAX_TRY:
-                                result_summary.max_flag = True
-                            page_obj.has_next = True
-                            if (item_count-1)//PAGE_PER_ITEM == page_obj.number - 1 and item_count % PAGE_PER_ITEM == 0:
-                                # page分の取得完了
-                                break
-                        else:
-                            if timeset_flag:
-                                # 次の期間で再度コメント取得
-                                if sort_mode == '0':
-                                    search_datatime_end = search_datatime_start
-                                    search_datatime_start = search_datatime_end - \
-                                        relativedelta(months=1)
-                                    if search_datatime_start < req_search_datatime_start:
-                                        timeset_flag = False
-                                        search_datatime_start = req_search_datatime_start
-                                elif sort_mode == '1':
-                                    search_datatime_start = search_datatime_end
-                                    search_datatime_end = search_datatime_start + \
-                                        relativedelta(months=1)
-                                    if search_datatime_end > req_search_datatime_end:
-                                        timeset_flag = False
-                                        search_datatime_end = req_search_datatime_end
-                            else:
-                                if tmp_count < len(queryset):
-                                    # queryset回りきっていない
-                                    page_obj.has_next = True
-                                else:
-                                    page_obj.number = (
-                                        item_count - 1) // PAGE_PER_ITEM + 1
-                                    page_obj.has_next = False
-                                # データの取得完了
-                                break
-
-                    # 不要分の削除
-                    for i in range(1, len(self.object_list)):
-                        if len(self.object_list) > (item_count - 1) % PAGE_PER_ITEM + 1:
-                            self.object_list.pop(0)
+                    # 同一条件の検索結果があれば再利用
+                    signature = search_cache.make_signature(keyword, liverNameId, channelList, ex_channelList, mode,
+                                                            search_datatime_start_str, search_datatime_end_str,
+                                                            sort_mode, least_count, title_keyword, 'my_flag' in kwargs)
+                    state = search_cache.load(signature)
+                    if state:
+                        video_search = VideoSearch.from_state(state)
+
+                    # 非同期ジョブで検索し、結果は search_job_status で取得する
+                    if request.GET.get('job') == '1':
+                        video_search = VideoSearch(keyword, liverNameId, channelList, ex_channelList,
+                                                   search_datatime_start, search_datatime_end, mode, sort_mode,
+                                                   least_count, title_keyword, 'my_flag' in kwargs, nowtime)
+                        try:
+                            job_id = search_jobs.submit(video_search, signature,
+                                                        search_cache.timeout_for(mode, search_datatime_end, nowtime))
+                        except search_jobs.SearchJobFull:
+                            logger.info("検索ジョブ受付不可:" + keyword)
+                            return JsonResponse({'status': 'busy', 'message': "アクセスが集中しています。時間をおいてお試しください。"}, status=503)
+                        return JsonResponse({'status': 'queued', 'job_id': job_id})
+
+                    page_start = (page_obj.number - 1) * PAGE_PER_ITEM
+                    replay_flag = True
+                    # 次ページ有無の判定のため1件多く取得
+                    if video_search is None or not video_search.has(page_start + PAGE_PER_ITEM + 1):
+                        # 前ページからのカーソルがあれば続きから検索(1ページ目からの再取得なし)
+                        cursor = load_cursor_token(request.GET.get(
+                            'cursor'), signature, page_obj.number)
+                        if cursor or video_search is None:
+                            video_search = VideoSearch(keyword, liverNameId, channelList, ex_channelList,
+                                                       search_datatime_start, search_datatime_end, mode, sort_mode,
+                                                       least_count, title_keyword, 'my_flag' in kwargs, nowtime)
+                        if cursor:
+                            video_search.resume(cursor['position'])
+                            page_start = cursor['offset']
+                            replay_flag = False
+
+                        # 同一条件の検索が実行中なら、その結果を待って使う
+                        flight_key = signature + ":" + \
+                            str(page_obj.number) + (":cursor" if cursor else "")
+                        step = SearchStep(flight_key, video_search, page_start + PAGE_PER_ITEM + 1,
+                                          signature if replay_flag else None,
+                                          search_cache.timeout_for(mode, search_datatime_end, nowtime))
+                        try:
+                            video_search = VideoSearch.from_state((yield step))
+                        except singleflight.SingleFlightTimeout:
+                            logger.info("検索中断:" + keyword)
+                            message = "検索中です。再度お試しください。"
+                            return render(self.request, self.template_name,
+                                          {'form': self.get_form(), 'message': message})
+
+                    items = video_search.items
+                    result_summary.max_flag = video_search.max_flag
+                    result_summary.zero_flag = len(items) == 0
+
+                    # 結果件数を超えるページ指定は最終ページへ
+                    if replay_flag and items and len(items) <= page_start:
+                        page_obj.number = (len(items) - 1) // PAGE_PER_ITEM + 1
+                        page_start = (page_obj.number - 1) * PAGE_PER_ITEM
+                    page_items = items[page_start:page_start + PAGE_PER_ITEM]
+                    page_obj.has_next = len(items) > page_start + PAGE_PER_ITEM or \
+                        not video_search.exhausted
+
+                    self.object_list = self.make_video_rows(
+                        page_items, liverNameId, 'my_flag' in kwargs)
 
                     page_obj.previous_page_number = page_obj.number - 1
                     page_obj.next_page_number = page_obj.number + 1
@@ -890,7 +988,7 @@ class VideoListES(ListView, ModelFormMixin):
                         page_obj.has_previous = False
                     page_obj.url_options = ""
                     for key, value in self.request.GET.items():
-                        if key == 'page':
+                        if key == 'page' or key == 'cursor':
                             continue
                         if key == 'channelName' or key == 'ex_channelName':
                             for channel in self.request.GET.getlist(key):
@@ -899,29 +997,31 @@ class VideoListES(ListView, ModelFormMixin):
                             continue
                         page_obj.url_options += "&" + key + "=" + str(value)
 
+                    # 次ページ用カーソル(他のページ番号では無視され再取得になる)
+                    if page_obj.has_next and sort_mode != '2':
+                        cursor = video_search.cursor_at(
+                            page_start + PAGE_PER_ITEM)
+                        if cursor:
+                            page_obj.url_options += "&cursor=" + \
+                                make_cursor_token(
+                                    cursor, signature, page_obj.number + 1)
+
                 except elasticsearch.ConnectionTimeout as e:
-                    logger.info("query" + json.dumps(query))
+                    logger.info("query" + json.dumps(video_search.query if video_search else ""))
                     logger.error("ESタイムアウト:" + keyword, exc_info=True)
-                    SearchKey.objects.filter(
-                        keyword=emoji.demojize(keyword)).delete()
 
                     message = "検索結果が多いか、アクセスが集中しています。期間などを絞り込むか、時間をおいてお試しください。"
 
                     return render(self.request, self.template_name,
                                   {'form': self.get_form(), 'message': message})
-                except:
-                    logger.info("query" + json.dumps(query))
+                except Exception:
+                    logger.info("query" + json.dumps(video_search.query if video_search else ""))
                     logger.error("想定外エラー:" + keyword, exc_info=True)
-                    SearchKey.objects.filter(
-                        keyword=emoji.demojize(keyword)).delete()
 
                     message = "エラーが発生しました。お手数おかけしますが事象が解消されない場合は問い合わせをお願い致します。"
                     return render(self.request, self.template_name,
                                   {'form': self.get_form(), 'message': message})
 
-                SearchKey.objects.filter(
-                    keyword=emoji.demojize(keyword)).delete()
-
                 logger.info("検索完了:" + emoji.demojize(keyword))
             else:
                 self.object_list = Video.objects.none()
@@ -930,10 +1030,130 @@ class VideoListES(ListView, ModelFormMixin):
             ), 'object_list': self.object_list, 'page_obj': page_obj, 'result_summary': result_summary, 'liver_list': liver_list, 'liverNameId': liverNameId, 'my_flag': my_flag})
             return response
 
+    def make_video_rows(self, page_items, liverNameId, my_flag):
+        """表示用の動画行を作成"""
+        count_dict = dict(page_items)
+        object_list = []
+        for video in bulk_videos([video_id for video_id, _ in page_items]):
+            count = count_dict[video.id]
+
+            obj = Empty()
+            obj.img = "https://i3.ytimg.com/vi/" + video.id + "/mqdefault.jpg"
+            if my_flag:
+                if liverNameId:
+                    # liverNameIdの値はhtml側で足す
+                    obj.url = reverse('comment:comment_list_my', kwargs=dict(
+                        pk=video.id)) + "?liverNameId="
+                else:
+                    # keywrodの値はhtml側で足す
+                    obj.url = reverse('comment:comment_list_my', kwargs=dict(
+                        pk=video.id)) + "?keyword="
+            else:
+                if liverNameId:
+                    # liverNameIdの値はhtml側で足す
+                    obj.url = reverse('comment:comment_list_es', kwargs=dict(
+                        pk=video.id)) + "?liverNameId="
+                else:
+                    # keywrodの値はhtml側で足す
+                    obj.url = reverse('comment:comment_list_es', kwargs=dict(
+                        pk=video.id)) + "?keyword="
+
+            obj.video_id = video.id
+            if video.public and video.enable:
+                obj.title = emoji.emojize(video.title)
+            else:
+                obj.title = "★" + emoji.emojize(video.title)
+            obj.publishedAt = video.publishedAt
+            obj.channelName = emoji.emojize(
+                video.channel.channelName)
+            obj.count = count
+            object_list.append(obj)
+        return object_list
+
     def get_queryset(self):
         return Video.objects.none()
 
 
+def search_job_status(request, job_id):
+    """非同期検索ジョブの進捗と途中結果(JSON)"""
+    job = search_jobs.load(job_id)
+    if job is None:
+        return JsonResponse({'status': 'not_found'}, status=404)
+
+    page_number_str = request.GET.get('page')
+    if page_number_str and not page_number_str.isdecimal():
+        return JsonResponse({'status': 'bad_request'}, status=400)
+    page_number = int(page_number_str) if page_number_str and int(
+        page_number_str) > 1 else 1
+    items = job['items']
+    start = (page_number - 1) * PAGE_PER_ITEM
+    page_items = items[start:start + PAGE_PER_ITEM]
+    count_dict = dict(page_items)
+
+    if job['my_flag']:
+        url_name = 'comment:comment_list_my'
+    else:
+        url_name = 'comment:comment_list_es'
+    object_list = []
+    for video in bulk_videos([video_id for video_id, _ in page_items]):
+        title = emoji.emojize(video.title)
+        if not (video.public and video.enable):
+            title = "★" + title
+        object_list.append({
+            'video_id': video.id,
+            'title': title,
+            'url': reverse(url_name, kwargs=dict(pk=video.id)),
+            'img': "https://i3.ytimg.com/vi/" + video.id + "/mqdefault.jpg",
+            'publishedAt': video.publishedAt,
+            'channelName': emoji.emojize(video.channel.channelName),
+            'count': count_dict[video.id],
+        })
+
+    return JsonResponse({
+        'status': job['status'],
+        'message': job['message'],
+        'progress': job['progress'],
+        'page': page_number,
+        'has_next': len(items) > start + PAGE_PER_ITEM or (job['status'] != 'done' and not job['exhausted']),
+        'object_list': object_list,
+    })
+
+
+def metrics_allowed(request):
+    """集計を参照できるリクエストか(スタッフ・許可IP・トークン)"""
+    if getattr(request, 'user', None) is not None and request.user.is_staff:
+        return True
+    clientIP, _ = get_client_ip(request)
+    if clientIP is not None and clientIP in METRICS_ALLOWED_IPS:
+        return True
+    if METRICS_TOKEN:
+        token = request.META.get('HTTP_AUTHORIZATION', '')
+        return hmac.compare_digest(token.encode(), ('Bearer ' + METRICS_TOKEN).encode())
+    return False
+
+
+def metrics(request):
+    """検索画面の処理時間の集計(Prometheus形式)"""
+    if not metrics_allowed(request):
+        return HttpResponseForbidden()
+    gauges = {}
+    counters = {}
+    for key, value in es_client.pool_stats().items():
+        if key in ES_COUNTER_KEYS:
+            counters['comment_es_' + key + '_total'] = value
+        else:
+            gauges['comment_es_' + key] = value
+    for key, value in history_writer.stats().items():
+        if key in HISTORY_COUNTER_KEYS:
+            counters['comment_search_history_' + key + '_total'] = value
+        else:
+            gauges['comment_search_history_' + key] = value
+    for key, value in search_cache.stats().items():
+        counters['comment_search_cache_' + key + '_total'] = value
+    return HttpResponse(request_metrics.render_prometheus(gauges, counters),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 class VideoListMY(VideoListES):
     # @login_required
     def get(self, request, *args, **kwargs):
@@ -952,6 +1172,108 @@ class VideoListONLY(VideoListES):
         return response
 
 
+class AsyncVideoListES(VideoListES):
+    """VideoListES の非同期版(ASGI用)
+
+    ES検索は AsyncElasticsearch で行い、待ち時間中にワーカーを占有しない。
+    フォーム・DB・テンプレートの処理は同期版と共通。
+    """
+
+    async def get(self, request, *args, **kwargs):
+        return await arun_steps(self.search_steps(request, *args, **kwargs))
+
+
+class AsyncVideoListMY(AsyncVideoListES):
+    # @login_required
+    async def get(self, request, *args, **kwargs):
+        kwargs['my_flag'] = True
+        response = await super().get(request, *args, **kwargs)
+        return response
+
+
+class AsyncVideoListONLY(AsyncVideoListES):
+    # @login_required
+    async def get(self, request, *args, **kwargs):
+        kwargs['only_flag'] = True
+        response = await super().get(request, *args, **kwargs)
+        return response
+
+
+class SearchStep:
+    """search_steps から yield されるES検索の単位
+
+    count件まで検索し、signature があれば検索結果キャッシュに保存して
+    検索状態を返す。同一 flight_key の同時実行は1回にまとめる。
+    """
+
+    def __init__(self, flight_key, video_search, count, signature, cache_timeout):
+        self.flight_key = flight_key
+        self.video_search = video_search
+        self.count = count
+        self.signature = signature
+        self.cache_timeout = cache_timeout
+
+    def _store(self):
+        state = self.video_search.to_state()
+        if self.signature:
+            search_cache.store(self.signature, state, self.cache_timeout)
+        return state
+
+    def _fill(self):
+        self.video_search.fill(self.count)
+        return self._store()
+
+    async def _afill(self):
+        await self.video_search.afill(self.count)
+        return await request_metrics.sync_to_async(self._store)()
+
+    def run(self):
+        return singleflight.do(self.flight_key, self._fill)
+
+    async def arun(self):
+        return await singleflight.ado(self.flight_key, self._afill)
+
+
+def _advance(steps, value=None, error=None):
+    """steps を次の SearchStep まで進める。終了時は (None, レスポンス)"""
+    try:
+        if error is not None:
+            return steps.throw(error), None
+        return steps.send(value), None
+    except StopIteration as e:
+        return None, e.value
+
+
+def run_steps(steps):
+    """search_steps を同期で実行してレスポンスを返す"""
+    step, response = _advance(steps)
+    while step is not None:
+        try:
+            value = step.run()
+        except Exception as e:
+            step, response = _advance(steps, error=e)
+        else:
+            step, response = _advance(steps, value)
+    return response
+
+
+async def arun_steps(steps):
+    """search_steps を非同期で実行してレスポンスを返す
+
+    DB・テンプレートを含む部分はスレッドで、ES検索はイベントループ上で実行する。
+    """
+    advance = request_metrics.sync_to_async(_advance)
+    step, response = await advance(steps)
+    while step is not None:
+        try:
+            value = await step.arun()
+        except Exception as e:
+            step, response = await advance(steps, error=e)
+        else:
+            step, response = await advance(steps, value)
+    return response
+
+
 def livername_view(request):
     livernames = LiverName.objects.filter(id__gt=121).order_by('no')
 
@@ -1013,85 +1335,54 @@ def parse_livername_keyword(keyword):
 
 
 def check_keyword(keyword):
-
-    count = 0
-    for word in keyword.replace('　', ' ').split(' '):
-        if not (word):
-            continue
-
-        if word == "*":
-            return False
-        if word == "-":
-            return False
-        if word == "-*":
-            return False
-        if word == "\t":
-            return False
-        if word[0] != "-":
-            count += 1
-
-    if count == 0:
-        return False
-
-    return True
+    return keyword_analysis.is_valid(keyword)
+
+
+# 検索語の種類ごとの対象フィールド
+MESSAGE_FIELDS = {
+    'wildcard': "message.wildcard",
+    'symbol': "message.symbol",
+    'ngram': "message.ngram",
+    'phrase': "message",
+}
+
+
+def make_symbol_clause(word):
+    """絵文字・ハングル・記号を含む語の条件
+
+    message.symbol(1文字ずつのトークン)のフレーズで候補を絞る。
+    トークンにならない空白等をまたいで連続する場合もフレーズに一致するため、
+    2文字以上の語は候補をワイルドカードで確認する(先頭のワイルドカードのみの検索はしない)。
+    """
+    clause = {"match_phrase": {MESSAGE_FIELDS['symbol']: word}}
+    if len(word) == 1:
+        return clause
+    return {
+        "bool": {
+            "filter": [
+                clause,
+                {"wildcard": {MESSAGE_FIELDS['wildcard']: {
+                    "value": keyword_analysis.wildcard_pattern(word)}}},
+            ]
+        }
+    }
 
 
 def make_base_query(keyword, liverNameId):
     not_word_list = []
     word_list = []
-    for word in keyword.replace('　', ' ').split(' '):
-        # 様子を見ていく
-        # type = "wildcard"
-        type = "ngram"
-        if not (word):
-            continue
-
-        if wildcard_check(word):
-            type = "wildcard"
-            word = word.replace('?', '\?').replace('*', '\*')
-
-        if type == "wildcard":
-            if word[0] == '-':
-                not_word_list.append(
-                    {
-                        "wildcard": {
-                            "message.wildcard": {
-                                "value": "*" + word[1:] + "*"
-                            }
-                        }
-                    }
-                )
-            else:
-                word_list.append(
-                    {
-                        "wildcard": {
-                            "message.wildcard": {
-                                "value": "*" + word + "*"
-                            }
-                        }
-                    }
-                )
+    for term in keyword_analysis.message_terms(keyword):
+        field = MESSAGE_FIELDS[term.kind]
+        if term.kind == 'wildcard':
+            clause = {"wildcard": {field: {"value": term.value}}}
+        elif term.kind == 'symbol':
+            clause = make_symbol_clause(term.value)
         else:
-            target = "message"
-            if jp_check(word):
-                target = target + ".ngram"
-
-            if word[0] == '-':
-                not_word_list.append(
-                    {
-                        "match_phrase": {
-                            target: word[1:]
-                        }
-                    }
-                )
-            else:
-                word_list.append(
-                    {
-                        "match_phrase": {
-                            target: word
-                        }
-                    }
-                )
+            clause = {"match_phrase": {field: term.value}}
+        if term.negative:
+            not_word_list.append(clause)
+        else:
+            word_list.append(clause)
 
     query = {
         "query": {
@@ -1131,37 +1422,53 @@ def make_base_query(keyword, liverNameId):
 
 
 def jp_check(word):
-
-    # 特別対応
-    sp_word_list = ["魔界ノ"]
-    for sp_word in sp_word_list:
-        if word == sp_word:
-            return True
-
-    for ch in word:
-        name = unicodedata.name(ch)
-        if "CJK KATAKANA" in name or "HIRAGANA" in name:
-            # if "CJK KATAKANA" in name or "HIRAGANA" in name or "UNIFIED" in name:
-            return True
-    return False
+    return keyword_analysis.is_jp(word)
 
 
 def wildcard_check(word):
     # 絵文字とハングルはワイルドカード
+    return keyword_analysis.is_wildcard(word)
 
-    if emoji.emoji_count(word) > 0:
-        return True
 
-    if re.search('[가-힣]', word):
-        return True
+def make_title_query(title_keyword):
+    """タイトル条件のクエリ(コメントに持たせた video_title で判定)
 
-    if re.search('[!-/:-@\[-`{-~！-／：-＠［-｀｛-～、-〜”’・]', word):
-        return True
+    filter_videos のタイトル判定(部分文字列の一致)と同じ結果になるよう、
+    形態素ではなく video_title.wildcard の部分一致で判定する。
+    """
+    word_list = []
+    not_word_list = []
+    for term in keyword_analysis.title_terms(title_keyword):
+        condition = {"wildcard": {"video_title.wildcard": {
+            "value": keyword_analysis.wildcard_pattern(term.value)}}}
+        if term.negative:
+            not_word_list.append(condition)
+        else:
+            word_list.append(condition)
 
-    return False
+    query = {"bool": {}}
+    if word_list:
+        query['bool']['should'] = word_list
+        query['bool']['minimum_should_match'] = 1
+    if not_word_list:
+        query['bool']['must_not'] = not_word_list
+    if not query['bool']:
+        return None
+    return query
+
+
+def make_video_query(keyword, liverNameId, channelList, ex_channelList, search_datatime_start, search_datatime_end, after_key, sort_mode, least_count=0, title_keyword=''):
+    query = make_video_query_template(keyword, liverNameId, channelList, ex_channelList,
+                                      sort_mode, least_count, title_keyword)
+    return apply_video_window(query, search_datatime_start, search_datatime_end, after_key)
 
 
-def make_video_query(keyword, liverNameId, channelList, ex_channelList, search_datatime_start, search_datatime_end, after_key, sort_mode):
+def make_video_query_template(keyword, liverNameId, channelList, ex_channelList, sort_mode, least_count=0, title_keyword=''):
+    """動画検索クエリのうち期間・取得位置以外の部分
+
+    1回の検索中は変わらないため一度だけ作り、apply_video_window() で
+    期間と after を足して使う。
+    """
     query = make_base_query(keyword, liverNameId)
 
     if sort_mode == '0' or sort_mode == '1':
@@ -1227,27 +1534,17 @@ def make_video_query(keyword, liverNameId, channelList, ex_channelList, search_d
             }
         )
 
-    # 期間指定
-    if search_datatime_start:
-        query['query']['bool']['must'].append(
-            {
-                "range": {
-                    "video_publishedat": {
-                        "gt": int(search_datatime_start.timestamp()) * 1000
-                    }
-                }
-            }
-        )
-    if search_datatime_end:
-        query['query']['bool']['must'].append(
-            {
-                "range": {
-                    "video_publishedat": {
-                        "lte": int(search_datatime_end.timestamp()) * 1000
-                    }
-                }
-            }
-        )
+    # タイトル条件
+    if title_keyword and SEARCH_TITLE_FIELD:
+        title_query = make_title_query(title_keyword)
+        if title_query:
+            query['query']['bool']['must'].append(title_query)
+
+    # コメント数条件がある場合はES側で除外されるため、1回の取得数を増やす
+    if least_count > 1:
+        composite_size = FILTERED_COMPOSITE_SIZE
+    else:
+        composite_size = PAGE_PER_ITEM
 
     # 取得絡む指定
     if sort_mode == '0' or sort_mode == '1':
@@ -1255,7 +1552,7 @@ def make_video_query(keyword, liverNameId, channelList, ex_channelList, search_d
         query['aggs'] = {
             "group_by_video_id": {
                 "composite": {
-                    "size": PAGE_PER_ITEM,
+                    "size": composite_size,
                     "sources": [
                         {
                             "video_publishedat": {
@@ -1281,7 +1578,7 @@ def make_video_query(keyword, liverNameId, channelList, ex_channelList, search_d
         query['aggs'] = {
             "group_by_video_id": {
                 "composite": {
-                    "size": PAGE_PER_ITEM,
+                    "size": composite_size,
                     "sources": [
                         {
                             "video_publishedat": {
@@ -1313,12 +1610,457 @@ def make_video_query(keyword, liverNameId, channelList, ex_channelList, search_d
             }
         }
 
+    # コメント数条件
+    if least_count > 1:
+        if sort_mode == '2':
+            query['aggs']['group_by_video_id']['terms']['min_doc_count'] = least_count
+        else:
+            query['aggs']['group_by_video_id']['aggs'] = {
+                "least_count": {
+                    "bucket_selector": {
+                        "buckets_path": {
+                            "count": "_count"
+                        },
+                        "script": {
+                            "source": "params.count >= params.least_count",
+                            "params": {
+                                "least_count": least_count
+                            }
+                        }
+                    }
+                }
+            }
+
+    return query
+
+
+def apply_video_window(template, search_datatime_start, search_datatime_end, after_key):
+    """テンプレートに期間と after を足したクエリ
+
+    テンプレートは変更せず、変更する部分のみ複製する(他の部分は共有)。
+    """
+    query = dict(template)
+    must = list(template['query']['bool']['must'])
+
+    # 期間指定
+    if search_datatime_start:
+        must.append(
+            {
+                "range": {
+                    "video_publishedat": {
+                        "gt": int(search_datatime_start.timestamp()) * 1000
+                    }
+                }
+            }
+        )
+    if search_datatime_end:
+        must.append(
+            {
+                "range": {
+                    "video_publishedat": {
+                        "lte": int(search_datatime_end.timestamp()) * 1000
+                    }
+                }
+            }
+        )
+    query['query'] = dict(template['query'])
+    query['query']['bool'] = dict(template['query']['bool'], must=must)
+
     if after_key:
-        query['aggs']['group_by_video_id']['composite']['after'] = after_key
+        group = template['aggs']['group_by_video_id']
+        query['aggs'] = dict(template['aggs'])
+        query['aggs']['group_by_video_id'] = dict(
+            group, composite=dict(group['composite'], after=after_key))
 
     return query
 
 
+def bulk_videos(video_id_list, enable_only=False):
+    """動画IDの一覧から動画を一括取得し、同じ順序で返す(チャンネルも同時に取得)"""
+    queryset = Video.objects.select_related('channel')
+    if enable_only:
+        queryset = queryset.filter(enable=True)
+    video_dict = queryset.in_bulk(video_id_list)
+    return [video_dict[video_id] for video_id in video_id_list if video_id in video_dict]
+
+
+class VideoSearch:
+    """キーワードに該当する動画の検索
+
+    ESのcomposite集計を辿り、DB上の動画で絞り込んだ結果を
+    (動画ID, コメント数) の順序付きリスト items に貯める。
+    状態は to_state()/from_state() で保存し、続きから再開できる。
+    """
+    MAX_TRY = 1000
+
+    def __init__(self, keyword, liverNameId, channelList, ex_channelList, search_datatime_start, search_datatime_end,
+                 mode, sort_mode, least_count, title_keyword, my_flag, nowtime):
+        self.keyword = keyword
+        self.liverNameId = liverNameId
+        self.channelList = channelList
+        self.ex_channelList = ex_channelList
+        self.mode = mode
+        self.sort_mode = sort_mode
+        self.least_count = least_count
+        self.title_keyword = title_keyword
+        self.my_flag = my_flag
+        self.nowtime = nowtime
+
+        self.search_datatime_start = search_datatime_start
+        self.search_datatime_end = search_datatime_end
+        self.req_search_datatime_start = search_datatime_start
+        self.req_search_datatime_end = search_datatime_end
+        self.timeset_flag = False
+        if mode == '1':
+            if sort_mode == '0':
+                self.search_datatime_start = search_datatime_end - \
+                    relativedelta(months=1)
+                # 時間未指定の場合の強制期間制限
+                if not (search_datatime_start) or search_datatime_start < self.search_datatime_start:
+                    self.timeset_flag = True
+                else:
+                    self.search_datatime_start = search_datatime_start
+            elif sort_mode == '1':
+                self.search_datatime_end = search_datatime_start + \
+                    relativedelta(months=1)
+                # 時間未指定の場合の強制期間制限
+                if not (search_datatime_end) or search_datatime_end > self.search_datatime_end:
+                    self.timeset_flag = True
+                else:
+                    self.search_datatime_end = search_datatime_end
+
+        self.after_key = None
+        self.query = ""
+        self.query_index = None
+        self.items = []
+        # 各ES検索の開始位置 (items上の位置, 検索位置)
+        self.chunk_starts = []
+        self.try_count = 0
+        self.exhausted = False
+        self.max_flag = False
+        # 先読み中の期間ごとの検索 (期間のキー -> Future)
+        self._prefetch = {}
+        # 期間・after 以外のクエリ(初回の検索時に作成)
+        self._query_template = None
+        # このプロセスで行った検索の ES took の合計(ミリ秒)とESでタイムアウトした回数
+        self._took = 0
+        self._timed_out = 0
+
+    def to_state(self):
+        state = dict(self.__dict__)
+        state['items'] = list(self.items)
+        del state['_prefetch']
+        del state['_query_template']
+        del state['_took']
+        del state['_timed_out']
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        video_search = cls.__new__(cls)
+        video_search.__dict__.update(state)
+        video_search.items = list(state['items'])
+        video_search._prefetch = {}
+        video_search._query_template = None
+        video_search._took = 0
+        video_search._timed_out = 0
+        return video_search
+
+    def position(self):
+        """現在の検索位置(composite の after_key と検索期間)"""
+        return {
+            'after_key': self.after_key,
+            'start': self.search_datatime_start.isoformat(),
+            'end': self.search_datatime_end.isoformat(),
+            'timeset_flag': self.timeset_flag,
+        }
+
+    def resume(self, position):
+        """position() の位置から検索を再開する"""
+        self.after_key = position['after_key']
+        self.search_datatime_start = datetime.fromisoformat(position['start'])
+        self.search_datatime_end = datetime.fromisoformat(position['end'])
+        self.timeset_flag = position['timeset_flag']
+
+    def cursor_at(self, index):
+        """items の index 件目から続きを取得するためのカーソル
+
+        index を含むES検索の開始位置と、その検索結果内での件数を返す。
+        """
+        if index >= len(self.items):
+            if self.exhausted:
+                return None
+            return {'position': self.position(), 'offset': 0}
+        for start, position in reversed(self.chunk_starts):
+            if start <= index:
+                return {'position': position, 'offset': index - start}
+        return None
+
+    def has(self, count):
+        """count件目までの結果が確定しているか"""
+        return self.exhausted or len(self.items) >= count
+
+    def fill(self, count, progress=None):
+        """count件集まるか検索が終わるまでESを辿る
+
+        progress を指定すると1回の検索ごとに progress(self) を呼ぶ。
+        """
+        started = time.monotonic()
+        try_count, took, timed_out = self.try_count, self._took, self._timed_out
+        while not self.has(count):
+            if self.try_count >= self.MAX_TRY:
+                self.max_flag = True
+                break
+            self.fetch_next()
+            if progress:
+                progress(self)
+        self.cancel_prefetch()
+        self.record_slow(time.monotonic() - started, try_count, took, timed_out)
+
+    async def afill(self, count, progress=None):
+        """fill() の非同期版"""
+        started = time.monotonic()
+        try_count, took, timed_out = self.try_count, self._took, self._timed_out
+        try:
+            while not self.has(count):
+                if self.try_count >= self.MAX_TRY:
+                    self.max_flag = True
+                    break
+                await self.afetch_next()
+                if progress:
+                    progress(self)
+        finally:
+            self.cancel_prefetch()
+        elapsed = time.monotonic() - started
+        if slow_query.is_slow(elapsed):
+            await request_metrics.sync_to_async(self.record_slow)(elapsed, try_count, took, timed_out)
+
+    def record_slow(self, elapsed, try_count, took, timed_out=0):
+        """遅い検索の記録(fill 1回で行ったES検索分)"""
+        if self.try_count > try_count:
+            slow_query.record(self.query_index, self.query, elapsed,
+                              self.try_count - try_count, self._took - took,
+                              self._timed_out > timed_out)
+
+    def make_request(self, search_datatime_start, search_datatime_end, after_key):
+        """指定期間・位置のES検索の (インデックス, クエリ)"""
+        # 期間に掛かるインデックスのみ検索
+        index = route_index(search_datatime_start, search_datatime_end,
+                            self.my_flag, self.nowtime)
+        if self._query_template is None:
+            self._query_template = make_video_query_template(
+                self.keyword, self.liverNameId, self.channelList, self.ex_channelList,
+                self.sort_mode, self.least_count, self.title_keyword)
+        query = apply_video_window(self._query_template, search_datatime_start,
+                                   search_datatime_end, after_key)
+        # logger.info("query" + json.dumps(query))
+        return index, query
+
+    def search(self, search_datatime_start, search_datatime_end, after_key):
+        """指定期間・位置のES検索 (インデックス, クエリ, 結果)"""
+        index, query = self.make_request(
+            search_datatime_start, search_datatime_end, after_key)
+        return index, query, es_client.search(index, query)
+
+    async def asearch(self, search_datatime_start, search_datatime_end, after_key):
+        """search() の非同期版"""
+        index, query = self.make_request(
+            search_datatime_start, search_datatime_end, after_key)
+        return index, query, await es_client.async_search(index, query)
+
+    def window_key(self, search_datatime_start, search_datatime_end):
+        return search_datatime_start.isoformat() + "/" + search_datatime_end.isoformat()
+
+    def prefetch_windows(self, submit=None):
+        """全期間検索で、現在以降の期間の最初のページを並列に検索しておく
+
+        submit(開始, 終了) は検索を開始して Future 等を返す(省略時はスレッドで実行)。
+        """
+        if submit is None:
+            def submit(search_datatime_start, search_datatime_end):
+                # 処理時間の記録先(リクエストのコンテキスト)を引き継ぐ
+                return window_executor.submit(
+                    contextvars.copy_context().run,
+                    self.search, search_datatime_start, search_datatime_end, None)
+        search_datatime_start = self.search_datatime_start
+        search_datatime_end = self.search_datatime_end
+        timeset_flag = self.timeset_flag
+        for i in range(FANOUT_WINDOWS):
+            key = self.window_key(search_datatime_start, search_datatime_end)
+            if key not in self._prefetch:
+                self._prefetch[key] = submit(
+                    search_datatime_start, search_datatime_end)
+            if not timeset_flag:
+                break
+            search_datatime_start, search_datatime_end, timeset_flag = self.following_window(
+                search_datatime_start, search_datatime_end)
+
+    def cancel_prefetch(self):
+        """不要になった先読みを取り消す(実行中のものは結果を捨てる)"""
+        for future in self._prefetch.values():
+            future.cancel()
+        self._prefetch = {}
+
+    def fetch_next(self):
+        """ESを1回検索して結果を items に追加する"""
+        self.try_count += 1
+        self.chunk_starts.append((len(self.items), self.position()))
+
+        future = None
+        if self.after_key is None and FANOUT_WINDOWS > 1:
+            if self.timeset_flag:
+                self.prefetch_windows()
+            future = self._prefetch.pop(self.window_key(
+                self.search_datatime_start, self.search_datatime_end), None)
+        if future:
+            self.query_index, self.query, result = future.result()
+        else:
+            self.query_index, self.query, result = self.search(
+                self.search_datatime_start, self.search_datatime_end, self.after_key)
+        self.add_result(result)
+
+    async def afetch_next(self):
+        """fetch_next() の非同期版(先読みはイベントループ上のタスクで行う)"""
+        self.try_count += 1
+        self.chunk_starts.append((len(self.items), self.position()))
+
+        task = None
+        if self.after_key is None and FANOUT_WINDOWS > 1:
+            if self.timeset_flag:
+                self.prefetch_windows(lambda search_datatime_start, search_datatime_end: asyncio.ensure_future(
+                    self.asearch(search_datatime_start, search_datatime_end, None)))
+            task = self._prefetch.pop(self.window_key(
+                self.search_datatime_start, self.search_datatime_end), None)
+        if task:
+            self.query_index, self.query, result = await task
+        else:
+            self.query_index, self.query, result = await self.asearch(
+                self.search_datatime_start, self.search_datatime_end, self.after_key)
+        # DBでの絞り込みはスレッドで実行
+        await request_metrics.sync_to_async(self.add_result)(result)
+
+    def add_result(self, result):
+        """ES検索結果をDBの情報で絞り込んで items に追加し、検索位置を進める"""
+        self._took += result.get('took', 0)
+        if result.get('timed_out'):
+            self._timed_out += 1
+        self.after_key = result["aggregations"]["group_by_video_id"].get(
+            "after_key")
+        buckets = result["aggregations"]["group_by_video_id"]["buckets"]
+
+        result_dict = {}
+        video_id_list = []
+        for bucket in buckets:
+            if self.sort_mode == '2':
+                video_id = bucket['key']
+            else:
+                video_id = bucket['key']['video_id']
+            video_id_list.append(video_id)
+            doc_count = bucket['doc_count']
+            if doc_count >= self.least_count:
+                result_dict[video_id] = doc_count
+
+        for video in self.filter_videos(result_dict, [video_id for video_id in video_id_list if video_id in result_dict]):
+            self.items.append((video.id, result_dict[video.id]))
+
+        if not self.after_key:
+            if self.timeset_flag:
+                # 次の期間で再度コメント取得
+                self.next_window()
+            else:
+                # データの取得完了
+                self.exhausted = True
+
+    def following_window(self, search_datatime_start, search_datatime_end):
+        """次の期間 (開始, 終了, さらに次の期間があるか)"""
+        timeset_flag = True
+        if self.sort_mode == '0':
+            search_datatime_end = search_datatime_start
+            search_datatime_start = search_datatime_end - \
+                relativedelta(months=1)
+            if search_datatime_start < self.req_search_datatime_start:
+                timeset_flag = False
+                search_datatime_start = self.req_search_datatime_start
+        elif self.sort_mode == '1':
+            search_datatime_start = search_datatime_end
+            search_datatime_end = search_datatime_start + \
+                relativedelta(months=1)
+            if search_datatime_end > self.req_search_datatime_end:
+                timeset_flag = False
+                search_datatime_end = self.req_search_datatime_end
+        return search_datatime_start, search_datatime_end, timeset_flag
+
+    def next_window(self):
+        self.search_datatime_start, self.search_datatime_end, self.timeset_flag = self.following_window(
+            self.search_datatime_start, self.search_datatime_end)
+
+    def filter_videos(self, result_dict, video_id_list):
+        """ヒットした動画をDBの情報で絞り込み、ESの順序で返す"""
+        video_list = bulk_videos(video_id_list, enable_only=not self.my_flag)
+
+        # 非公開等の動画の確認はまとめて行う
+        available_dict = {}
+        if not self.my_flag:
+            available_dict = video_availability.check_many(
+                [video for video in video_list if not (video.enable and video.public)])
+
+        title_keyword = self.title_keyword
+        for video in video_list:
+            if self.my_flag:
+                if video is None:
+                    continue
+            else:
+                # if video is None or check_video(video) == False:
+                if video is None:
+                    continue
+                if not (video.enable and video.public) and available_dict[video.id] == False:
+                    continue
+                '''
+                if "メン限" in video.title or "メンバーシップ限定" in video.title:
+                    # TODO 特殊対応　メン限が配信タイトルにあれば対象外とする
+                    continue
+                '''
+
+            # タイトル条件判定
+            # logger.info(video.title)
+            title_hit_flag = False
+            if title_keyword.replace('　', ' ').replace(' ', '') != '':
+                for word in title_keyword.replace('　', ' ').split(' '):
+                    # logger.info(word)
+                    if len(word) > 1 and word[0] == "-":
+                        if word[1:] in video.title:
+                            # logger.info("hit1" + word)
+                            title_hit_flag = False
+                            break
+                    elif len(word) > 0 and word in video.title:
+                        # logger.info("hit2" + word)
+                        title_hit_flag = True
+                if not title_hit_flag:
+                    continue
+
+            yield video
+
+
+def make_cursor_token(cursor, signature, page_number):
+    """次ページ用カーソルの署名付きトークン"""
+    return signing.dumps({'signature': signature, 'page': page_number, 'cursor': cursor},
+                         salt='comment.VideoSearch.cursor', compress=True)
+
+
+def load_cursor_token(token, signature, page_number):
+    """トークンからカーソルを復元。検索条件・ページが一致しない場合は None"""
+    if not token:
+        return None
+    try:
+        data = signing.loads(token, salt='comment.VideoSearch.cursor',
+                             max_age=CURSOR_MAX_AGE)
+    except signing.BadSignature:
+        return None
+    if data['signature'] != signature or data['page'] != page_number:
+        return None
+    return data['cursor']
+
+
 def livername_get_keyword(liverNameId):
     return LiverName.objects.get(pk=liverNameId).keyword
 
@@ -1375,9 +2117,10 @@ def channel_edit(request, channel_id=None):
                 channel.no = max['no__max'] + 1
                 # channel.group_id = 1  # デフォルトで1に設定　その後手動で変更
             channel.save()
+            channel_topology.invalidate()
 
             # 動画一覧取得
-            future = executor.submit(collet_videolist, channel)
+            future = collector.submit(channel)
             # collet_videolist(channel)
 
             return redirect('comment:channel_list')
@@ -1393,61 +2136,12 @@ def channel_del(request, channel_id):
     # return HttpResponse('チャンネルの削除')
     channel = get_object_or_404(Channel, pk=channel_id)
     channel.delete()
+    channel_topology.invalidate()
     return redirect('comment:channel_list')
 
 
 def collet_videolist(channel, new_flag=True, db_only_flag=False):
-
-    try:
-        if not (db_only_flag):
-            # 動画一覧情報
-            etag, infos = yt.get_video_id_list_by_playlist_id(
-                channel.id, not (new_flag), channel.etag)
-            channel.etag = etag
-            channel.save()
-            video_id_list = []
-
-            for video_id in infos:
-                video = Video.objects.filter(id=video_id).first()
-                if video is None:
-                    if video_id not in video_id_list:
-                        video_id_list.append(video_id)
-                else:
-                    check_video(video)
-
-            infos = yt.get_video_snippet_list(video_id_list)
-            db_new_video_list = []
-            for info in infos:
-                [video_id, item] = info
-
-                title = item['snippet']['title']
-                publishedAt = item['snippet']['publishedAt']
-
-                video = Video()
-                video.channel = channel
-                video.id = video_id
-                video.title = unquote(emoji.demojize(title))
-                video.description = ""
-                video.publishedAt = datetime.strptime(publishedAt, '%Y-%m-%dT%H:%M:%SZ').replace(
-                    tzinfo=timezone(timedelta(hours=+9)))
-                video.enable = True
-                video.public = True
-                video.collecting_flag = True
-                # video.save()
-
-                if 'liveStreamingDetails' in item:
-                    if 'scheduledStartTime' in item['liveStreamingDetails']:
-                        video.scheduledStartTime = item['liveStreamingDetails']['scheduledStartTime']
-                else:
-                    logger.info("非配信:" + video.id, exc_info=True)
-                    video.enable = False
-
-                db_new_video_list.append(video)
-
-            Video.objects.bulk_create(db_new_video_list)
-    except:
-        logger.info("想定外エラー:" + channel.id, exc_info=True)
-    logger.info("collet_videolist完了：" + channel.id)
+    return collector.collect_channel(channel, new_flag, db_only_flag)
 
 
 # ページネーション用に、Pageオブジェクトを返す。